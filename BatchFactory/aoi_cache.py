@@ -0,0 +1,196 @@
+###############################################################################################################################################################################
+#
+# AOI Cache - prepared AOIs (KML converted to a file geodatabase, FW Setup shapefiles) kept on local disk and keyed by the
+# hash of the input files plus the template, so a retry or a second tool on the same AOI reuses the prepared geometry
+#
+# Each entry is a folder named after its key holding the prepared files and an aoi.json naming the result inside it.
+# Entries are built in a staging folder and renamed into place, so parallel workers never see a half written entry.
+# The folder's modified time is the last use, the least recently used entries are removed once the cache is bigger
+# than AOI_CACHE_MAX_MB (0 turns the cache off). Jobs read their AOI straight from the entry, so an entry used in the last
+# AOI_CACHE_PROTECT_HOURS is never removed, and a worker marks the entry as used again when its job starts.
+#
+###############################################################################################################################################################################
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from job_fingerprint import hash_file, SHAPEFILE_SIDECARS
+from env_config import get_env_number
+
+ENTRY_FILE = 'aoi.json'
+
+# One cache per process, created the first time get_aoi_cache is called
+AOI_CACHE_INSTANCE = None
+
+# Template hashes by (path, mtime, size), the template is on the network share and is the same for every job
+TEMPLATE_HASHES = {}
+
+
+def get_input_files(path):
+    ''' Returns the files that make up an input: a shapefile and its sidecar files, or the file itself '''
+    if str(path).lower().endswith('.shp'):
+        base = os.path.splitext(path)[0]
+        return [base + ext for ext in SHAPEFILE_SIDECARS if os.path.exists(base + ext)]
+    return [path]
+
+
+def hash_template(template):
+    ''' Returns the hash of the template's files, reusing the last hash while the template's mtime and size are unchanged '''
+    stat = os.stat(template)
+    key = (template, stat.st_mtime, stat.st_size)
+    if key not in TEMPLATE_HASHES:
+        TEMPLATE_HASHES[key] = [hash_file(f) for f in get_input_files(template)]
+    return TEMPLATE_HASHES[key]
+
+
+def hash_aoi_inputs(path, template=None, extra=None):
+    '''
+    Returns the cache key for an AOI: a sha256 over the content of the input files, the template's files and anything in
+    extra that changes the prepared output (e.g. the kind of preparation and the FW file number). File paths aren't part
+    of the key, the same KML copied to another folder is the same AOI.
+    '''
+    sha = hashlib.sha256()
+    for f in get_input_files(path):
+        sha.update(os.path.splitext(f)[1].lower().encode('utf-8'))
+        sha.update(hash_file(f).encode('utf-8'))
+    if template:
+        for file_hash in hash_template(template):
+            sha.update(file_hash.encode('utf-8'))
+    sha.update(json.dumps(extra or {}, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class AOI_CACHE:
+    ''' Content addressed cache of prepared AOIs on local disk with least recently used eviction by total size '''
+
+    def __init__(self, cache_dir=None, max_bytes=None, protect_seconds=None, logger=None) -> None:
+        self.cache_dir = cache_dir or os.getenv('AOI_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'batchfactory_aoi_cache')
+        self.max_bytes = max_bytes if max_bytes is not None else get_env_number('AOI_CACHE_MAX_MB', 2048, float) * 1024 * 1024
+        # Longer than a job can run (JOB_TIMEOUT, 6 hours) plus its retries, an entry a job may still be reading is kept
+        self.protect_seconds = protect_seconds if protect_seconds is not None else get_env_number('AOI_CACHE_PROTECT_HOURS', 24, float) * 3600
+        self.logger = logger or logging.getLogger(__name__)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        ''' Returns the path of the cached result for key, or None on a miss. A hit marks the entry as just used '''
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, ENTRY_FILE), encoding='utf-8') as f:
+                result = json.load(f)['result']
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            return None
+        return os.path.join(entry, result)
+
+    def touch(self, path):
+        ''' Marks the entry a cached AOI path belongs to as just used. Paths outside the cache are ignored '''
+        try:
+            relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.cache_dir))
+        except ValueError:
+            # Different drive on Windows
+            return
+        name = relative.replace('\\', '/').split('/')[0]
+        if relative.startswith('..') or name in ['', '.'] or name.endswith('.tmp'):
+            return
+        try:
+            os.utime(self.entry_path(name))
+        except OSError:
+            pass
+
+    def put(self, key, build, source=None):
+        '''
+        Builds an entry and returns the path of its result. build(staging_folder) writes the prepared files into the
+        staging folder and returns the result's path relative to it. If another process stored the same key first its
+        entry is used and ours is thrown away.
+        '''
+        staging = tempfile.mkdtemp(prefix=f'{key[:16]}.', suffix='.tmp', dir=self.cache_dir)
+        try:
+            result = build(staging)
+            with open(os.path.join(staging, ENTRY_FILE), 'w', encoding='utf-8') as f:
+                json.dump({'result': result, 'source': source, 'created': time.time()}, f)
+            os.rename(staging, self.entry_path(key))
+        except OSError:
+            # Lost the race to another worker building the same AOI
+            if self.get(key) is None:
+                raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+        return self.get(key)
+
+    def get_or_build(self, key, build, source=None):
+        ''' Returns the cached result for key, building and storing it first on a miss '''
+        cached = self.get(key)
+        if cached is not None:
+            print(f"AOI Cache: Reusing the prepared AOI for {source}")
+            self.logger.info(f"AOI Cache: Hit for {source} ({key[:12]}), using {cached}")
+            return cached
+
+        self.logger.info(f"AOI Cache: Miss for {source} ({key[:12]}), preparing the AOI")
+        return self.put(key, build, source)
+
+    def entry_size(self, entry):
+        ''' Returns the total size in bytes of the files in an entry '''
+        size = 0
+        for folder, _, files in os.walk(entry):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(folder, name))
+                except OSError:
+                    pass
+        return size
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes. The entry named keep and entries used
+        in the last protect_seconds are never removed, a running job may still be reading them.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = self.entry_path(name)
+            # Staging folders belong to builds still in progress
+            if name.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry), name, self.entry_size(entry)))
+            except OSError:
+                continue
+
+        total = sum(size for _, _, size in entries)
+        protected_since = time.time() - self.protect_seconds
+        for last_used, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep or last_used > protected_since:
+                continue
+            shutil.rmtree(self.entry_path(name), ignore_errors=True)
+            total -= size
+            self.logger.info(f"AOI Cache: Evicted {name[:12]} ({size / (1024 * 1024):.1f} MB)")
+
+        if total > self.max_bytes:
+            self.logger.info(f"AOI Cache: {total / (1024 * 1024):.1f} MB is over the limit, the rest of the entries are in use")
+
+
+def touch_cached_aoi(path, logger=None):
+    ''' Called by a worker when a job starts, so the job's cached AOI isn't evicted while the tool reads it '''
+    cache = get_aoi_cache(logger)
+    if cache is not None and path:
+        cache.touch(str(path))
+
+
+def get_aoi_cache(logger=None):
+    ''' Returns this process's AOI cache, or None if AOI_CACHE_MAX_MB is 0 '''
+    global AOI_CACHE_INSTANCE
+    if get_env_number('AOI_CACHE_MAX_MB', 2048, float) <= 0:
+        return None
+    if AOI_CACHE_INSTANCE is None:
+        AOI_CACHE_INSTANCE = AOI_CACHE(logger=logger)
+    return AOI_CACHE_INSTANCE
@@ -0,0 +1,96 @@
+###############################################################################################################################################################################
+#
+# AOI Preparation - prepares each job's AOI (KML conversion, FW Setup) on a thread pool while the first jobs already run
+#
+# The preparation is a job source for the JOB_SCHEDULER: every queued job is submitted to the pool up front (in dispatch
+# order) and the scheduler claims each job as soon as its AOI is ready, so tool runs start after the first AOI instead of
+# after the last one.
+#
+###############################################################################################################################################################################
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AOI_PREPARATION:
+    '''
+    Job source that runs prepare(job_index, job) for every job on `workers` threads and hands the prepared jobs to the
+    scheduler in the order they finish. A job whose preparation fails is still handed over, like load_jobs did when it
+    prepared the AOIs itself, the error is in the log and the tool decides what to do with the unprepared input. A job
+    prepare returns None for (an input the batch can't run) was already marked Failed and is not handed over.
+    '''
+
+    # How often the scheduler checks for prepared jobs while none are ready
+    POLL_SECONDS = 1
+
+    def __init__(self, jobs, prepare, workers, logger=None) -> None:
+        self.prepare = prepare
+        self.logger = logger or logging.getLogger(__name__)
+        self.poll_seconds = self.POLL_SECONDS
+        self.ready = queue.Queue()
+        self.remaining = len(jobs)
+        self.lock = threading.Lock()
+        self.prepare_seconds = []
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aoi_prep')
+        for job_index, job in jobs:
+            self.executor.submit(self.prepare_job, job_index, job)
+
+        print(f"AOI Preparation: Preparing {len(jobs)} AOIs on {workers} threads")
+        self.logger.info(f"AOI Preparation: Preparing {len(jobs)} AOIs on {workers} threads")
+
+    def prepare_job(self, job_index, job):
+        '''
+        Runs on a pool thread. Prepares one job and puts it on the ready queue whether or not the preparation worked,
+        unless prepare returned None: that job was already marked Failed and is dropped
+        '''
+        start = time.time()
+        prepared = job
+        try:
+            prepared = self.prepare(job_index, job)
+        except Exception as e:
+            print(f"AOI Preparation: Preparing job {job_index} failed: {e}")
+            self.logger.error(f"AOI Preparation: Preparing job {job_index} failed: {e}")
+        finally:
+            seconds = time.time() - start
+            with self.lock:
+                self.prepare_seconds.append(seconds)
+                if prepared is None:
+                    self.remaining -= 1
+            if prepared is None:
+                self.logger.info(f"AOI Preparation: Job {job_index} was marked Failed after {seconds:.1f} seconds, not queued")
+            else:
+                self.logger.info(f"AOI Preparation: Job {job_index} ready after {seconds:.1f} seconds")
+                self.ready.put((job_index, job))
+
+    def claim(self, count):
+        ''' Returns up to count prepared (job_index, job) pairs without waiting for the ones still being prepared '''
+        claimed = []
+        while len(claimed) < count:
+            try:
+                claimed.append(self.ready.get_nowait())
+            except queue.Empty:
+                break
+        with self.lock:
+            self.remaining -= len(claimed)
+        return claimed
+
+    def release(self, job_index):
+        ''' Nothing to give back, a job that wasn't run stays Queued in the queuefile '''
+        pass
+
+    def has_more(self):
+        ''' True until every submitted job has been claimed '''
+        with self.lock:
+            return self.remaining > 0
+
+    def shutdown(self):
+        ''' Stops the pool. Preparations that haven't started are cancelled '''
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.prepare_seconds:
+            total = sum(self.prepare_seconds)
+            print(f"AOI Preparation: {len(self.prepare_seconds)} AOIs prepared in {total:.1f} thread seconds")
+            self.logger.info(f"AOI Preparation: {len(self.prepare_seconds)} AOIs prepared in {total:.1f} thread seconds "
+                             f"(mean {total / len(self.prepare_seconds):.1f})")
@@ -1,13 +1,19 @@
 
-import arcpy
 import os
+import re
 import datetime
-import geopandas
 import shutil
+import threading
+from gp_backend import get_backend
+from aoi_cache import get_aoi_cache, hash_aoi_inputs
 
 # Assign the shapefile template for FW Setup to a variable
 template = os.getenv('TEMPLATE') # File path in .env
 
+# Held while FW Setup runs and while the connection broker probes the BCGW connection, arcpy can't run tools from
+# several threads of one process at once
+FW_SETUP_LOCK = threading.Lock()
+
 # def classify_input_type(job, logger):
 #     '''Classify the input type and process accordingly.'''
 
@@ -40,6 +46,21 @@ template = os.getenv('TEMPLATE') # File path in .env
 #         print('No feature layer provided in job')
 #         logger.warning('Classifying Input Type - No feature layer provided in job')
 
+def write_kml_to_gdb(aoi, out_folder):
+        "Writes the KML to a file geodatabase in out_folder, returns the gdb name and the feature class name"
+        import geopandas
+        from fiona.drvsupport import supported_drivers
+        supported_drivers['LIBKML'] = 'rw'
+        bname = os.path.basename(aoi).split('.')[0]
+        fc = get_layer_name(aoi, set())
+        out_name = os.path.join(out_folder, bname + '.gdb')
+        if os.path.exists(out_name):
+            shutil.rmtree(out_name, ignore_errors=True)
+        df = geopandas.read_file(aoi)
+        df.to_file(out_name, layer=fc, driver='OpenFileGDB')
+        return bname + '.gdb', fc
+
+
 def build_aoi_from_kml(aoi, logger):
         "Write shp file for temporary use"
 
@@ -47,20 +68,27 @@ def build_aoi_from_kml(aoi, logger):
         if not os.path.exists(aoi):
             raise FileNotFoundError(f"The KML file '{aoi}' does not exist.")
 
+        # A KML that was already converted (same content) comes straight from the AOI cache
+        cache = get_aoi_cache(logger)
+        if cache is not None:
+            def build(staging):
+                print("Building AOI from KML")
+                logger.info("Building AOI from KML")
+                gdb_name, fc = write_kml_to_gdb(aoi, staging)
+                return gdb_name + '/' + fc
+
+            cached = cache.get_or_build(get_kml_cache_key(aoi), build, source=aoi)
+            print(f' kml ouput is {cached}')
+            logger.info(f' kml ouput is {cached}')
+            return cached
+
         print("Building AOI from KML")
         logger.info("Building AOI from KML")
-        from fiona.drvsupport import supported_drivers
-        supported_drivers['LIBKML'] = 'rw'
         tmp = os.getenv('TEMP')
         if not tmp:
             raise EnvironmentError("TEMP environment variable is not set.")
-        bname = os.path.basename(aoi).split('.')[0]
-        fc = bname.replace(' ', '_')
-        out_name = os.path.join(tmp, bname + '.gdb')
-        if os.path.exists(out_name):
-            shutil.rmtree(out_name, ignore_errors=True)
-        df = geopandas.read_file(aoi)
-        df.to_file(out_name, layer=fc, driver='OpenFileGDB')
+        gdb_name, fc = write_kml_to_gdb(aoi, tmp)
+        out_name = os.path.join(tmp, gdb_name)
 
         #DELETE?
         print(f' kml ouput is {out_name} / {fc}')
@@ -69,6 +97,105 @@ def build_aoi_from_kml(aoi, logger):
 
 
 
+def get_layer_name(aoi, used_names):
+        "Returns a geodatabase layer name for the KML: its file name with anything but letters, digits and _ replaced, unique within used_names"
+        name = re.sub(r'[^0-9A-Za-z_]', '_', os.path.basename(aoi).split('.')[0])
+        if not name or not name[0].isalpha():
+            name = 'aoi_' + name
+        unique_name = name
+        suffix = 2
+        while unique_name.lower() in used_names:
+            unique_name = f"{name}_{suffix}"
+            suffix += 1
+        used_names.add(unique_name.lower())
+        return unique_name
+
+
+def get_kml_cache_key(aoi):
+        "Returns the AOI cache key for a converted KML. The layer is named after the KML, so two KMLs with the same content but different names are cached apart"
+        return hash_aoi_inputs(aoi, extra={'kind': 'kml', 'layer': get_layer_name(aoi, set())})
+
+
+def normalise_aoi_geometries(geometries):
+        """Cleans every AOI geometry in one pass with shapely 2 array functions: drops the KML Z values, repairs invalid
+        polygons and keeps only the polygon parts (make_valid can return collections with lines and points).
+        Returns an array of MultiPolygons, None where a geometry had no polygon left"""
+        import numpy
+        import shapely
+
+        geometries = shapely.make_valid(shapely.force_2d(numpy.asarray(geometries, dtype=object)))
+
+        # Two levels of parts: collections hold multipolygons, multipolygons hold polygons
+        parts, part_index = shapely.get_parts(geometries, return_index=True)
+        polygons, polygon_index = shapely.get_parts(parts, return_index=True)
+        source_index = part_index[polygon_index]
+        keep = (shapely.get_type_id(polygons) == 3) & ~shapely.is_empty(polygons)
+
+        normalised = numpy.full(len(geometries), None, dtype=object)
+        if keep.any():
+            shapely.multipolygons(polygons[keep], indices=source_index[keep], out=normalised)
+        return normalised
+
+
+def build_aois_from_kmls(aois, logger):
+        """Converts many KMLs in one go: KMLs already in the AOI cache come from the cache, the rest are read into one
+        GeoDataFrame, normalised together and written to a single shared file geodatabase with one layer per KML.
+        Returns {kml path: gdb/layer} for every KML that could be converted, missing or unreadable KMLs are left out and logged"""
+        import geopandas
+        import pandas
+        from fiona.drvsupport import supported_drivers
+        supported_drivers['LIBKML'] = 'rw'
+
+        converted = {}
+        cache = get_aoi_cache(logger)
+        frames = []
+        for aoi in dict.fromkeys(aois):
+            if not os.path.exists(aoi):
+                print(f"The KML file '{aoi}' does not exist.")
+                logger.error(f"Batch KML Conversion - The KML file '{aoi}' does not exist.")
+                continue
+            if cache is not None:
+                cached = cache.get(get_kml_cache_key(aoi))
+                if cached is not None:
+                    converted[aoi] = cached
+                    continue
+            try:
+                df = geopandas.read_file(aoi)
+            except Exception as e:
+                print(f"Unable to read KML '{aoi}': {e}")
+                logger.error(f"Batch KML Conversion - Unable to read KML '{aoi}': {e}")
+                continue
+            df['source_kml'] = aoi
+            frames.append(df)
+
+        print(f"Batch KML Conversion: {len(converted)} KMLs from the AOI cache, {len(frames)} to convert")
+        logger.info(f"Batch KML Conversion: {len(converted)} KMLs from the AOI cache, {len(frames)} to convert")
+        if not frames:
+            return converted
+
+        placemarks = geopandas.GeoDataFrame(pandas.concat(frames, ignore_index=True), crs=frames[0].crs)
+        placemarks['geometry'] = normalise_aoi_geometries(placemarks.geometry.values)
+        placemarks = placemarks[placemarks.geometry.notna()]
+
+        tmp = os.getenv('TEMP')
+        if not tmp:
+            raise EnvironmentError("TEMP environment variable is not set.")
+        out_name = os.path.join(tmp, f'kml_aois_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.gdb')
+
+        used_names = set()
+        for aoi, layer in placemarks.groupby('source_kml', sort=False):
+            fc = get_layer_name(aoi, used_names)
+            # Columns that only came from the other KMLs are dropped
+            layer = layer.drop(columns='source_kml').dropna(axis=1, how='all')
+            layer.to_file(out_name, layer=fc, driver='OpenFileGDB')
+            converted[aoi] = out_name + '/' + fc
+
+        print(f"Batch KML Conversion: {len(used_names)} AOIs written to {out_name}")
+        logger.info(f"Batch KML Conversion: {len(used_names)} AOIs written to {out_name}, "
+                    f"{len([aoi for aoi in dict.fromkeys(aois) if aoi not in converted])} KMLs not converted")
+        return converted
+
+
 def build_aoi_from_shp(job, feature_layer_path, template, logger):
         """This is snippets of Mike Eastwoods FW Setup Script, if run FW Setup is set to true **Not sure if we need this
         as an option or just make it standard.
@@ -82,9 +209,9 @@ def build_aoi_from_shp(job, feature_layer_path, template, logger):
         print("Processing shapefile using FW Setup Script")
         logger.info("Processing shapefile using FW Setup Script")
         
+        backend = get_backend()
         fsj_workspace = os.getenv('FSJ_WORKSPACE')
-        arcpy.env.workspace = fsj_workspace
-        arcpy.env.overwriteOutput = False
+        backend.set_environment(workspace=fsj_workspace, overwrite_output=False)
 
         # Check if there is a file path in Feature Layer
         if feature_layer_path:
@@ -108,14 +235,12 @@ def build_aoi_from_shp(job, feature_layer_path, template, logger):
         year = str(date.year)
 
         # Set variables
-        base = arcpy.env.workspace
+        base = fsj_workspace
         baseYear = os.path.join(base, year)
         outName = file_number_str
         geometry = "POLYGON"
     
-        m = "SAME_AS_TEMPLATE"
-        z = "SAME_AS_TEMPLATE"
-        spatialReference = arcpy.Describe(template).spatialReference
+        spatialReference = backend.describe_spatial_reference(template)
 
         # ===========================================================================
         # Create Folders
@@ -147,24 +272,46 @@ def build_aoi_from_shp(job, feature_layer_path, template, logger):
             print("Exiting without creating files")
             logger.info("Exiting without creating files")
             return os.path.join(outPath, outName + ".shp")
-        else:
-            # Creating template shapefile
-            create_shp = arcpy.management.CreateFeatureclass(outPath, outName, geometry, template, m, z, spatialReference)
-            # Append the newly created shapefile with area of interest
-            append_shp = arcpy.management.Append(feature_layer_path, create_shp, "NO_TEST")
-            print("Append Successful")
-            logger.info("Append Successful")
-            # Making filename for kml
-            create_kml = os.path.join(outPath, outName + ".kml")
-            # Make layer for kml to be converted from 
-            layer_shp = arcpy.management.MakeFeatureLayer(append_shp, outName)
-            # Populate the shapefile                          
-            arcpy.conversion.LayerToKML(layer_shp, create_kml)
-            # Send message to user that kml has been created
-            print("kml created: " + create_kml)
-            logger.info("kml created: " + create_kml)
-
-            print(f"FW Setup complete, returned shapefile is {os.path.join(outPath, outName + '.shp')}")
-            logger.info(f"FW Setup complete, returned shapefile is {os.path.join(outPath, outName + '.shp')}")
-
-            return os.path.join(outPath, outName + ".shp")
\ No newline at end of file
+
+        # The same shapefile, template and file number were set up before, copy the prepared files instead of re-running FW Setup
+        cache = get_aoi_cache(logger)
+        cache_key = None
+        if cache is not None:
+            cache_key = hash_aoi_inputs(feature_layer_path, template, extra={'kind': 'fw_setup', 'file_number': file_number_str})
+            cached = cache.get(cache_key)
+            if cached is not None:
+                cached_folder = os.path.dirname(cached)
+                for name in os.listdir(cached_folder):
+                    if name.startswith(outName + "."):
+                        shutil.copy2(os.path.join(cached_folder, name), outPath)
+                print(f"FW Setup restored from the AOI cache, returned shapefile is {os.path.join(outPath, outName + '.shp')}")
+                logger.info(f"FW Setup restored from the AOI cache ({cached}), returned shapefile is {os.path.join(outPath, outName + '.shp')}")
+                return os.path.join(outPath, outName + ".shp")
+
+        # Creating template shapefile
+        create_shp = backend.create_feature_class(outPath, outName, geometry, template, spatialReference)
+        # Append the newly created shapefile with area of interest
+        append_shp = backend.append(feature_layer_path, create_shp)
+        print("Append Successful")
+        logger.info("Append Successful")
+        # Making filename for kml
+        create_kml = os.path.join(outPath, outName + ".kml")
+        # Convert the populated shapefile to kml
+        backend.convert_to_kml(append_shp, outName, create_kml)
+        # Send message to user that kml has been created
+        print("kml created: " + create_kml)
+        logger.info("kml created: " + create_kml)
+
+        print(f"FW Setup complete, returned shapefile is {os.path.join(outPath, outName + '.shp')}")
+        logger.info(f"FW Setup complete, returned shapefile is {os.path.join(outPath, outName + '.shp')}")
+
+        # Keep a copy of the FW Setup files (shapefile, sidecars and kml) for the next job on the same AOI
+        if cache_key is not None:
+            def build(staging):
+                for name in os.listdir(outPath):
+                    if name.startswith(outName + "."):
+                        shutil.copy2(os.path.join(outPath, name), staging)
+                return outName + ".shp"
+            cache.put(cache_key, build, source=feature_layer_path)
+
+        return os.path.join(outPath, outName + ".shp")
\ No newline at end of file
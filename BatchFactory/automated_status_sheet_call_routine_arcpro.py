@@ -164,19 +164,27 @@ def main():
     arcpy.AddMessage("======================================================================")
     arcpy.AddMessage("Checking BCGW Credentials - may take a minute to process...")
 
-    #set the key name that will be used for storing credentials in keyring
-    key_name = config.CONNNAME
-    try:
-        oracleCreds = connect_bcgw.ManageCredentials(key_name, output_directory)
-        #get sde path location
-        if not oracleCreds.check_credentials():
-            arcpy.AddError("BCGW credentials could not be established.")
+    # Batch runs share the connection BatchFactory already created and checked, so each job doesn't log in again
+    sde = os.getenv("BCGW_SDE_FILE")
+    batch_connection = bool(sde and os.path.exists(sde))
+    if batch_connection:
+        arcpy.AddMessage(f"Using the batch BCGW connection {sde}")
+        # The overlap and status tab scripts read the connection from SDE_FILE_PATH
+        os.environ["SDE_FILE_PATH"] = sde
+    else:
+        #set the key name that will be used for storing credentials in keyring
+        key_name = config.CONNNAME
+        try:
+            oracleCreds = connect_bcgw.ManageCredentials(key_name, output_directory)
+            #get sde path location
+            if not oracleCreds.check_credentials():
+                arcpy.AddError("BCGW credentials could not be established.")
+                sys.exit()
+            sde = os.getenv("SDE_FILE_PATH")
+
+        except Exception as e:
+            arcpy.AddError(f"Failure occurred when establishing BCGW connection - {e}. Please try again.")
             sys.exit()
-        sde = os.getenv("SDE_FILE_PATH")
-
-    except Exception as e:
-        arcpy.AddError(f"Failure occurred when establishing BCGW connection - {e}. Please try again.")
-        sys.exit()
 
     #Check RAAD connection
     raad = os.path.join(sde, "WHSE_ARCHAEOLOGY.RAAD_TFM_SITE")
@@ -558,7 +566,9 @@ def main():
 
     #cleanup temporary sde file
     try:
-        shutil.rmtree(os.path.dirname(os.path.abspath(os.getenv("SDE_FILE_PATH"))))
+        # The batch connection belongs to BatchFactory, which removes it when the batch ends
+        if not batch_connection:
+            shutil.rmtree(os.path.dirname(os.path.abspath(os.getenv("SDE_FILE_PATH"))))
         del os.environ["SDE_FILE_PATH"]
     except Exception as e:
         pass
@@ -0,0 +1,83 @@
+###############################################################################################################################################################################
+#
+# Batch Control - pause, drain or cancel a running batch by writing a command to its control file
+#
+#   python main.py --control pause    stop starting new jobs, running jobs carry on
+#   python main.py --control resume   start new jobs again
+#   python main.py --control drain    stop starting new jobs and end the batch once the running jobs finish
+#   python main.py --control cancel   terminate the running jobs, mark them Requeued and end the batch
+#
+# The next run of main.py picks up every job that isn't COMPLETE, jobs that finished before the batch stopped aren't run again.
+# Add --node SHARED_DIR (or --coordinator SHARED_DIR) to send the command to every node of a sharded batch instead.
+#
+###############################################################################################################################################################################
+import os
+import time
+import logging
+import tempfile
+
+from env_config import get_env_number
+
+CONTROL_COMMANDS = ['pause', 'resume', 'drain', 'cancel']
+
+
+def get_control_file(queuefile):
+    ''' Returns the control file for a queuefile: BATCH_CONTROL_FILE from the .env file, or <queuefile>_control.txt next to it '''
+    return os.getenv('BATCH_CONTROL_FILE') or os.path.splitext(queuefile)[0] + '_control.txt'
+
+
+def write_control(control_file, command):
+    ''' Writes a command to the control file. The file is replaced in one step so the batch never reads half a command '''
+    if command not in CONTROL_COMMANDS:
+        raise ValueError(f"Batch Control: Unknown command '{command}', use one of {CONTROL_COMMANDS}")
+    folder = os.path.dirname(os.path.abspath(control_file))
+    fd, tmp_file = tempfile.mkstemp(prefix='.control_', dir=folder)
+    with os.fdopen(fd, 'w') as f:
+        f.write(command)
+    os.replace(tmp_file, control_file)
+
+
+class BATCH_CONTROL:
+    ''' Reads the control file for the scheduler, at most once every poll_seconds '''
+
+    def __init__(self, control_file, poll_seconds=None, logger=None, owner=True) -> None:
+        self.control_file = control_file
+        # Only the owner of the file clears it. The shard nodes share the coordinator's file, one node clearing it would
+        # hide the command from the nodes that haven't read it yet
+        self.owner = owner
+        self.poll_seconds = poll_seconds if poll_seconds is not None else get_env_number('CONTROL_POLL_SECONDS', 5, float)
+        self.logger = logger or logging.getLogger(__name__)
+        self.last_read = 0.0
+        self.command = None
+
+    def read(self):
+        ''' Returns the current command (pause, drain or cancel), or None to run normally. resume is the same as no command '''
+        if time.time() - self.last_read < self.poll_seconds:
+            return self.command
+        self.last_read = time.time()
+
+        try:
+            with open(self.control_file) as f:
+                command = f.read().strip().lower()
+        except FileNotFoundError:
+            command = None
+        except OSError as e:
+            # Keep the last command if the file can't be read right now
+            self.logger.warning(f"Batch Control: Unable to read {self.control_file}: {e}")
+            return self.command
+
+        if command and command not in CONTROL_COMMANDS:
+            self.logger.warning(f"Batch Control: Ignoring unknown command '{command}' in {self.control_file}")
+            command = self.command
+        self.command = None if command == 'resume' else command
+        return self.command
+
+    def clear(self):
+        ''' Removes the control file, so a drain or cancel only stops the batch it was sent to '''
+        self.command = None
+        if not self.owner:
+            return
+        try:
+            os.remove(self.control_file)
+        except FileNotFoundError:
+            pass
@@ -1,13 +1,33 @@
 
 import os
-from openpyxl import Workbook, load_workbook
-import arcpy
+import time
+from openpyxl import Workbook
 import logging
 import traceback
 import multiprocessing as mp
-from mp_worker import process_job_mp
+from concurrent.futures import ThreadPoolExecutor
+from status_writer import STATUS_WRITER
+from queue_reader import QUEUE_READER, get_queue_format, write_queue_rows, convert_queuefile
+from job_ledger import JOB_LEDGER, hash_job_parameters
+from job_fingerprint import fingerprint_job, outputs_exist
+from job_telemetry import RUN_REPORT, SOURCE_FEATURE_LAYER_KEY
+from job_scheduler import JOB_SCHEDULER, get_max_workers, get_worker_mode
+from job_cost import estimate_job_costs, measure_aoi_files, order_jobs, simulate_makespan
+from dry_run import format_duration, check_tool_signature, check_job_parameters, check_feature_layer, check_output_directory
+from gp_backend import get_backend
+from shared_queue import SHARED_JOB_SOURCE, FINAL_CONDITIONS
+from connection_broker import get_connection_broker
+from batch_control import BATCH_CONTROL, get_control_file
+from batch_progress import BATCH_PROGRESS
+from output_planner import OUTPUT_PLANNER
+from network_staging import INPUT_STAGING, OUTPUT_UPLOADER
+from worker_scratch import stage_outputs_locally, upload_outputs_async
 from aoi_utilities import build_aoi_from_shp
 from aoi_utilities import build_aoi_from_kml
+from aoi_utilities import FW_SETUP_LOCK
+from aoi_utilities import build_aois_from_kmls
+from aoi_preparation import AOI_PREPARATION
+from env_config import get_env_number
 
 
 class BATCH_FACTORY:
@@ -18,7 +38,11 @@ class BATCH_FACTORY:
 
     
     BATCH_CONDITION_COLUMN = 'batch_condition'
-    # DONT_OVERWRITE_OUTPUTS = 'dont_overwrite_outputs'
+    DONT_OVERWRITE_OUTPUTS = 'dont_overwrite_outputs'
+    STATUS_FLUSH_INTERVAL = 60  # seconds between queuefile saves while a batch is running
+    JOB_INDEX_KEY = '_job_index'  # job dictionary key holding the job index (Excel row - 2), not a tool parameter
+    PRIORITY_COLUMN = 'priority'  # optional column, higher priority jobs are dispatched first. Not a tool parameter
+    JOB_TIMEOUT = 21600  # 6 hours in seconds
     AST_SCRIPT = ''
     job_index = None  # Initialize job_index as a global variable
     
@@ -30,6 +54,31 @@ class BATCH_FACTORY:
             self.logger = logger or logging.getLogger(__name__)
             self.current_path = current_path
             self.parameter_names = []   
+            # Only the status writer saves the queuefile
+            self.status_writer = STATUS_WRITER(queuefile, self.XLSX_SHEET_NAME, self.BATCH_CONDITION_COLUMN, self.DONT_OVERWRITE_OUTPUTS, self.logger)
+            # The SQLite ledger next to the queuefile holds the job state, the queuefile is a view of it
+            self.ledger = JOB_LEDGER(os.path.splitext(queuefile)[0] + '_ledger.sqlite', self.logger)
+            # Per job wall time, CPU time, peak memory and I/O for the current batch (csv or parquet)
+            self.run_report = RUN_REPORT(os.path.join(current_path or os.getcwd(), 'run_reports'), os.getenv('RUN_REPORT_FORMAT', 'csv'), self.logger)
+            # Set when this instance runs jobs as a node of a shared queue, every job result is also written there
+            self.shared_queue = None
+            # Set while a batch copies the jobs' network inputs to local disk (STAGE_INPUTS)
+            self.input_staging = None
+            # Set while a batch converts its KMLs together in the background, {kml path: gdb/layer} once done
+            self.kml_conversion = None
+
+    def __getstate__(self):
+        # The factory is sent to every worker process. Input staging and the KML conversion (thread pools, locks and
+        # futures) belong to the parent process, the workers are given jobs that already point at the prepared AOIs
+        state = self.__dict__.copy()
+        state['input_staging'] = None
+        state['kml_conversion'] = None
+        return state
+
+    def get_parameter_names(self, header):
+        ''' Returns the tool parameter names from the queuefile header, leaving out the batch_condition and priority columns '''
+        return [col_name for col_name in header if col_name and col_name not in [self.BATCH_CONDITION_COLUMN, self.PRIORITY_COLUMN]]
+
 #LOAD JOBS
     def load_jobs(self):
         '''
@@ -52,110 +101,57 @@ class BATCH_FACTORY:
         if os.path.exists(self.queuefile):
 
             try:
-                # Open the Excel workbook and select the correct sheet
-                wb = load_workbook(filename=self.queuefile)
-                ws = wb[self.XLSX_SHEET_NAME]
-                
-                if ws not in wb.sheetnames:
-                    raise ValueError(f"'{self.XLSX_SHEET_NAME}' sheet not found in the workbook.")
-                
-                # Get the header row (parameter names)
-                header_row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True))
-                if not header_row or not any(header_row):
-                    raise ValueError("No header found in the spreadsheet.")
+                # Stream the rows out of the queuefile in read-only mode, one job at a time
+                reader = QUEUE_READER(self.queuefile, self.XLSX_SHEET_NAME, self.logger)
 
-                # Convert None headers to empty strings if needed
-                header = [h if h is not None else "" for h in header_row]
+                # Get the header row (parameter names)
+                header = reader.read_header()
                 
                 # Store these header names in self.parameter_names so we can reference them later
-                # but exclude any known special columns like self.BATCH_CONDITION_COLUMN:
-                self.parameter_names = []
-                for col_name in header:
-                    if col_name and col_name != self.BATCH_CONDITION_COLUMN:
-                        self.parameter_names.append(col_name)
+                # but exclude any known special columns like self.BATCH_CONDITION_COLUMN and self.PRIORITY_COLUMN:
+                self.parameter_names = self.get_parameter_names(header)
                         
                 self.logger.info(f"Identified parameter names: {self.parameter_names}")
                 
                 self.jobs = []  # clear existing jobs
-                
 
-                
-                
-                
-        
-                # 
-                # 
-                # 
-                # 
-                # 
-                # 
-                # 
-                # *******
                 # Create the dictionary the holds the keys (header names/parameters) and values (job details) for each job
-                # Read all the data rows (starting from the second row to skip the header)
-                data = []
-                
-                for row_idx, row_data in enumerate(ws.iter_rows(min_row=2, max_col=None, values_only=True), start=2):
-                          # If the row is entirely blank, skip it
-                    if all((value is None or str(value).strip() == '') for value in row_data):
-                        continue
-                    print(f'Row index is {row_idx} and row is {row_data}')
-                    # data.append(row)
-                    
-                    # Create a dictionary to store the row data
-                    job = {}
-                    for col_idx, cell_value in enumerate(row_data):
-                        # Only process cells that match up to existing header columns
-                        if col_idx < len(header):
-                            param_name = header[col_idx]
-                            if param_name:
-                            # Store the cell_value in the dictionary
-                                job[param_name] = cell_value
-                                print(f'Job dictionary is {job}')
-                
-                
-                                                    # # Iterate over each row of data; enumerate to keep track of the row number in Excel
-                                                    # for job_index, row_data in enumerate(data):  
-
-                                                    #     # Dictionary where key is index key is Job number dictionary is the dictionary of jobs
-                                                    #     # Send job to processer and include status
-                                                    #     self.logger.info(f"\n")
-                                                    #     self.logger.info(f"-------------------------------------------------------------------------------")
-                                                    #     self.logger.info(f"-                        Load Jobs: Start of Job {job_index}                               -")
-                                                    #     self.logger.info(f"-------------------------------------------------------------------------------")
-                                                    #     self.logger.info(f"\n")
-                                                        
-                                                    #     # Initialize a dictionary to store the job's parameters
-                                                    #     job = {}
-                                                    #     self.logger.info('Load Jobs - Creating empty dictionary')
-                                                    #     batch_condition = None  # Initialize the batch_condition for the current row
-                                                            
-                                                        
-                                                    #     # Skip any completely blank rows
-                                                    #     if all((value is None or str(value).strip() == '') for value in row_data):
-                                                    #         print(f"Load Jobs - Skipping blank row at job index ({job_index}) ")
-                                                    #         self.logger.info(f"Load Jobs - Skipping blank row at index ({job_index}) ")
-                                                    #         continue  # Skip this row entirely
-
-
-                    # Loop through each column header and corresponding value in the current row
-                    for key, value in zip(header, row_data):
-                        # If the key isn't empty and equals "batch_condition", assign the value to batch_condition
-                        if key is not None and key.lower() == self.BATCH_CONDITION_COLUMN.lower():
-                            batch_condition = value if value is not None else ""
-
-                        # Assign an empty string to any None values
-                        value = "" if value is None else value
-
-                        # Assign the value to the job dictionary if the key is not None
-                        if key is not None:
-                            job[key] = value
+                # Blank rows are skipped by the reader
+                for job_index, job in reader.iter_jobs():
+                    row_idx = job_index + 2
+                    print(f'Row index is {row_idx} and job is {job}')
+
+                    # Register the job in the ledger under its job index and parameter hash
+                    job[self.JOB_INDEX_KEY] = job_index
+                    ledger_record = self.ledger.register(job_index, hash_job_parameters(job, self.parameter_names))
 
                     # Skip if marked as "COMPLETE"
-                    batch_condition = job.get(self.BATCH_CONDITION_COLUMN, "")
+                    batch_condition = str(job.get(self.BATCH_CONDITION_COLUMN, ""))
+                    input_fingerprint = None
+                    if batch_condition.upper() != 'COMPLETE':
+                        # Fingerprint the inputs before classify_input_type replaces the feature layer
+                        try:
+                            input_fingerprint = fingerprint_job(job, self.parameter_names)
+                        except OSError as e:
+                            self.logger.warning(f"Load Jobs - Unable to fingerprint the inputs for job {row_idx}: {e}")
+
+                        if ledger_record['state'] == 'COMPLETE':
+                            if input_fingerprint and ledger_record['input_fingerprint'] == input_fingerprint and outputs_exist(job):
+                                # The job already ran with these exact inputs and its outputs are still there
+                                print(f"Job {row_idx} is COMPLETE in the ledger and its inputs haven't changed, skipping.")
+                                self.logger.info(f"Load Jobs - Job {row_idx} is COMPLETE in the ledger with unchanged inputs and existing outputs, skipping.")
+                                batch_condition = 'COMPLETE'
+                                job[self.BATCH_CONDITION_COLUMN] = batch_condition
+                                self.status_writer.set_condition(job_index, batch_condition)
+                            else:
+                                print(f"Job {row_idx} inputs or outputs have changed since it was COMPLETE, running it again.")
+                                self.logger.info(f"Load Jobs - Job {row_idx} inputs or outputs have changed since it was COMPLETE, running it again.")
+
                     if batch_condition.upper() == 'COMPLETE':
                         print(f"Skipping job {row_idx} as it is marked COMPLETE.")
                         self.logger.info(f"Load Jobs - Skipping job {row_idx} as it is marked COMPLETE.")
+                        if ledger_record['state'] != 'COMPLETE':
+                            self.ledger.set_state(job_index, 'COMPLETE')
                         # continue  # Skip this job as it's already marked as COMPLETE
 
                     # Check if the batch_condition is None, empty, or not 'COMPLETE' assign it to queued
@@ -165,27 +161,22 @@ class BATCH_FACTORY:
                         
                         # Assign the updated batch_condition to the job dictionary (queued)
                         job[self.BATCH_CONDITION_COLUMN] = batch_condition
+                        if input_fingerprint:
+                            self.ledger.set_fingerprint(job_index, input_fingerprint)
                         self.logger.info(f"Load Jobs - (Queued assigned to Job ({job_index}) is ({batch_condition})")
 
                         # Immediately update the Excel sheet with the new condition
                         #LOAD JOBS ADD_JOB_RESULT FUNCTION IS CALLED HERE
                         try:
-                            self.add_job_result(row_idx, batch_condition)
+                            self.add_job_result(row_idx - 2, batch_condition)
                             self.logger.info(f"Load Jobs - Added job condition '{batch_condition}' for job {row_idx} to jobs list")
                         except Exception as e:
                             print(f"Error updating Excel sheet at row {row_idx}: {e}")
                             self.logger.error(f"Load Jobs - Error updating Excel sheet at row {row_idx}: {e}")
                             continue
 
-                        # Classify the input type for the job
-                        try:
-                            self.logger.info(f"Classifying input type for job {row_idx}")
-                            self.classify_input_type(job)
- 
-                        except Exception as e:
-                            print(f"Error classifying input type for job {job}: {e}")
-                            self.logger.error(f"Error classifying input type for job {job}: {e}")
-                            
+                        # The input type is classified (and the AOI prepared) by batch_ast, alongside the first tool runs
+
                     # Add the job to the jobs list after all checks and processing
                     self.jobs.append(job)
                     print(f"Load Jobs - Job Condition for job ({row_idx}) is not Complete: Writing ({batch_condition}) to ast_contion. Adding job: {row_idx} to jobs list")
@@ -207,11 +198,14 @@ class BATCH_FACTORY:
                 print(f"Unexpected error loading jobs: {e}")
                 self.logger.error(f"Unexpected error loading jobs: {e}")
 
+            # Write all the Queued conditions in one save
+            self.status_writer.flush()
+
             return self.jobs
 
 
-    def classify_input_type(self, job):
-        '''Classify the input type and process accordingly.'''
+    def classify_input_type(self, job_index, job):
+        '''Classify the input type and process accordingly. Returns False if the job was marked Failed and must not run.'''
 
         if job.get('feature_layer'):
             print(f'Feature layer found: {job["feature_layer"]}')
@@ -223,119 +217,121 @@ class BATCH_FACTORY:
             if feature_layer_path.lower().endswith('.kml'):
                 print('KML found, building AOI from KML')
                 self.logger.info('Classifying Input Type - KML found, building AOI from KML')
-                job['feature_layer'] = build_aoi_from_kml(job, feature_layer_path)
+                job['feature_layer'] = build_aoi_from_kml(feature_layer_path, self.logger)
 
             elif feature_layer_path.lower().endswith('.shp'):
                 if job.get('file_number'):
                     print(f"File number found, running FW setup on shapefile: {feature_layer_path}")
                     self.logger.info(f"Classifying Input Type - File number found, running FW setup on shapefile: {feature_layer_path}")
-                    new_feature_layer_path = build_aoi_from_shp(job, feature_layer_path)
+                    # arcpy isn't thread safe, FW Setup runs one job at a time when the AOIs are prepared on threads
+                    with FW_SETUP_LOCK:
+                        new_feature_layer_path = build_aoi_from_shp(job, feature_layer_path, os.getenv('TEMPLATE'), self.logger)
                     job['feature_layer'] = new_feature_layer_path
                 else:
                     print('No FW File Number provided for the shapefile, using original shapefile path')
                     self.logger.info('Classifying Input Type - No FW File Number provided, using original shapefile path')
+            elif '.gdb' in feature_layer_path.lower():
+                # Already a geodatabase feature class, e.g. a KML converted by start_kml_conversion
+                print(f"Geodatabase feature layer found, using it as is: {feature_layer_path}")
+                self.logger.info(f"Classifying Input Type - Geodatabase feature layer found, using it as is: {feature_layer_path}")
             else:
                 print(f"Unsupported feature layer format: {feature_layer_path}")
-                self.logger.warning(f"Classifying Input Type - Unsupported feature layer format: {feature_layer_path} - Marking job as Failed")
-                self.add_job_result(job, 'Failed')
+                self.logger.warning(f"Classifying Input Type - Unsupported feature layer format: {feature_layer_path} - Marking job {job_index} as Failed")
+                job[self.BATCH_CONDITION_COLUMN] = 'Failed'
+                self.add_job_result(job_index, 'Failed', f"Unsupported feature layer format: {feature_layer_path}")
+                return False
         else:
             print('No feature layer provided in job')
             self.logger.warning('Classifying Input Type - No feature layer provided in job')
+        return True
+
+    def prepare_job_aoi(self, job_index, job):
+        '''
+        Classifies the job's input type and prepares its AOI. Errors are logged and the job keeps its original feature layer.
+        Returns the job, or None if it was marked Failed (an unsupported feature layer) and must not be queued.
+        '''
+        self.apply_kml_conversion(job_index, job)
+        try:
+            self.logger.info(f"Classifying input type for job {job_index}")
+            if not self.classify_input_type(job_index, job):
+                return None
+        except Exception as e:
+            print(f"Error classifying input type for job {job_index}: {e}")
+            self.logger.error(f"Error classifying input type for job {job_index}: {e}")
+
+        # The tool reads the prepared inputs from local copies instead of across the network
+        if self.input_staging is not None:
+            self.input_staging.stage_job(job_index, job, self.parameter_names)
+        return job
+
+    def start_network_staging(self, queued_jobs):
+        ''' Starts copying the queued jobs' network inputs to local disk when STAGE_INPUTS is True '''
+        if str(os.getenv('STAGE_INPUTS', 'True')).strip().lower() != 'true':
+            return
+        self.input_staging = INPUT_STAGING(logger=self.logger)
+        self.input_staging.prefetch(queued_jobs, self.parameter_names)
+        print(f"Batch Ast: Staging network inputs in {self.input_staging.stage_dir}")
+        self.logger.info(f"Batch Ast: Staging network inputs in {self.input_staging.stage_dir}")
+
+    def stop_network_staging(self):
+        if self.input_staging is not None:
+            self.input_staging.shutdown()
+            self.input_staging = None
+
+    def start_kml_conversion(self, queued_jobs):
+        '''
+        Starts converting the KML feature layers of the queued jobs together into one shared geodatabase when there are at
+        least KML_BATCH_MIN of them (0 turns this off). The conversion runs on its own thread so the jobs that don't use a
+        KML start straight away, apply_kml_conversion waits for it when a KML job's AOI is prepared.
+        '''
+        batch_min = get_env_number('KML_BATCH_MIN', 10)
+        kmls = [job['feature_layer'] for _, job in queued_jobs if str(job.get('feature_layer') or '').lower().endswith('.kml')]
+        if batch_min <= 0 or len(kmls) < batch_min:
+            return
+
+        print(f"Batch Ast: Converting {len(kmls)} KML AOIs together")
+        self.logger.info(f"Batch Ast: Converting {len(kmls)} KML AOIs together")
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kml_conversion')
+        self.kml_conversion = executor.submit(self.convert_kmls, kmls)
+        executor.shutdown(wait=False)
+
+    def convert_kmls(self, kmls):
+        ''' Runs the batch KML conversion, returns {kml path: gdb/layer} or {} if it failed '''
+        try:
+            return build_aois_from_kmls(kmls, self.logger)
+        except Exception as e:
+            print(f"Batch KML conversion failed, converting the KMLs one at a time: {e}")
+            self.logger.error(f"Batch Ast: Batch KML conversion failed, converting the KMLs one at a time: {e}")
+            return {}
+
+    def apply_kml_conversion(self, job_index, job):
+        '''
+        Points a KML job's feature_layer at its layer in the batch geodatabase, waiting for the conversion if it's still
+        running. KMLs the batch conversion couldn't handle are left for classify_input_type to convert one at a time.
+        '''
+        feature_layer = job.get('feature_layer')
+        if self.kml_conversion is None or not str(feature_layer or '').lower().endswith('.kml'):
+            return
+        converted = self.kml_conversion.result()
+        if feature_layer in converted:
+            job['feature_layer'] = converted[feature_layer]
+            self.logger.info(f"Batch Ast: Job {job_index} feature layer is {job['feature_layer']}")
 
 #ADD JOB RESULT                        
-    def add_job_result(self, job_index, condition):
+    def add_job_result(self, job_index, condition, error=None):
         ''' 
         Function adds result information to the Excel spreadsheet. If the job is successful, it will update the batch_condition column to "COMPLETE",
         if the job failed, it will update the batch_condition column to "Failed".
+        The condition is recorded in the job ledger first, then held by the status writer and written to the queuefile with the
+        other pending changes on the next flush.
         '''
-
-        print("Running Add Job Results...")
-        self.logger.info("\n")
-        self.logger.info("##########################################################################################################################")
-        self.logger.info("#")
-        self.logger.info("Running Add Job Results from Load Jobs Function")
-        self.logger.info("#")
-        self.logger.info("##########################################################################################################################")
-        self.logger.info("\n")
-     
-
         try:
-            # Load the workbook
-            wb = load_workbook(filename=self.queuefile)
-            self.logger.info(f"Add Job Result - Workbook loaded")
-            
-            # Load the correct worksheet
-            ws = wb[self.XLSX_SHEET_NAME]
-
-            # Read the header index for the batch_condition column
-            header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True))
-            
-            # Check if 'AST CONDITION COLUMN' exists in the header. If it is not found, raise a ValueError
-            # if ast condition column IS found, log a message
-            if self.BATCH_CONDITION_COLUMN not in header:
-                raise ValueError(f"'{self.BATCH_CONDITION_COLUMN}' column not found in the spreadsheet.")
-            
-            if self.BATCH_CONDITION_COLUMN in header:
-                self.logger.info(f"Add Job Result - '{self.BATCH_CONDITION_COLUMN}' column found in the spreadsheet.")
-                
-            # # Check if 'DONT OVERWRITE OUTPUTS' exists in the header
-            # if self.DONT_OVERWRITE_OUTPUTS not in header:
-            #     raise ValueError(f"'{self.DONT_OVERWRITE_OUTPUTS}' column not found in the spreadsheet.")
-            
-            # if self.DONT_OVERWRITE_OUTPUTS in header:
-            #     self.logger.info(f"Add Job Result - '{self.DONT_OVERWRITE_OUTPUTS}' column found in the spreadsheet.")
-            
-            # Find the ast condition column and assign it to the correct index
-            ast_condition_index = header.index(self.BATCH_CONDITION_COLUMN) + 1  # +1 because Excel columns are 1-indexed
-
-            # # Find the dont_overwrite_outputs column and assign it to the correct index
-            dont_overwrite_outputs_index = header.index(self.DONT_OVERWRITE_OUTPUTS) + 1  # +1 because Excel columns are 1-indexed
-            
-            # Calculate the actual row index in Excel, +2 to account for header and 0-index
-            excel_row_index = job_index + 2  # NOTE I changed this to +1 and it changes the batch_condition header row to Failed. So it must stay at +2
-            self.logger.info(f"Add Job Result - Calculated Excel row index as {excel_row_index} for job index {job_index}")
-            
-            # Check if the row is blank before updating,  If all cell values in row_values are either None or empty strings, then all() will return True, indicating that the row is blank.
-            row_values = []
-            for col in range(1, len(header) + 1):
-                cell_value = ws.cell(row=excel_row_index, column=col).value
-                row_values.append(cell_value)
-            if all(value is None or str(value).strip() == '' for value in row_values):
-                print(f"Row {excel_row_index} is blank, not updating.")
-                self.logger.info(f"Add_Job_Result -Job {job_index} / Row {excel_row_index} ")
-                return  # Do not update if the row is blank
-
-            # Update the ast condition for the specific job to the new condition (failed, queued, complete)
-            ws.cell(row=excel_row_index, column=ast_condition_index, value=condition)
-
-            # if the condition in BATCH_CONDITION_COLUMN is 'Requeued" then go to the dont overwrite output column and change false to true
-            if condition == 'Requeued':
-                # print(f"Add Job Result - Job {job_index} failed, updating condition to 'Requeued'.  **CHANGED JOB INDEX +1 to JOB INDEX ***") #NOTE CHANGED JOB INDEX + 1 to JOB INDEX
-                self.logger.info(f"Add Job Result - Job {job_index} (Row {excel_row_index})  updating condition to 'Requeued'.") 
-                ws.cell(row=excel_row_index, column=dont_overwrite_outputs_index, value="True")
-                self.logger.info(f"Add Job Result - Job {job_index} (Row {excel_row_index})  updating dont_overwrite_outputs to 'True'.")
-            
-            # Save the workbook with the updated condition
+            self.ledger.set_state(job_index, condition, error)
+            self.status_writer.set_condition(job_index, condition)
+            if self.shared_queue is not None:
+                self.shared_queue.record_result(job_index, condition, error)
             self.logger.info(f"Add Job Result - Updated Job {job_index} with condition '{condition}'.")
-            wb.save(self.queuefile)
-            self.logger.info(f"Add Job Result - Saving Workbook with updated condition")
-            print(f"Updated row {excel_row_index} with condition '{condition}'.")
-
-        except FileNotFoundError as e:
-            print(f"Error: Queue file not found - {e}")
-            self.logger.error(f"Error: Queue file not found - {e}")
-
-        except ValueError as e:
-            print(f"Error: {e}")
-            self.logger.error(f"Error: {e}")
-
-        except IndexError as e:
-            print(f"Error: Index out of range when accessing row {excel_row_index} - {e}")
-            self.logger.error(f"Error: Index out of range when accessing row {excel_row_index} - {e}")
-
-        except PermissionError as e:
-            print(f"Error: Permission denied when trying to access the Excel file - {e}")
-            self.logger.error(f"Error: Permission denied when trying to access the Excel file - {e}")
+            print(f"Updated job {job_index} with condition '{condition}'.")
 
         except Exception as e:
             print(f"Unexpected error while adding job result: {e}")
@@ -344,7 +340,7 @@ class BATCH_FACTORY:
 #BATCH AST
     def batch_ast(self):
         '''
-        Uses multiprocessing to run the NUMBER_OF_JOBS in parallel.
+        Uses multiprocessing to run the queued jobs in parallel on a bounded pool of MAX_WORKERS workers.
         '''
         self.logger.info(f"\n")
         self.logger.info("##########################################################################################################################")
@@ -354,95 +350,341 @@ class BATCH_FACTORY:
         self.logger.info("##########################################################################################################################")
         self.logger.info(f"\n")
         
-        import time
-        
         # Set job timeout to 6 hours
-        JOB_TIMEOUT = 21600  # 6 hours in seconds
+        JOB_TIMEOUT = self.JOB_TIMEOUT
         self.logger.info(f"Batch Ast: Job Timeout set to {JOB_TIMEOUT} seconds")
         print(f"Batch Ast: Job Timeout set to {JOB_TIMEOUT} seconds")
 
-        processes = []
-        manager = mp.Manager()
-        return_dict = manager.dict()
-
+        # Only queued or requeued jobs are sent to the scheduler
+        queued_jobs = []
         for job_index, job in enumerate(self.jobs):
-            self.logger.info(f"Batch Ast: Starting job {job_index}")
-            print(f"Batch Ast: Starting job {job_index} Job ({job})")
-
-            # if ast condition is queued or requeued, run the job
-            if job.get(self.BATCH_CONDITION_COLUMN) in ['Queued', 'Requeued']: #NOTE Add QUEUED AFTER TESTING***
-                
-                # Start each job in a separate process
-                p = mp.Process(target=process_job_mp, args=(self, job, job_index, self.current_path, return_dict))
-                
-                # Append the process object to the processes list and job_index. This list keeps track of all the processes and their corresponding job indices.
-                processes.append((p, job_index))
-                
-                # Start method is called on the process object p. This begins the execution of the job in a separate process.
-                p.start()
-                self.logger.info(f"Batch Ast: {job.get(self.BATCH_CONDITION_COLUMN)} Job {job_index}.....Multiproccessing started......")
-                print(f"Batch Ast: Queued Job...Multiproccessing started......")
-                
-
-        # Monitor and enforce timeouts
-        timeout_failed_counter = 0
-        success_counter = 0
-        worker_failed_counter = 0
-        other_exception_failed_counter = 0
-        for process, job_index in processes:
-            
-            # Join the process to timeout which waits for the process to complete within the timeout
-            process.join(JOB_TIMEOUT)
-            
-            # If the process exceeds the timeout, terminate the process and mark the job as failed
-            if process.is_alive():
-                
-                print(f"Batch Ast: Job {job_index} exceeded timeout. Terminating process.")
-                self.logger.warning(f"Batch Ast: Job {job_index} exceeded timeout. Terminating process.")
-                
-                # End the hung up job
-                process.terminate()
-                
-                # Call the join method again to ensure the process is terminated
-                process.join()
-                
-                # Call add job result and update the job as failed
-                self.add_job_result(job_index, 'Failed') 
-                
-                # Increase the job timeout counter
-                timeout_failed_counter+= 1
-                self.logger.error(f"Batch Ast: Job {job_index} exceeded timeout. Marking as Failed. Failed counter is {timeout_failed_counter}")
-                
+            if job.get(self.BATCH_CONDITION_COLUMN) in ['Queued', 'Requeued']:
+                # The run report records the queuefile's feature layer, the next batch looks up its duration by it
+                job.setdefault(SOURCE_FEATURE_LAYER_KEY, job.get('feature_layer'))
+                queued_jobs.append((job.get(self.JOB_INDEX_KEY, job_index), job))
+
+        # Start the highest priority and then the longest jobs first so a big AOI doesn't start last and hold up the batch
+        # JOB_ORDERING 'row' keeps the queuefile order. The AOIs are only sized by their files here, reading every AOI's
+        # geometry would hold up the first job
+        if str(os.getenv('JOB_ORDERING', 'cost')).lower() == 'cost':
+            costs = estimate_job_costs(queued_jobs, self.run_report.report_folder, self.logger, measure=measure_aoi_files)
+            queued_jobs = order_jobs(queued_jobs, costs, self.PRIORITY_COLUMN)
+            self.logger.info(f"Batch Ast: Jobs ordered by priority and estimated cost: {[job_index for job_index, _ in queued_jobs]}")
+            print(f"Batch Ast: Jobs ordered by priority and estimated cost")
+
+        # Run the jobs on a fixed number of workers rather than one process per row
+        # WORKER_MODE 'warm' imports the toolbox once per worker instead of once per job
+        max_workers = get_max_workers(self.logger)
+        worker_mode = get_worker_mode()
+        self.logger.info(f"Batch Ast: Running {len(queued_jobs)} jobs on {max_workers} {worker_mode} workers")
+        print(f"Batch Ast: Running {len(queued_jobs)} jobs on {max_workers} {worker_mode} workers")
+
+        # AOIs are prepared (KML conversion, FW Setup) on AOI_PREP_WORKERS threads and each job goes to the scheduler as soon
+        # as its AOI is ready, so the first tool runs don't wait for every AOI. 0 prepares them all first, one at a time
+        prep_workers = get_env_number('AOI_PREP_WORKERS', 4)
+        preparation = None
+
+        # main.py --control pause|resume|drain|cancel talks to the running batch through this file
+        control = BATCH_CONTROL(get_control_file(self.queuefile), logger=self.logger)
+
+        # Counts, running jobs, jobs per hour and ETA on http://127.0.0.1:PROGRESS_PORT/ and in the log
+        progress = BATCH_PROGRESS(len(queued_jobs), JOB_TIMEOUT, logger=self.logger)
+
+        # Folders full of small KMLs are converted in one pass into one geodatabase instead of one geodatabase per KML,
+        # alongside the first jobs
+        self.start_kml_conversion(queued_jobs)
+
+        # Jobs that write to the same output folder run one at a time, reported here before the AOI preparation takes the queue
+        output_planner = OUTPUT_PLANNER(self.logger)
+        output_planner.plan(queued_jobs)
+
+        def prepare(job_index, job):
+            # A job that fails its preparation is finished, the progress page counts it with the others
+            prepared = self.prepare_job_aoi(job_index, job)
+            if prepared is None:
+                progress.job_condition(job_index, 'Failed')
+            return prepared
+
+        # Network inputs are copied to local disk (STAGE_INPUTS) and staged outputs are uploaded while the workers carry on
+        self.start_network_staging(queued_jobs)
+        uploader = OUTPUT_UPLOADER(logger=self.logger) if stage_outputs_locally() and upload_outputs_async() else None
+
+        # Job results are written to the queuefile on a timer and once more when the batch is done
+        self.status_writer.start_timer(self.STATUS_FLUSH_INTERVAL)
+        try:
+            if prep_workers > 0:
+                preparation = AOI_PREPARATION(queued_jobs, prepare, prep_workers, self.logger)
+                scheduler = JOB_SCHEDULER(self, max_workers, JOB_TIMEOUT, self.logger, worker_mode, job_source=preparation,
+                                          connection_broker=get_connection_broker(), control=control, progress=progress,
+                                          output_planner=output_planner, uploader=uploader)
+                scheduler.run([])
             else:
-                # Get the result of the job from return_dict. 
-                # If the result is 'Success', increment the success_counter and call the add_job_result method to mark the job as 'COMPLETE'
-                
-                result = return_dict.get(job_index)
-                if result == 'Success':
-                    success_counter += 1
-                    self.add_job_result(job_index, 'COMPLETE')
-                    print(f"Batch Ast: Job {job_index} completed successfully.")
-                    self.logger.info(f"Batch Ast: Job {job_index} completed successfully. Success counter is {success_counter}")
-                
-                elif result == 'Failed':
-                    
-                    # If the result is 'Failed', increment the other_failed_counter and mark the job as 'Failed' (Other failed counter means it failed due to something other than a timeout)
-                    # Job failed due to an exception in the worker
-                    self.add_job_result(job_index, 'Failed')
-                    worker_failed_counter += 1
-                    print(f"Batch Ast: Job {job_index} failed due to an exception.")
-                    self.logger.error(f"Batch AST: Job {job_index} failed due to an exception in the Worker. Other exception failed counter is {worker_failed_counter}")
-                
-                else:
-                    # Handle unexpected cases
-                    self.add_job_result(job_index, 'Unknown Error')
-                    other_exception_failed_counter += 1
-                    print(f"Batch Ast: Job {job_index} failed with unknown status.")
-                    self.logger.error(f"Batch AST: Job {job_index} failed with unknown status. Other Exception failed counter is {other_exception_failed_counter}")
-         
+                queued_jobs = [(job_index, job) for job_index, job in queued_jobs if prepare(job_index, job) is not None]
+                scheduler = JOB_SCHEDULER(self, max_workers, JOB_TIMEOUT, self.logger, worker_mode, connection_broker=get_connection_broker(),
+                                          control=control, progress=progress, output_planner=output_planner, uploader=uploader)
+                scheduler.run(queued_jobs)
+        finally:
+            if preparation is not None:
+                preparation.shutdown()
+            self.kml_conversion = None
+            if uploader is not None:
+                uploader.shutdown()
+            self.stop_network_staging()
+            self.export_ledger_to_queuefile()
+            self.status_writer.stop_timer()
+            self.run_report.write()
+
         self.logger.info('\n')    
         self.logger.info("Batch Ast Complete - Check separate worker log file for more details")
-    
+
+        # The scheduler's counters and startup/job timings are used by the benchmark
+        return scheduler
+
+    def export_ledger_to_queuefile(self):
+        ''' Copies the ledger state of every loaded job into the queuefile's batch_condition column (written on the next status writer flush) '''
+        for job_index, state in self.ledger.loaded_states().items():
+            # Running jobs are still Queued as far as the queuefile is concerned
+            if state != 'Running':
+                self.status_writer.set_condition(job_index, state)
+        self.logger.info("Batch Ast - Ledger states exported to the queuefile")
+
+#DRY RUN
+    def dry_run(self, workers=None):
+        '''
+        Checks the queuefile without running anything: the jobs that would run, their parameters against the tool's
+        signature, whether each feature_layer and output_directory can be reached, the estimated cost of each job and the
+        projected makespan on `workers` workers (MAX_WORKERS by default). Only the toolbox is imported, to read the tool's
+        parameters. Nothing is written to the queuefile. Returns a report dictionary.
+        '''
+        self.logger.info("##########################################################################################################################")
+        self.logger.info("#")
+        self.logger.info("Dry Run: Checking the queuefile...")
+        self.logger.info("#")
+        self.logger.info("##########################################################################################################################")
+
+        workers = workers or get_max_workers(self.logger)
+        reader = QUEUE_READER(self.queuefile, self.XLSX_SHEET_NAME, self.logger)
+        self.parameter_names = self.get_parameter_names(reader.read_header())
+
+        # Same skip rule as load_jobs, without registering anything in the ledger
+        jobs = []
+        skipped = 0
+        for job_index, job in reader.iter_jobs():
+            job[self.JOB_INDEX_KEY] = job_index
+            if str(job.get(self.BATCH_CONDITION_COLUMN, "")).upper() == 'COMPLETE':
+                skipped += 1
+                continue
+            ledger_record = self.ledger.lookup(job_index, hash_job_parameters(job, self.parameter_names))
+            if ledger_record and ledger_record['state'] == 'COMPLETE' and outputs_exist(job):
+                try:
+                    if ledger_record['input_fingerprint'] == fingerprint_job(job, self.parameter_names):
+                        skipped += 1
+                        continue
+                except OSError:
+                    pass
+            jobs.append((job_index, job))
+
+        # The tool's parameters come from the toolbox, the tool itself isn't run
+        tool_name = os.getenv('TOOL')
+        tool_parameters = None
+        try:
+            backend = get_backend()
+            backend.import_toolbox(os.getenv('TOOLBOX'))
+            tool_parameters = backend.get_tool_parameters(tool_name)
+        except Exception as e:
+            print(f"Dry Run: Unable to read the parameters of {tool_name}: {e}")
+            self.logger.warning(f"Dry Run: Unable to read the parameters of {tool_name}: {e}")
+        if tool_parameters is None:
+            print("Dry Run: The tool's parameters aren't available, only the paths are checked")
+            self.logger.warning("Dry Run: The tool's parameters aren't available, only the paths are checked")
+
+        problems = {'queuefile': check_tool_signature(self.parameter_names, tool_parameters)}
+        for job_index, job in jobs:
+            job_problems = check_job_parameters(job, self.parameter_names, tool_parameters)
+            job_problems += [problem for problem in [check_feature_layer(job.get('feature_layer')),
+                                                     check_output_directory(job.get('output_directory'))] if problem]
+            if job_problems:
+                problems[job_index] = job_problems
+
+        # Estimated cost per job from the AOI size and earlier run reports, in the order batch_ast would dispatch them
+        costs = estimate_job_costs(jobs, self.run_report.report_folder, self.logger)
+        if str(os.getenv('JOB_ORDERING', 'cost')).lower() == 'cost':
+            jobs = order_jobs(jobs, costs, self.PRIORITY_COLUMN)
+        makespan = simulate_makespan([costs[job_index] for job_index, _ in jobs], workers)
+        longest = max(costs.values()) if costs else 0
+
+        for key, key_problems in problems.items():
+            for severity, message in key_problems:
+                where = 'Queuefile' if key == 'queuefile' else f"Job {key} (row {key + 2})"
+                print(f"Dry Run: {severity.upper()} {where}: {message}")
+                if severity == 'error':
+                    self.logger.error(f"Dry Run: {where}: {message}")
+                else:
+                    self.logger.warning(f"Dry Run: {where}: {message}")
+
+        errors = sum(1 for key_problems in problems.values() for severity, _ in key_problems if severity == 'error')
+        warnings = sum(1 for key_problems in problems.values() for severity, _ in key_problems if severity == 'warning')
+        report = {
+            'jobs': len(jobs),
+            'skipped': skipped,
+            'errors': errors,
+            'warnings': warnings,
+            'problems': problems,
+            'costs': costs,
+            'workers': workers,
+            'makespan_seconds': makespan,
+        }
+
+        summary = (f"Dry Run: {len(jobs)} jobs would run ({skipped} already COMPLETE), {errors} errors, {warnings} warnings. "
+                   f"Estimated {format_duration(sum(costs.values()))} of tool time, longest job {format_duration(longest)}, "
+                   f"projected makespan {format_duration(makespan)} on {workers} workers")
+        print(summary)
+        self.logger.info(summary)
+        if longest > self.JOB_TIMEOUT:
+            print(f"Dry Run: WARNING the longest job is estimated to run past the {format_duration(self.JOB_TIMEOUT)} job timeout")
+            self.logger.warning(f"Dry Run: The longest job is estimated to run past the {format_duration(self.JOB_TIMEOUT)} job timeout")
+
+        return report
+
+#SHARED QUEUE
+    def publish_to_shared_queue(self, shared_queue):
+        '''
+        Coordinator: publishes every job in the queuefile that isn't COMPLETE to the shared queue, highest priority first.
+        Jobs are published as they are in the queuefile, each node classifies the input of the jobs it claims.
+        '''
+        reader = QUEUE_READER(self.queuefile, self.XLSX_SHEET_NAME, self.logger)
+        self.parameter_names = self.get_parameter_names(reader.read_header())
+
+        jobs = []
+        for job_index, job in reader.iter_jobs():
+            ledger_record = self.ledger.register(job_index, hash_job_parameters(job, self.parameter_names))
+            batch_condition = str(job.get(self.BATCH_CONDITION_COLUMN, ""))
+
+            # Same skip rule as load_jobs: COMPLETE in the queuefile, or COMPLETE in the ledger with unchanged inputs and existing outputs
+            if batch_condition.upper() == 'COMPLETE':
+                continue
+            try:
+                input_fingerprint = fingerprint_job(job, self.parameter_names)
+            except OSError:
+                input_fingerprint = None
+            if ledger_record['state'] == 'COMPLETE' and input_fingerprint and ledger_record['input_fingerprint'] == input_fingerprint and outputs_exist(job):
+                self.add_job_result(job_index, 'COMPLETE')
+                continue
+
+            if input_fingerprint:
+                self.ledger.set_fingerprint(job_index, input_fingerprint)
+            job[self.BATCH_CONDITION_COLUMN] = 'Queued'
+            self.add_job_result(job_index, 'Queued')
+            jobs.append((job_index, job))
+
+        jobs = order_jobs(jobs, {}, self.PRIORITY_COLUMN)
+        shared_queue.publish(self.queuefile, self.parameter_names,
+                             [(job_index, self.ledger.current_hashes[job_index], job) for job_index, job in jobs], self.XLSX_SHEET_NAME)
+        self.status_writer.flush()
+        return len(jobs)
+
+    def merge_shared_results(self, shared_queue, merged=None):
+        '''
+        Coordinator: copies the nodes' results into the ledger and the queuefile. merged holds the conditions already
+        copied ({job_index: condition}) so only changes are written. Returns the number of published jobs that are finished.
+        '''
+        merged = {} if merged is None else merged
+        for job_index, result in shared_queue.read_results().items():
+            # Results for an older version of an edited row are ignored
+            if self.ledger.current_hashes.get(job_index) != result['params_hash'] or merged.get(job_index) == result['condition']:
+                continue
+            self.add_job_result(job_index, result['condition'], result.get('error'))
+            merged[job_index] = result['condition']
+        self.status_writer.flush()
+        return sum(1 for condition in merged.values() if condition in FINAL_CONDITIONS)
+
+    def run_shard_coordinator(self, shared_queue):
+        ''' Coordinator: publishes the queuefile's jobs and merges the nodes' results into it until every job is finished '''
+        self.logger.info("##########################################################################################################################")
+        self.logger.info("#")
+        self.logger.info(f"Shard Coordinator: Publishing jobs to {shared_queue.shared_dir}...")
+        self.logger.info("#")
+        self.logger.info("##########################################################################################################################")
+
+        # A drain or cancel sent to the last sharded batch doesn't stop this one
+        control = BATCH_CONTROL(shared_queue.control_file, poll_seconds=0, logger=self.logger)
+        control.clear()
+
+        published = self.publish_to_shared_queue(shared_queue)
+        merged = {}
+        try:
+            while True:
+                finished = self.merge_shared_results(shared_queue, merged)
+                status = shared_queue.status()
+                print(f"Shard Coordinator: {finished}/{published} jobs finished - {status['jobs']} - {len(status['nodes'])} nodes")
+                self.logger.info(f"Shard Coordinator: {finished}/{published} jobs finished - {status['jobs']} - nodes {status['nodes']}")
+                if finished >= published:
+                    break
+
+                # The nodes stop on a drain or cancel, stop merging once none of them holds a job
+                if control.read() in ['drain', 'cancel'] and status['jobs']['running'] == 0:
+                    print(f"Shard Coordinator: Batch stopped by {control.command}, {published - finished} jobs are left for the next run")
+                    self.logger.warning(f"Shard Coordinator: Batch stopped by {control.command}, {published - finished} jobs are left for the next run")
+                    control.clear()
+                    break
+                time.sleep(shared_queue.poll_seconds)
+        finally:
+            self.export_ledger_to_queuefile()
+            self.status_writer.flush()
+
+    def prepare_claimed_job(self, job_index, job):
+        ''' Node: registers a job claimed from the shared queue in this node's ledger and classifies its input. Returns None if it was marked Failed '''
+        job[self.JOB_INDEX_KEY] = job_index
+        job.setdefault(SOURCE_FEATURE_LAYER_KEY, job.get('feature_layer'))
+        self.ledger.register(job_index, hash_job_parameters(job, self.parameter_names))
+        job[self.BATCH_CONDITION_COLUMN] = 'Queued'
+        self.add_job_result(job_index, 'Queued')
+        return self.prepare_job_aoi(job_index, job)
+
+    def run_shard_node(self, shared_queue):
+        '''
+        Node: claims jobs from the shared queue one at a time and runs them on this machine's workers until every published
+        job is finished. The queuefile of this instance is the node's local copy of the published queuefile.
+        '''
+        self.logger.info("##########################################################################################################################")
+        self.logger.info("#")
+        self.logger.info(f"Shard Node {shared_queue.node_id}: Claiming jobs from {shared_queue.shared_dir}...")
+        self.logger.info("#")
+        self.logger.info("##########################################################################################################################")
+
+        manifest = shared_queue.read_manifest()
+        self.parameter_names = manifest['parameter_names']
+        self.shared_queue = shared_queue
+
+        max_workers = get_max_workers(self.logger)
+        worker_mode = get_worker_mode()
+        print(f"Shard Node {shared_queue.node_id}: Running jobs on {max_workers} {worker_mode} workers")
+        self.logger.info(f"Shard Node {shared_queue.node_id}: Running jobs on {max_workers} {worker_mode} workers")
+
+        self.start_network_staging([])
+        uploader = OUTPUT_UPLOADER(logger=self.logger) if stage_outputs_locally() and upload_outputs_async() else None
+
+        shared_queue.start_heartbeat()
+        self.status_writer.start_timer(self.STATUS_FLUSH_INTERVAL)
+        try:
+            scheduler = JOB_SCHEDULER(self, max_workers, self.JOB_TIMEOUT, self.logger, worker_mode,
+                                      job_source=SHARED_JOB_SOURCE(shared_queue, self.prepare_claimed_job),
+                                      connection_broker=get_connection_broker(),
+                                      control=BATCH_CONTROL(shared_queue.control_file, logger=self.logger, owner=False),
+                                      progress=BATCH_PROGRESS(None, self.JOB_TIMEOUT, logger=self.logger),
+                                      output_planner=OUTPUT_PLANNER(self.logger), uploader=uploader)
+            scheduler.run([])
+        finally:
+            if uploader is not None:
+                uploader.shutdown()
+            self.stop_network_staging()
+            shared_queue.stop_heartbeat()
+            self.shared_queue = None
+            self.status_writer.stop_timer()
+            self.run_report.write()
+
+        return scheduler
+
 
 
 # NOTE ** Reload failed jobs may be able to be incorporated into load failed jobs to tighten up the script
@@ -469,62 +711,34 @@ class BATCH_FACTORY:
         if os.path.exists(self.queuefile):
 
             try:
-                # Open the Excel workbook and select the correct sheet
-                wb = load_workbook(filename=self.queuefile)
-                ws = wb[self.XLSX_SHEET_NAME]
-                
-                
-                print(f'Workbook loaded is {wb}')   
-                self.logger.info(f'Re load Failed Jobs: Workbook loaded is {wb}') 
-                
+                # Stream the rows out of the queuefile in read-only mode, one job at a time
+                reader = QUEUE_READER(self.queuefile, self.XLSX_SHEET_NAME, self.logger)
+                print(f'Queuefile opened is {self.queuefile}')
+                self.logger.info(f'Re load Failed Jobs: Queuefile opened is {self.queuefile}')
+
                 # Get the header (column names) from the first row of the sheet
-                header = list([row for row in ws.iter_rows(min_row=1, max_col=None, values_only=True)][0])
+                header = reader.read_header()
 
-                # Read all the data rows (starting from the second row to skip the header)
-                data = []
-                self.logger.info(f'Re load Failed Jobs: Reading all data rows and building data list')
-                for row in ws.iter_rows(min_row=2, max_col=None, values_only=True):
-                    print(f'Row is {row}')
-                    
-                    data.append(row)
+                # Parameter names are needed to find each job's ledger record
+                parameter_names = self.parameter_names or self.get_parameter_names(header)
 
-                # Iterate over each row of data; enumerate to keep track of the row number in Excel
+                # Iterate over each job; the job index is the row number in Excel - 2 and blank rows are skipped by the reader
                 self.logger.info(f'Re load Failed Jobs: Iterating over each row of data')
-                for job_index, row_data in enumerate(data):  # Start from 2 to account for Excel header
+                for job_index, job in reader.iter_jobs():
                     
                     self.logger.info(f"\n")
                     self.logger.info(f"------------------------------------------------------------------------------------")
                     self.logger.info(f"-                        Re Load Failed Jobs: Start of Job {job_index}                               -")
                     self.logger.info(f"------------------------------------------------------------------------------------")
                     self.logger.info(f"\n")
-                    
-                                    
-                    # Initialize a dictionary to store the job's parameters
-                    job = {}
-                    self.logger.info('Re load Jobs - Creating empty dictionary')
-                    batch_condition = ''  # Initialize the batch_condition for the current row
-                        
-                    # Skip any completely blank rows
-                    if all((value is None or str(value).strip() == '') for value in row_data):
-                        print(f"Re Load Failed Jobs: Skipping blank row at index {job_index}")
-                        self.logger.info(f"Re Load Failed Jobs: Skipping blank row at index {job_index}")
-                        continue  # Skip this row entirely
-
 
-                    # Loop through each column header and corresponding value in the current row
-                    for key, value in zip(header, row_data):
-                        # Check if the key corresponds to the batch_condition column
-                        if key is not None and key.lower() == self.BATCH_CONDITION_COLUMN.lower():
-                            batch_condition = value if value is not None else ""
+                    batch_condition = str(job.get(self.BATCH_CONDITION_COLUMN, ""))
 
-                        # Assign an empty string to any None values
-                        value = "" if value is None else value
-
-                        # Assign the value to the job dictionary if the key is not None
-                        if key is not None:
-                            # logger.info(f"Re Load Failed Jobs: Assigning values to job dictionary")
-                            print(f"Re Load Failed Jobs: Assigning values to job dictionary")
-                            job[key] = value
+                    # The ledger has the latest state if the queuefile wasn't saved after the last batch
+                    ledger_record = self.ledger.register(job_index, hash_job_parameters(job, parameter_names))
+                    job[self.JOB_INDEX_KEY] = job_index
+                    if ledger_record['state'] in ['COMPLETE', 'Failed']:
+                        batch_condition = ledger_record['state']
 
                     # Skip if marked as "COMPLETE"
                     if batch_condition.upper() == 'COMPLETE':
@@ -554,10 +768,6 @@ class BATCH_FACTORY:
                     try:
                         self.add_job_result(job_index, batch_condition)
                         self.logger.info(f"Re load Jobs - Added job condition '{batch_condition}' for job {job_index} to jobs list")
-                    # Added Dec 12th
-                        # Save the workbook with the updated condition
-                        self.logger.info(f"Reload Failed Jobs - Saving Job Index ({job_index}) with new condition.")
-                        wb.save(self.queuefile)
                     except Exception as e:
                         print(f"Error updating Excel sheet at row {job_index}: {e}")
                         self.logger.error(f"Re load Jobs - Error updating Excel sheet at row {job_index}: {e}")
@@ -625,10 +835,16 @@ class BATCH_FACTORY:
                 self.logger.error(f"Re Load Failed Jobs Unexpected error loading jobs: {e}")
                 self.logger.error(traceback.format_exc())
 
+        # Write all the Requeued conditions in one save
+        self.status_writer.flush()
+
         return self.jobs   
 
-    def create_new_queuefile(self):
-        '''write a new queuefile with preset header'''
+    def create_new_queuefile(self, template=None):
+        '''
+        write a new queuefile with preset header. The queuefile can be .xlsx, .csv or .parquet. If template is the path
+        of a filled in queuefile (e.g. the Excel template) its rows are copied into the new queuefile's format
+        '''
 
         
         self.logger.info("##########################################################################################################################")
@@ -637,28 +853,47 @@ class BATCH_FACTORY:
         self.logger.info("#")
         self.logger.info("##########################################################################################################################")
 
+        if template:
+            self.import_queuefile(template)
+            return
         
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = self.XLSX_SHEET_NAME
         headers = list(self.BATCH_PARAMETERS
 .values())
         headers.append(self.BATCH_CONDITION_COLUMN)
+
+        # CSV and Parquet queuefiles are written straight from the header row
+        if get_queue_format(self.queuefile) != 'xlsx':
+            write_queue_rows(self.queuefile, [headers], self.XLSX_SHEET_NAME)
+            return
+
+        wb = Workbook()
+        ws = wb.active
+        ws.title = self.XLSX_SHEET_NAME
         for h in headers:
             c = headers.index(h) + 1
             ws.cell(row=1, column=c).value = h
         wb.save(self.queuefile)
 
-    
-        
+    def import_queuefile(self, source):
+        ''' Replaces the queuefile with the rows of another queuefile in any format, e.g. an Excel template filled in by hand '''
+        print(f"Import Queuefile: Importing {source} into {self.queuefile}")
+        self.logger.info(f"Import Queuefile: Importing {source} into {self.queuefile}")
+        convert_queuefile(source, self.queuefile, self.XLSX_SHEET_NAME, self.logger)
+
+    def export_queuefile(self, destination):
+        ''' Writes the queuefile, with every job condition so far, to another format, e.g. a CSV queue to Excel to review '''
+        self.status_writer.flush()
+        print(f"Export Queuefile: Exporting {self.queuefile} to {destination}")
+        self.logger.info(f"Export Queuefile: Exporting {self.queuefile} to {destination}")
+        convert_queuefile(self.queuefile, destination, self.XLSX_SHEET_NAME, self.logger)
 
     def capture_arcpy_messages(self):
         ''' Re assigns the arcpy messages  (0 for all messages, 1 for warnings, and 2 for errors) to variables and passes them to the logger'''
         
-        arcpy_messages = arcpy.GetMessages(0) # Gets all messages
-        arcpy_warnings = arcpy.GetMessages(1) # Gets all warnings only
-        arcpy_errors = arcpy.GetMessages(2) # Gets all errors only
+        backend = get_backend()
+        arcpy_messages = backend.get_messages(0) # Gets all messages
+        arcpy_warnings = backend.get_messages(1) # Gets all warnings only
+        arcpy_errors = backend.get_messages(2) # Gets all errors only
         
         if arcpy_messages:
             self.logger.info(f'ast_toobox arcpy messages: {arcpy_messages}')
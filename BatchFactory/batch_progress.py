@@ -0,0 +1,193 @@
+###############################################################################################################################################################################
+#
+# Batch Progress - live queued/running/complete/failed counts, each running job's elapsed time against the timeout, jobs
+# per hour and an ETA for the batch that is running
+#
+# The scheduler reports each job start and condition change, which only updates a few counters under a lock. The status
+# page (http://127.0.0.1:PROGRESS_PORT/, or /status.json) and the progress line printed every PROGRESS_PRINT_SECONDS are
+# built from those counters on their own threads, so watching the batch never holds up the scheduler or the workers.
+#
+###############################################################################################################################################################################
+import json
+import time
+import html
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from env_config import get_env_number
+from dry_run import format_duration
+
+# Conditions that end a job for this batch. Requeued jobs go back to waiting
+FINISHED_CONDITIONS = {'COMPLETE': 'complete', 'Failed': 'failed', 'Unknown Error': 'failed'}
+
+# The status page reloads itself this often
+PAGE_REFRESH_SECONDS = 5
+
+
+class BATCH_PROGRESS:
+    ''' Progress of one batch, updated by the JOB_SCHEDULER and read by the status page and the progress line '''
+
+    def __init__(self, total=None, job_timeout=None, port=None, print_seconds=None, logger=None) -> None:
+        # total is None when the jobs come from a shared queue, the page then shows the jobs this node is holding
+        self.total = total
+        self.job_timeout = job_timeout
+        self.port = port if port is not None else get_env_number('PROGRESS_PORT', 8765)
+        self.print_seconds = print_seconds if print_seconds is not None else get_env_number('PROGRESS_PRINT_SECONDS', 60, float)
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.running = {}  # job_index -> (start_time, heartbeat)
+        self.counts = {'complete': 0, 'failed': 0, 'requeued': 0}
+        self.waiting = 0
+
+        self.server = None
+        self.printer_stop = None
+        self.printer_thread = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Scheduler events
+    # ------------------------------------------------------------------------------------------------------------------
+    def job_started(self, job_index, heartbeat=None, waiting=None):
+        ''' A job was handed to a worker. waiting is the number of jobs still in the scheduler's queues '''
+        with self.lock:
+            self.running[job_index] = (time.time(), heartbeat)
+            if waiting is not None:
+                self.waiting = waiting
+
+    def job_condition(self, job_index, condition):
+        ''' A job's condition changed. COMPLETE and Failed end it, Requeued sends it back to wait for a retry or the next batch '''
+        with self.lock:
+            if self.running.pop(job_index, None) is None and condition not in FINISHED_CONDITIONS:
+                return
+            if condition in FINISHED_CONDITIONS:
+                self.counts[FINISHED_CONDITIONS[condition]] += 1
+            elif condition == 'Requeued':
+                self.counts['requeued'] += 1
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Readers
+    # ------------------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        ''' Returns the batch progress as a dict: counts, throughput, ETA and every running job '''
+        now = time.time()
+        with self.lock:
+            running = dict(self.running)
+            counts = dict(self.counts)
+            waiting = self.waiting
+
+        finished = counts['complete'] + counts['failed']
+        if self.total is not None:
+            queued = max(0, self.total - finished - len(running))
+        else:
+            queued = waiting
+
+        # Throughput counts every finished job since the batch started, the ETA assumes the rest of the jobs keep that pace
+        elapsed = now - self.started_at
+        jobs_per_hour = finished / (elapsed / 3600) if finished and elapsed > 0 else None
+        eta_seconds = (queued + len(running)) / jobs_per_hour * 3600 if jobs_per_hour else None
+
+        jobs = []
+        for job_index, (start_time, heartbeat) in sorted(running.items(), key=lambda item: item[1][0]):
+            job_elapsed = now - start_time
+            jobs.append({'job_index': job_index,
+                         'elapsed_seconds': round(job_elapsed, 1),
+                         'timeout_seconds': self.job_timeout,
+                         'timeout_used': round(job_elapsed / self.job_timeout, 3) if self.job_timeout else None,
+                         'stage': heartbeat.current_stage() if heartbeat is not None else None,
+                         'seconds_since_progress': round(heartbeat.seconds_since_progress(), 1) if heartbeat is not None else None})
+
+        return {'total': self.total, 'queued': queued, 'running': len(running), 'complete': counts['complete'], 'failed': counts['failed'],
+                'requeued': counts['requeued'], 'elapsed_seconds': round(elapsed, 1),
+                'jobs_per_hour': round(jobs_per_hour, 2) if jobs_per_hour else None,
+                'eta_seconds': round(eta_seconds) if eta_seconds is not None else None, 'jobs': jobs}
+
+    def progress_line(self, snapshot=None):
+        ''' One line summary for the console and the log '''
+        snapshot = snapshot or self.snapshot()
+        rate = f"{snapshot['jobs_per_hour']:.1f} jobs/hour" if snapshot['jobs_per_hour'] else 'no jobs finished yet'
+        eta = format_duration(snapshot['eta_seconds']) if snapshot['eta_seconds'] is not None else 'unknown'
+        return (f"Batch Progress: {snapshot['queued']} queued, {snapshot['running']} running, {snapshot['complete']} complete, "
+                f"{snapshot['failed']} failed - {rate} - ETA {eta}")
+
+    def render_page(self):
+        ''' The status page: the counts and a table of the running jobs '''
+        snapshot = self.snapshot()
+        rows = []
+        for job in snapshot['jobs']:
+            timeout = format_duration(job['timeout_seconds']) if job['timeout_seconds'] else ''
+            used = f"{job['timeout_used'] * 100:.0f}%" if job['timeout_used'] is not None else ''
+            quiet = format_duration(job['seconds_since_progress']) if job['seconds_since_progress'] is not None else ''
+            rows.append(f"<tr><td>{job['job_index']}</td><td>{html.escape(job['stage'] or '')}</td><td>{format_duration(job['elapsed_seconds'])}</td>"
+                        f"<td>{timeout}</td><td>{used}</td><td>{quiet}</td></tr>")
+
+        return (f"<html><head><title>Batch Progress</title><meta http-equiv='refresh' content='{PAGE_REFRESH_SECONDS}'></head><body>"
+                f"<h2>{html.escape(self.progress_line(snapshot))}</h2>"
+                f"<p>Running for {format_duration(snapshot['elapsed_seconds'])}, {snapshot['requeued']} jobs requeued</p>"
+                f"<table border='1' cellpadding='4'><tr><th>Job</th><th>Stage</th><th>Elapsed</th><th>Timeout</th><th>Timeout used</th>"
+                f"<th>Since last progress</th></tr>{''.join(rows)}</table></body></html>")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Status page and progress line
+    # ------------------------------------------------------------------------------------------------------------------
+    def start(self):
+        ''' Starts the status page (PROGRESS_PORT, 0 turns it off) and the progress line timer (PROGRESS_PRINT_SECONDS, 0 turns it off) '''
+        self.started_at = time.time()
+
+        if self.port > 0:
+            progress = self
+
+            class PROGRESS_HANDLER(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.startswith('/status.json'):
+                        body, content_type = json.dumps(progress.snapshot()), 'application/json'
+                    else:
+                        body, content_type = progress.render_page(), 'text/html'
+                    body = body.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    # Page requests stay out of the batch log
+                    pass
+
+            try:
+                # Only this machine can see the page
+                self.server = ThreadingHTTPServer(('127.0.0.1', self.port), PROGRESS_HANDLER)
+                self.server.daemon_threads = True
+                threading.Thread(target=self.server.serve_forever, name='batch_progress_page', daemon=True).start()
+                print(f"Batch Progress: Status page at http://127.0.0.1:{self.port}/")
+                self.logger.info(f"Batch Progress: Status page at http://127.0.0.1:{self.port}/")
+            except OSError as e:
+                # Another batch on this machine has the port, the batch runs without a page
+                self.server = None
+                print(f"Batch Progress: Unable to open the status page on port {self.port}: {e}")
+                self.logger.warning(f"Batch Progress: Unable to open the status page on port {self.port}: {e}")
+
+        if self.print_seconds > 0:
+            self.printer_stop = threading.Event()
+
+            def print_loop():
+                while not self.printer_stop.wait(self.print_seconds):
+                    line = self.progress_line()
+                    print(line)
+                    self.logger.info(line)
+
+            self.printer_thread = threading.Thread(target=print_loop, name='batch_progress_line', daemon=True)
+            self.printer_thread.start()
+
+    def stop(self):
+        ''' Stops the page and the progress line, and logs the final progress '''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.printer_thread is not None:
+            self.printer_stop.set()
+            self.printer_thread.join()
+            self.printer_thread = None
+        self.logger.info(self.progress_line())
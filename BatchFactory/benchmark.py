@@ -0,0 +1,205 @@
+###############################################################################################################################################################################
+#
+# Benchmark - measures how many jobs per hour BATCH_FACTORY can push and where the time goes
+#
+# Generates synthetic batch_config workbooks, runs load_jobs, batch_ast and add_job_result against the simulated
+# geoprocessing backend (GP_BACKEND=simulated) and records the time and memory of each phase. Every run is appended to
+# benchmark_history.jsonl so a regression shows up against the last run with the same settings.
+#
+#   python benchmark.py --rows 10 100 1000 10000 --workers 4 --mode warm --latency 0
+#
+###############################################################################################################################################################################
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import datetime
+import tempfile
+import platform
+import contextlib
+import subprocess
+import tracemalloc
+
+from queue_reader import write_queue_rows
+
+# A phase more than this much slower than the last run with the same settings is reported as a regression
+REGRESSION_THRESHOLD = 0.20
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark_history.jsonl')
+
+
+def build_workbook(queuefile, rows):
+    ''' Writes a batch_config queuefile (xlsx, csv or parquet) with `rows` synthetic jobs. The simulated tool ignores the parameter values '''
+    header = [('region', 'file_number', 'include_summary', 'batch_condition')]
+    jobs = ((f'Region {row % 8}', f'BENCH{row:06d}', 'false', None) for row in range(rows))
+    write_queue_rows(queuefile, itertools.chain(header, jobs))
+
+
+def measure(phase, func, results):
+    ''' Runs func and stores its wall time and peak Python memory (MB) in results[phase]. Returns what func returns '''
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    results[phase] = {'seconds': round(seconds, 4), 'peak_mb': round(peak / (1024 * 1024), 2)}
+    return value
+
+
+def run_benchmark(rows, workers, work_dir, logger, queue_format='xlsx'):
+    ''' Runs one workbook size through every phase and returns the result record '''
+    from batch_factory import BATCH_FACTORY
+    from job_telemetry import read_process_counters
+
+    queuefile = os.path.join(work_dir, f'benchmark_{rows}.{queue_format}')
+    phases = {}
+
+    measure('build_workbook', lambda: build_workbook(queuefile, rows), phases)
+
+    bf = BATCH_FACTORY(queuefile, 'benchmark', 'benchmark', logger, work_dir)
+    try:
+        measure('load_jobs', bf.load_jobs, phases)
+        scheduler = measure('batch_ast', bf.batch_ast, phases)
+
+        # Every job result going through the ledger and status writer, then the one save
+        def write_results():
+            for job_index in range(rows):
+                bf.add_job_result(job_index, 'COMPLETE')
+            bf.status_writer.flush()
+        measure('add_job_result', write_results, phases)
+    finally:
+        bf.ledger.close()
+
+    # Split the batch into worker startup, tool execution and what's left over for the scheduler and I/O
+    batch_seconds = phases['batch_ast']['seconds']
+    startup_seconds = sum(scheduler.startup_seconds) if scheduler else 0
+    tool_seconds = sum(scheduler.job_seconds) if scheduler else 0
+    ideal_seconds = (startup_seconds + tool_seconds) / max(workers, 1)
+
+    return {
+        'rows': rows,
+        'phases': phases,
+        'jobs_succeeded': scheduler.success_counter if scheduler else 0,
+        'jobs_per_hour': round(rows / batch_seconds * 3600, 1) if batch_seconds else None,
+        'worker_startup_seconds': round(startup_seconds, 4),
+        'tool_seconds': round(tool_seconds, 4),
+        'scheduling_overhead_seconds': round(max(batch_seconds - ideal_seconds, 0), 4),
+        'parent_peak_rss_mb': read_process_counters()['peak_rss_mb'],
+    }
+
+
+def get_git_commit():
+    ''' Returns the short hash of the checked out commit, or None outside a git repository '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_file):
+    ''' Returns every benchmark record in the history file, oldest first '''
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history):
+    ''' Compares each phase with the last run that used the same settings. Returns a list of regression messages '''
+    settings = record['settings']
+    previous = [r for r in history if r.get('settings') == settings and r.get('rows') == record['rows']]
+    if not previous:
+        return []
+
+    last = previous[-1]
+    regressions = []
+    for phase, measured in record['phases'].items():
+        before = last.get('phases', {}).get(phase)
+        if before and before['seconds'] > 0 and measured['seconds'] > before['seconds'] * (1 + REGRESSION_THRESHOLD):
+            regressions.append(f"{record['rows']} rows {phase}: {measured['seconds']:.3f}s, was {before['seconds']:.3f}s "
+                               f"at {last.get('git_commit')} ({measured['seconds'] / before['seconds'] - 1:+.0%})")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark BATCH_FACTORY throughput against the simulated geoprocessing backend')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000], help='workbook sizes to run (10 to 10000 rows)')
+    parser.add_argument('--workers', type=int, default=4, help='MAX_WORKERS for the batch')
+    parser.add_argument('--mode', choices=['warm', 'spawn'], default='warm', help='WORKER_MODE for the batch')
+    parser.add_argument('--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx', help='queuefile format')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated tool run time in seconds')
+    parser.add_argument('--startup', type=float, default=0.0, help='simulated toolbox import time in seconds')
+    parser.add_argument('--transient-failure-rate', type=float, default=0.0, help='fraction of tool runs that fail with a retryable error')
+    parser.add_argument('--history', default=HISTORY_FILE, help='file the results are appended to')
+    parser.add_argument('--verbose', action='store_true', help="show BATCH_FACTORY's console output")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Every phase runs against the simulated backend. Workers inherit these settings
+    os.environ['GP_BACKEND'] = 'simulated'
+    os.environ['GP_SIM_LATENCY_SECONDS'] = str(args.latency)
+    os.environ['GP_SIM_STARTUP_SECONDS'] = str(args.startup)
+    os.environ['GP_SIM_TRANSIENT_FAILURE_RATE'] = str(args.transient_failure_rate)
+    os.environ['GP_SIM_PERMANENT_FAILURE_RATE'] = '0'
+    os.environ['MAX_WORKERS'] = str(args.workers)
+    os.environ['WORKER_MODE'] = args.mode
+    os.environ['RETRY_BACKOFF_SECONDS'] = '0'
+    os.environ.setdefault('TOOLBOX', 'benchmark.atbx')
+    os.environ.setdefault('TOOL', 'Benchmark_tool')
+
+    settings = {'workers': args.workers, 'mode': args.mode, 'format': args.format, 'latency': args.latency, 'startup': args.startup,
+                'transient_failure_rate': args.transient_failure_rate}
+
+    # Logs, ledgers, run reports and workbooks all go to a scratch folder
+    work_dir = tempfile.mkdtemp(prefix='batchfactory_benchmark_')
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    sys.path.insert(0, script_dir)
+    original_dir = os.getcwd()
+    os.chdir(work_dir)
+
+    from logging_setup import setup_logging, stop_logging
+    logger = setup_logging()
+
+    history = load_history(args.history)
+    records = []
+    tracemalloc.start()
+    try:
+        for rows in args.rows:
+            print(f"Benchmark: {rows} rows on {args.workers} {args.mode} workers...")
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+            with output:
+                result = run_benchmark(rows, args.workers, work_dir, logger, args.format)
+
+            record = {
+                'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                'git_commit': get_git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'settings': settings,
+            }
+            record.update(result)
+            records.append(record)
+
+            phase_summary = ', '.join(f"{phase} {measured['seconds']:.3f}s/{measured['peak_mb']:.1f}MB" for phase, measured in record['phases'].items())
+            print(f"Benchmark: {rows} rows - {record['jobs_per_hour']} jobs/hour - {phase_summary}")
+            print(f"Benchmark: worker startup {record['worker_startup_seconds']}s, tool {record['tool_seconds']}s, "
+                  f"scheduling overhead {record['scheduling_overhead_seconds']}s")
+            for regression in find_regressions(record, history):
+                print(f"Benchmark: REGRESSION {regression}")
+    finally:
+        tracemalloc.stop()
+        stop_logging()
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.history, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    print(f"Benchmark: Results appended to {args.history}")
@@ -0,0 +1,231 @@
+###############################################################################################################################################################################
+#
+# Connection Broker - one validated BCGW connection file for the whole run, shared read-only by every worker, and a cap on
+# the number of BCGW sessions the batch holds open at once
+#
+# The .sde file is created once, probed, and published to the workers through BCGW_SDE_FILE (the AST tool uses it
+# instead of creating its own connection). The path never changes during a run, a failover to BCGW_FAILOVER_INSTANCE
+# replaces the file in place. The scheduler asks the broker for a session before it starts a job and gives it back when
+# the job ends, jobs wait in the queue while BCGW_MAX_SESSIONS are in use.
+#
+# The workers log in with the file, so it holds the BCGW user name and password. It is kept in a folder on local disk
+# (under LOCAL_CONNECTION_DIR, the system temp folder by default) that only the user running the batch can open, and the
+# folder is removed when the run ends.
+#
+###############################################################################################################################################################################
+import os
+import sys
+import stat
+import time
+import atexit
+import shutil
+import getpass
+import logging
+import tempfile
+import subprocess
+
+from gp_backend import get_backend
+from aoi_utilities import FW_SETUP_LOCK
+from env_config import get_env_number
+from job_scheduler import get_max_workers
+
+# Production BCGW and the delivery (test) instance from the AST tool's config.py
+DEFAULT_INSTANCE = 'bcgw.bcgov/idwprod1.bcgov'
+DEFAULT_FAILOVER_INSTANCE = 'bcgw-i.bcgov/idwdlvr1.bcgov'
+
+CONNECTION_FILE = 'bcgw.sde'
+
+# The run's broker, created by setup_bcgw
+CONNECTION_BROKER_INSTANCE = None
+
+
+def create_private_folder():
+    '''
+    Creates a folder on local disk that only the current user can open and returns its path. Raises PermissionError if
+    the access can't be restricted, the credentials are never written to a folder other users can read.
+    '''
+    folder = tempfile.mkdtemp(prefix='bcgw_connection_', dir=os.getenv('LOCAL_CONNECTION_DIR') or None)
+    if sys.platform == 'win32':
+        # mkdtemp's mode is ignored on Windows, replace the inherited permissions with full control for this user only
+        domain = os.getenv('USERDOMAIN')
+        user = f'{domain}\\{getpass.getuser()}' if domain else getpass.getuser()
+        result = subprocess.run(['icacls', folder, '/inheritance:r', '/grant:r', f'{user}:(OI)(CI)F'], capture_output=True, text=True)
+        if result.returncode != 0:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise PermissionError(f"Connection Broker: Unable to restrict access to {folder}: {result.stdout.strip()} {result.stderr.strip()}")
+    else:
+        os.chmod(folder, stat.S_IRWXU)
+    return folder
+
+
+class CONNECTION_BROKER:
+    ''' Creates and health checks the run's BCGW connection file and counts the sessions held by running jobs '''
+
+    def __init__(self, connection_folder=None, user=None, password=None, instances=None, max_sessions=None, sessions_per_job=None,
+                 health_check_seconds=None, logger=None) -> None:
+        # The connection file holds the credentials, by default it goes in a private folder that close removes
+        self.owns_folder = connection_folder is None
+        self.connection_folder = connection_folder or create_private_folder()
+        self.user = user
+        self.password = password
+        self.logger = logger or logging.getLogger(__name__)
+
+        # The instances to try in order, the first one that passes the probe is used
+        if instances is None:
+            instances = [os.getenv('BCGW_INSTANCE') or DEFAULT_INSTANCE, os.getenv('BCGW_FAILOVER_INSTANCE', DEFAULT_FAILOVER_INSTANCE)]
+        self.instances = [instance.strip() for instance in instances if instance and instance.strip()]
+
+        # By default the batch holds the sessions of one job per worker, a BCGW_MAX_SESSIONS of 0 means no cap
+        self.sessions_per_job = sessions_per_job if sessions_per_job is not None else get_env_number('BCGW_SESSIONS_PER_JOB', 1)
+        if max_sessions is None:
+            max_sessions = get_env_number('BCGW_MAX_SESSIONS', get_max_workers(self.logger) * self.sessions_per_job)
+        self.max_sessions = max_sessions
+        self.health_check_seconds = health_check_seconds if health_check_seconds is not None else get_env_number('BCGW_HEALTH_CHECK_SECONDS', 300, float)
+
+        self.sde_file = os.path.join(self.connection_folder, CONNECTION_FILE)
+        self.instance = None
+        self.healthy = False
+        self.last_check = 0.0
+        self.sessions = {}  # job_index -> sessions held
+        self.job_instances = {}  # job_index -> instance the job was started on
+
+    def create_connection(self, instance):
+        ''' Creates a connection file for instance next to the shared one and returns its path, or None if it can't be created '''
+        candidate_name = 'bcgw_candidate.sde'
+        candidate = os.path.join(self.connection_folder, candidate_name)
+        if os.path.exists(candidate):
+            os.remove(candidate)
+        try:
+            # The workers log in with this file, so it keeps the user name and password
+            with FW_SETUP_LOCK:
+                return get_backend().create_database_connection(self.connection_folder, candidate_name, instance, self.user, self.password,
+                                                                save_credentials=True)
+        except Exception as e:
+            print(f"Connection Broker: Unable to create a connection to {instance}: {e}")
+            self.logger.error(f"Connection Broker: Unable to create a connection to {instance}: {e}")
+            return None
+
+    def probe(self, connection_file):
+        '''
+        True if connection_file can read from the database. The probe sets arcpy's workspace while it lists the datasets
+        (and puts it back afterwards), so it holds the same lock as FW Setup on the AOI preparation threads
+        '''
+        with FW_SETUP_LOCK:
+            return get_backend().probe_connection(connection_file)
+
+    def publish(self, candidate):
+        ''' Moves a probed connection file to the shared path, read-only so no worker changes it '''
+        if os.path.exists(self.sde_file):
+            os.chmod(self.sde_file, stat.S_IREAD | stat.S_IWRITE)
+        os.replace(candidate, self.sde_file)
+        os.chmod(self.sde_file, stat.S_IREAD)
+        os.environ['BCGW_SDE_FILE'] = self.sde_file
+
+    def connect(self):
+        '''
+        Tries each instance in order, publishing the first connection that passes the probe. Returns the instance that is
+        in use. Raises ConnectionError if no instance can be reached.
+        '''
+        self.last_check = time.time()
+        for instance in self.instances:
+            candidate = self.create_connection(instance)
+            if candidate and self.probe(candidate):
+                if self.instance and instance != self.instance:
+                    print(f"Connection Broker: Failed over from {self.instance} to {instance}")
+                    self.logger.warning(f"Connection Broker: Failed over from {self.instance} to {instance}")
+                elif instance != self.instances[0]:
+                    print(f"Connection Broker: {self.instances[0]} is unavailable, using {instance}")
+                    self.logger.warning(f"Connection Broker: {self.instances[0]} is unavailable, using {instance}")
+                self.publish(candidate)
+                self.instance = instance
+                self.healthy = True
+                print(f"Connection Broker: Connected to {instance}, workers share {self.sde_file}")
+                self.logger.info(f"Connection Broker: Connected to {instance}, workers share {self.sde_file}")
+                return instance
+
+            print(f"Connection Broker: {instance} failed the health check")
+            self.logger.error(f"Connection Broker: {instance} failed the health check")
+
+        self.healthy = False
+        raise ConnectionError(f"Connection Broker: None of {self.instances} could be reached")
+
+    def check_health(self, force=False):
+        '''
+        Probes the shared connection every health_check_seconds. If the probe fails the instances are tried again from
+        the top, so the batch fails over, or falls back to production once it is back. Returns True while a connection is usable.
+        '''
+        if not force and time.time() - self.last_check < self.health_check_seconds:
+            return self.healthy
+
+        self.last_check = time.time()
+        if self.instance == self.instances[0] and self.probe(self.sde_file):
+            self.healthy = True
+            return True
+
+        try:
+            self.connect()
+        except ConnectionError as e:
+            print(f"{e}, holding new jobs until the next health check")
+            self.logger.error(f"{e}, holding new jobs until the next health check")
+        return self.healthy
+
+    def seconds_until_health_check(self):
+        return max(0, self.last_check + self.health_check_seconds - time.time())
+
+    def has_free_session(self):
+        ''' True if another job can start: the connection is healthy and the session cap leaves room for one more job '''
+        if not self.check_health():
+            return False
+        if self.max_sessions <= 0:
+            return True
+        return sum(self.sessions.values()) + self.sessions_per_job <= self.max_sessions
+
+    def acquire(self, job_index):
+        ''' Counts the job's sessions and returns the instance it runs on, the ledger records it with the attempt '''
+        self.sessions[job_index] = self.sessions_per_job
+        self.job_instances[job_index] = self.instance
+        return self.instance
+
+    def release(self, job_index):
+        self.sessions.pop(job_index, None)
+        self.job_instances.pop(job_index, None)
+
+    def close(self):
+        ''' Deletes the connection file (and the private folder it is in) so the saved credentials don't outlive the run '''
+        for sde_file in [self.sde_file, os.path.join(self.connection_folder, 'bcgw_candidate.sde')]:
+            if os.path.exists(sde_file):
+                os.chmod(sde_file, stat.S_IREAD | stat.S_IWRITE)
+                os.remove(sde_file)
+        if self.owns_folder:
+            shutil.rmtree(self.connection_folder, ignore_errors=True)
+        if os.environ.get('BCGW_SDE_FILE') == self.sde_file:
+            del os.environ['BCGW_SDE_FILE']
+        self.healthy = False
+        self.logger.info(f"Connection Broker: Removed the connection file {self.sde_file}")
+
+
+def open_connection_broker(user, password, logger=None, connection_folder=None):
+    ''' Creates the run's connection broker and connects it. The connection file is removed when the run exits. Returns the broker '''
+    global CONNECTION_BROKER_INSTANCE
+    CONNECTION_BROKER_INSTANCE = CONNECTION_BROKER(connection_folder, user, password, logger=logger)
+    # Removed on a normal exit, an unhandled error or Ctrl+C, close_connection_broker removes it sooner
+    atexit.register(close_connection_broker)
+    try:
+        CONNECTION_BROKER_INSTANCE.connect()
+    except ConnectionError:
+        close_connection_broker()
+        raise
+    return CONNECTION_BROKER_INSTANCE
+
+
+def close_connection_broker():
+    ''' Removes the run's connection file. Safe to call more than once '''
+    global CONNECTION_BROKER_INSTANCE
+    if CONNECTION_BROKER_INSTANCE is not None:
+        CONNECTION_BROKER_INSTANCE.close()
+        CONNECTION_BROKER_INSTANCE = None
+
+
+def get_connection_broker():
+    ''' Returns the run's connection broker, or None if setup_bcgw hasn't created one (dry runs, benchmarks) '''
+    return CONNECTION_BROKER_INSTANCE
@@ -5,7 +5,8 @@
 ###############################################################################################################################################################################
 import os
 from dotenv import load_dotenv
-import arcpy
+from gp_backend import get_backend
+from connection_broker import open_connection_broker
 
 def setup_bcgw(logger):
     # Get the secret file containing the database credentials
@@ -33,38 +34,18 @@ def setup_bcgw(logger):
         print("Database user and password not found")
         logger.error("Database user and password not found")
 
-    # Define current path of the executing script
-    current_path = os.path.dirname(os.path.realpath(__file__))
-
-    # Create the connection folder
-    connection_folder = 'connection'
-    connection_folder = os.path.join(current_path, connection_folder)
-
-    # Check for the existance of the connection folder and if it doesn't exist, print an error and create a new connection folder
-    if not os.path.exists(connection_folder):
-        print("Connection folder not found, creating new connection folder")
-        logger.info("Connection folder not found, creating new connection folder")
-        os.mkdir(connection_folder)
-
-    # Check for an existing bcgw connection, if there is one, remove it
-    if os.path.exists(os.path.join(connection_folder, 'bcgw.sde')):
-        os.remove(os.path.join(connection_folder, 'bcgw.sde'))
-
-    # Create a bcgw connection
-    bcgw_con = arcpy.management.CreateDatabaseConnection(connection_folder,
-                                                        'bcgw.sde',
-                                                        'ORACLE',
-                                                        'bcgw.bcgov/idwprod1.bcgov',
-                                                        'DATABASE_AUTH',
-                                                        DB_USER,
-                                                        DB_PASS,
-                                                        'DO_NOT_SAVE_USERNAME')
+    # Create one bcgw connection for the whole run. The broker probes it (failing over to the test instance if production
+    # can't be reached) and shares it with the workers through BCGW_SDE_FILE. The file keeps the credentials so the
+    # workers can log in with it, it is written to a private local folder that is removed when the run ends
+    backend = get_backend()
+    broker = open_connection_broker(DB_USER, DB_PASS, logger)
+    bcgw_con = broker.sde_file
 
     print("new db connection created")
-    logger.info("new db connection created")
+    logger.info(f"new db connection created ({broker.instance})")
 
 
-    arcpy.env.workspace = bcgw_con.getOutput(0)
+    backend.set_environment(workspace=bcgw_con)
 
     print("workspace set to bcgw connection")
     logger.info("workspace set to bcgw connection")
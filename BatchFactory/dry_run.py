@@ -0,0 +1,93 @@
+###############################################################################################################################################################################
+#
+# Dry Run - checks a queuefile before a long batch: tool parameters, input and output paths, estimated job cost and the
+# projected makespan. Nothing is written to the queuefile, the BCGW isn't touched and the tool isn't run.
+#
+###############################################################################################################################################################################
+import os
+
+
+def format_duration(seconds):
+    ''' Returns seconds as "2h 05m" (or "45s" under a minute) '''
+    seconds = int(round(seconds or 0))
+    if seconds < 60:
+        return f"{seconds}s"
+    hours, minutes = divmod(seconds // 60, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m"
+
+
+def check_tool_signature(parameter_names, tool_parameters):
+    '''
+    Compares the queuefile columns with the tool's parameters. The columns are passed to the tool by position, so a
+    column whose name isn't the tool parameter at that position is reported. Returns a list of (severity, message).
+    '''
+    problems = []
+    if tool_parameters is None:
+        return problems
+
+    if len(parameter_names) > len(tool_parameters):
+        problems.append(('error', f"The queuefile has {len(parameter_names)} parameter columns but the tool only takes {len(tool_parameters)}: "
+                                  f"{parameter_names[len(tool_parameters):]} have no tool parameter"))
+
+    for column, tool_parameter in zip(parameter_names, tool_parameters):
+        if column.lower() != str(tool_parameter['name']).lower():
+            problems.append(('warning', f"Column '{column}' is passed as tool parameter '{tool_parameter['name']}'"))
+
+    for tool_parameter in tool_parameters[len(parameter_names):]:
+        if tool_parameter['required']:
+            problems.append(('error', f"Required tool parameter '{tool_parameter['name']}' has no column in the queuefile"))
+
+    return problems
+
+
+def check_job_parameters(job, parameter_names, tool_parameters):
+    ''' Checks one job's values against the tool's parameters: required values are filled in and booleans are true or false '''
+    problems = []
+    if tool_parameters is None:
+        return problems
+
+    for column, tool_parameter in zip(parameter_names, tool_parameters):
+        value = job.get(column)
+        empty = value is None or str(value).strip() == ''
+        if empty and tool_parameter['required']:
+            problems.append(('error', f"'{column}' is required by the tool but is empty"))
+        elif not empty and str(tool_parameter.get('datatype', '')).lower() == 'boolean' and str(value).strip().lower() not in ['true', 'false']:
+            problems.append(('error', f"'{column}' must be true or false, not '{value}'"))
+    return problems
+
+
+def check_feature_layer(feature_layer):
+    ''' Returns a (severity, message) if the job's feature layer can't be reached, otherwise None '''
+    if not feature_layer:
+        return None
+
+    feature_layer = str(feature_layer)
+    lower_path = feature_layer.lower()
+
+    # A geodatabase feature class is reachable if its geodatabase folder is
+    path = feature_layer[:lower_path.index('.gdb') + 4] if '.gdb' in lower_path else feature_layer
+    if not os.path.exists(path):
+        return ('error', f"feature_layer '{feature_layer}' doesn't exist or can't be reached")
+    if not os.access(path, os.R_OK):
+        return ('error', f"feature_layer '{feature_layer}' can't be read")
+    return None
+
+
+def check_output_directory(output_directory):
+    ''' Returns a (severity, message) if the output directory can't be written to or created, otherwise None '''
+    if not output_directory:
+        return None
+
+    output_directory = str(output_directory)
+    if os.path.isdir(output_directory):
+        if not os.access(output_directory, os.W_OK):
+            return ('error', f"output_directory '{output_directory}' isn't writable")
+        return None
+
+    # The worker creates a missing output directory, so its nearest existing parent has to be writable
+    parent = os.path.dirname(os.path.abspath(output_directory))
+    while parent and not os.path.exists(parent) and os.path.dirname(parent) != parent:
+        parent = os.path.dirname(parent)
+    if not os.path.isdir(parent) or not os.access(parent, os.W_OK):
+        return ('error', f"output_directory '{output_directory}' doesn't exist and can't be created")
+    return ('warning', f"output_directory '{output_directory}' doesn't exist yet, the worker will create it")
@@ -0,0 +1,17 @@
+###############################################################################################################################################################################
+#
+# Env Config - reads the numeric settings from the .env file for every module of the batch
+#
+###############################################################################################################################################################################
+import os
+
+
+def get_env_number(name, default, cast=int):
+    ''' Returns a number from the .env file, or the default if it isn't set or isn't a number '''
+    value = os.getenv(name)
+    if value is None or str(value).strip() == '':
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        return default
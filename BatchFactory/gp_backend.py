@@ -0,0 +1,305 @@
+###############################################################################################################################################################################
+#
+# GP Backend - the geoprocessing operations BatchFactory needs, behind one interface so the batching can run without ArcGIS
+#
+# GP_BACKEND=arcpy (default) runs the real tools, GP_BACKEND=simulated fakes them with configurable latency and failure rates
+# so the scheduler, retry policy and status writer can be load tested on a machine without arcpy.
+#
+###############################################################################################################################################################################
+import os
+import time
+import random
+
+from env_config import get_env_number
+
+# One backend per process, created the first time get_backend is called
+BACKEND = None
+
+
+class GP_BACKEND:
+    ''' The geoprocessing operations BatchFactory uses. Each backend implements all of them '''
+
+    name = None
+
+    def import_toolbox(self, toolbox):
+        ''' Imports the toolbox so its tools can be found with get_tool '''
+        raise NotImplementedError
+
+    def get_tool(self, tool_name):
+        ''' Returns the tool function for tool_name, or None if the toolbox doesn't have it '''
+        raise NotImplementedError
+
+    def run_tool(self, tool_func, params):
+        ''' Runs a tool returned by get_tool with a list of parameter values '''
+        raise NotImplementedError
+
+    def get_messages(self, severity=0):
+        ''' Returns the messages from the last tool run (0 for all messages, 1 for warnings and 2 for errors) '''
+        raise NotImplementedError
+
+    def get_message_count(self):
+        ''' Returns how many messages the running (or last) tool has written. Used by the worker heartbeat to see progress '''
+        raise NotImplementedError
+
+    def get_tool_parameters(self, tool_name):
+        ''' Returns the tool's parameters in order as [{'name', 'required', 'datatype'}], or None if they can't be read '''
+        raise NotImplementedError
+
+    def create_database_connection(self, connection_folder, connection_name, instance, user, password, save_credentials=False):
+        ''' Creates a database connection file and returns its path. save_credentials stores the user name and password in the file '''
+        raise NotImplementedError
+
+    def probe_connection(self, connection_file):
+        ''' Returns True if the database connection file can be used to read from the database '''
+        raise NotImplementedError
+
+    def set_environment(self, workspace=None, overwrite_output=None, scratch_workspace=None):
+        ''' Sets the workspace, overwrite output and scratch workspace environment settings for the tools that follow '''
+        raise NotImplementedError
+
+    def describe_spatial_reference(self, dataset):
+        ''' Returns the spatial reference of a dataset '''
+        raise NotImplementedError
+
+    def create_feature_class(self, out_path, out_name, geometry_type, template, spatial_reference):
+        ''' Creates a feature class from a template and returns its path '''
+        raise NotImplementedError
+
+    def append(self, inputs, target):
+        ''' Appends inputs to the target feature class without a schema test and returns the target '''
+        raise NotImplementedError
+
+    def convert_to_kml(self, feature_class, layer_name, kml_file):
+        ''' Writes a feature class to a KML file and returns the KML path '''
+        raise NotImplementedError
+
+
+class ARCPY_BACKEND(GP_BACKEND):
+    ''' Runs everything with arcpy. arcpy is only imported when the backend is created '''
+
+    name = 'arcpy'
+
+    def __init__(self) -> None:
+        import arcpy
+        self.arcpy = arcpy
+
+    def import_toolbox(self, toolbox):
+        self.arcpy.ImportToolbox(toolbox)
+
+    def get_tool(self, tool_name):
+        return getattr(self.arcpy, tool_name, None)
+
+    def run_tool(self, tool_func, params):
+        return tool_func(*params)
+
+    def get_messages(self, severity=0):
+        return self.arcpy.GetMessages(severity)
+
+    def get_message_count(self):
+        # Read from the heartbeat thread while the tool runs, a failed read just means no progress seen this time
+        try:
+            return self.arcpy.GetMessageCount()
+        except Exception:
+            return None
+
+    def get_tool_parameters(self, tool_name):
+        # The toolbox has to be imported first
+        try:
+            return [{'name': p.name, 'required': p.parameterType == 'Required', 'datatype': p.datatype}
+                    for p in self.arcpy.GetParameterInfo(tool_name)]
+        except Exception:
+            return None
+
+    def create_database_connection(self, connection_folder, connection_name, instance, user, password, save_credentials=False):
+        connection = self.arcpy.management.CreateDatabaseConnection(connection_folder,
+                                                                    connection_name,
+                                                                    'ORACLE',
+                                                                    instance,
+                                                                    'DATABASE_AUTH',
+                                                                    user,
+                                                                    password,
+                                                                    'SAVE_USERNAME' if save_credentials else 'DO_NOT_SAVE_USERNAME')
+        return connection.getOutput(0)
+
+    def probe_connection(self, connection_file):
+        # Same test the AST tool makes on its connection: the connection works if it can list the datasets
+        workspace = self.arcpy.env.workspace
+        try:
+            self.arcpy.env.workspace = connection_file
+            return bool(self.arcpy.ListDatasets())
+        except Exception:
+            return False
+        finally:
+            self.arcpy.env.workspace = workspace
+
+    def set_environment(self, workspace=None, overwrite_output=None, scratch_workspace=None):
+        if workspace is not None:
+            self.arcpy.env.workspace = workspace
+        if overwrite_output is not None:
+            self.arcpy.env.overwriteOutput = overwrite_output
+        if scratch_workspace is not None:
+            self.arcpy.env.scratchWorkspace = scratch_workspace
+
+    def describe_spatial_reference(self, dataset):
+        return self.arcpy.Describe(dataset).spatialReference
+
+    def create_feature_class(self, out_path, out_name, geometry_type, template, spatial_reference):
+        feature_class = self.arcpy.management.CreateFeatureclass(out_path, out_name, geometry_type, template,
+                                                                 "SAME_AS_TEMPLATE", "SAME_AS_TEMPLATE", spatial_reference)
+        return feature_class.getOutput(0)
+
+    def append(self, inputs, target):
+        return self.arcpy.management.Append(inputs, target, "NO_TEST").getOutput(0)
+
+    def convert_to_kml(self, feature_class, layer_name, kml_file):
+        # LayerToKML needs a layer, not a feature class path
+        layer = self.arcpy.management.MakeFeatureLayer(feature_class, layer_name)
+        self.arcpy.conversion.LayerToKML(layer, kml_file)
+        return kml_file
+
+
+class SIMULATED_TOOL:
+    ''' Stand-in for a toolbox tool. Sleeps for the simulated latency and then succeeds or raises a simulated error '''
+
+    def __init__(self, backend, tool_name) -> None:
+        self.backend = backend
+        self.__name__ = tool_name
+
+    def __call__(self, *params):
+        return self.backend.run_tool(self, params)
+
+
+class SIMULATED_BACKEND(GP_BACKEND):
+    '''
+    Pure Python backend for load testing. Tools sleep for GP_SIM_LATENCY_SECONDS (+/- GP_SIM_LATENCY_JITTER), writing a
+    progress message every second, and fail with an Oracle connection error at GP_SIM_TRANSIENT_FAILURE_RATE or a missing
+    dataset error at GP_SIM_PERMANENT_FAILURE_RATE, so both sides of the retry policy get exercised. At GP_SIM_HANG_RATE
+    a tool hangs without writing any messages, like a stuck arcpy call. Importing the toolbox takes GP_SIM_STARTUP_SECONDS.
+    Files that would be created (connections, feature classes, KMLs) are written as empty placeholders.
+    '''
+
+    name = 'simulated'
+
+    # Error text the retry policy classifies as transient and permanent
+    TRANSIENT_ERROR = 'ERROR 999999: Underlying DBMS error [ORA-03113: end-of-file on communication channel]'
+    PERMANENT_ERROR = 'ERROR 000732: Input Features: Dataset does not exist or is not supported'
+
+    def __init__(self, latency_seconds=None, latency_jitter=None, transient_failure_rate=None, permanent_failure_rate=None,
+                 startup_seconds=None, hang_rate=None, seed=None) -> None:
+        self.latency_seconds = latency_seconds if latency_seconds is not None else get_env_number('GP_SIM_LATENCY_SECONDS', 1.0, float)
+        self.latency_jitter = latency_jitter if latency_jitter is not None else get_env_number('GP_SIM_LATENCY_JITTER', 0.0, float)
+        self.transient_failure_rate = transient_failure_rate if transient_failure_rate is not None else get_env_number('GP_SIM_TRANSIENT_FAILURE_RATE', 0.0, float)
+        self.permanent_failure_rate = permanent_failure_rate if permanent_failure_rate is not None else get_env_number('GP_SIM_PERMANENT_FAILURE_RATE', 0.0, float)
+        self.startup_seconds = startup_seconds if startup_seconds is not None else get_env_number('GP_SIM_STARTUP_SECONDS', 0.0, float)
+        self.hang_rate = hang_rate if hang_rate is not None else get_env_number('GP_SIM_HANG_RATE', 0.0, float)
+        seed = seed if seed is not None else get_env_number('GP_SIM_SEED', None)
+
+        # Each worker process gets its own sequence, otherwise every spawned worker would make the same choices
+        self.random = random.Random(None if seed is None else seed + os.getpid())
+        self.toolbox = None
+        self.messages = {0: '', 1: '', 2: ''}
+        self.message_count = 0
+
+    def import_toolbox(self, toolbox):
+        time.sleep(self.startup_seconds)
+        self.toolbox = toolbox
+
+    def get_tool(self, tool_name):
+        return SIMULATED_TOOL(self, tool_name)
+
+    def run_tool(self, tool_func, params):
+        start = time.time()
+        self.messages = {0: f"Start Time: {time.ctime(start)}", 1: '', 2: ''}
+        self.message_count = 1
+
+        # A hung tool never returns and never writes another message
+        if self.random.random() < self.hang_rate:
+            while True:
+                time.sleep(60)
+
+        latency = self.latency_seconds
+        if self.latency_jitter:
+            latency += self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        end = start + max(latency, 0)
+        while time.time() < end:
+            time.sleep(min(1.0, end - time.time()))
+            self.messages[0] += f"\nProcessing... {time.time() - start:.0f} seconds"
+            self.message_count += 1
+
+        roll = self.random.random()
+        if roll < self.transient_failure_rate:
+            error = self.TRANSIENT_ERROR
+        elif roll < self.transient_failure_rate + self.permanent_failure_rate:
+            error = self.PERMANENT_ERROR
+        else:
+            error = None
+
+        if error:
+            self.messages[2] = error
+            self.messages[0] += f"\n{error}\nFailed at {time.ctime()} (Elapsed Time: {time.time() - start:.2f} seconds)"
+            raise RuntimeError(error)
+
+        self.messages[0] += f"\nSucceeded at {time.ctime()} (Elapsed Time: {time.time() - start:.2f} seconds)"
+        return None
+
+    def get_messages(self, severity=0):
+        return self.messages.get(severity, '')
+
+    def get_message_count(self):
+        return self.message_count
+
+    def get_tool_parameters(self, tool_name):
+        # Simulated tools take whatever they are given
+        return None
+
+    def create_database_connection(self, connection_folder, connection_name, instance, user, password, save_credentials=False):
+        connection_file = os.path.join(connection_folder, connection_name)
+        with open(connection_file, 'w') as f:
+            f.write(f'simulated connection to {instance}\n')
+        return connection_file
+
+    def probe_connection(self, connection_file):
+        # Instances listed in GP_SIM_UNAVAILABLE_INSTANCES (comma separated) fail the probe
+        unavailable = [instance.strip() for instance in os.getenv('GP_SIM_UNAVAILABLE_INSTANCES', '').split(',') if instance.strip()]
+        try:
+            with open(connection_file) as f:
+                instance = f.read().replace('simulated connection to', '').strip()
+        except OSError:
+            return False
+        return instance not in unavailable
+
+    def set_environment(self, workspace=None, overwrite_output=None, scratch_workspace=None):
+        pass
+
+    def describe_spatial_reference(self, dataset):
+        return None
+
+    def create_feature_class(self, out_path, out_name, geometry_type, template, spatial_reference):
+        feature_class = os.path.join(out_path, out_name if out_name.lower().endswith('.shp') else out_name + '.shp')
+        open(feature_class, 'a').close()
+        return feature_class
+
+    def append(self, inputs, target):
+        return target
+
+    def convert_to_kml(self, feature_class, layer_name, kml_file):
+        with open(kml_file, 'w') as f:
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document><name>{layer_name}</name></Document></kml>\n')
+        return kml_file
+
+
+BACKENDS = {
+    'arcpy': ARCPY_BACKEND,
+    'simulated': SIMULATED_BACKEND,
+}
+
+
+def get_backend():
+    ''' Returns this process's geoprocessing backend, chosen by GP_BACKEND in the .env file (arcpy or simulated) '''
+    global BACKEND
+    if BACKEND is None:
+        backend_name = str(os.getenv('GP_BACKEND', 'arcpy')).strip().lower()
+        if backend_name not in BACKENDS:
+            raise ValueError(f"GP Backend: Unknown GP_BACKEND '{backend_name}', use one of {list(BACKENDS)}")
+        BACKEND = BACKENDS[backend_name]()
+    return BACKEND
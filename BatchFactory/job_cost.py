@@ -0,0 +1,267 @@
+###############################################################################################################################################################################
+#
+# Job Cost - estimates how long each job will take so the longest jobs can be started first
+#
+###############################################################################################################################################################################
+import os
+import csv
+import glob
+import heapq
+import logging
+import statistics
+from xml.etree import ElementTree
+
+from job_telemetry import SOURCE_FEATURE_LAYER_KEY
+
+
+def parse_kml_coordinates(text):
+    ''' Returns the (lon, lat) pairs of a KML <coordinates> element, "lon,lat[,alt]" tuples separated by whitespace '''
+    points = []
+    for point in (text or '').split():
+        values = point.split(',')
+        if len(values) >= 2:
+            points.append((float(values[0]), float(values[1])))
+    return points
+
+
+def measure_kml(kml_file):
+    '''
+    Returns {'vertices': int, 'area_km2': float} for a KML AOI. The KML is read directly rather than through GDAL, whose
+    KML driver often isn't available, so a KML job is measured before the AOI preparation converts it. Every coordinate
+    counts as a vertex, only polygons count towards the area.
+    '''
+    import geopandas
+    import shapely
+
+    vertices = 0
+    polygons = []
+    for element in ElementTree.parse(kml_file).getroot().iter():
+        tag = element.tag.split('}')[-1]
+        if tag == 'coordinates':
+            vertices += len(parse_kml_coordinates(element.text))
+        elif tag == 'Polygon':
+            rings = {'outerBoundaryIs': [], 'innerBoundaryIs': []}
+            for boundary in element:
+                boundary_tag = boundary.tag.split('}')[-1]
+                if boundary_tag in rings:
+                    for coordinates in boundary.iter():
+                        if coordinates.tag.split('}')[-1] == 'coordinates':
+                            rings[boundary_tag].append(parse_kml_coordinates(coordinates.text))
+            if rings['outerBoundaryIs'] and len(rings['outerBoundaryIs'][0]) >= 3:
+                holes = [ring for ring in rings['innerBoundaryIs'] if len(ring) >= 3]
+                polygons.append(shapely.Polygon(rings['outerBoundaryIs'][0], holes))
+
+    # KML is always WGS84 lat/long, the area is measured in BC Albers
+    area_km2 = float(geopandas.GeoSeries(polygons, crs=4326).to_crs(3005).area.sum()) / 1_000_000 if polygons else 0.0
+    return {'vertices': vertices, 'area_km2': area_km2}
+
+
+def measure_aoi(feature_layer):
+    '''
+    Returns {'vertices': int, 'area_km2': float} for the AOI in feature_layer, or None if it can't be read.
+    Handles shapefiles, KMLs and file geodatabase feature classes (folder.gdb/feature_class).
+    '''
+    if not feature_layer:
+        return None
+
+    try:
+        import geopandas
+        import shapely
+
+        feature_layer = str(feature_layer)
+        lower_path = feature_layer.lower()
+        if lower_path.endswith('.kml'):
+            return measure_kml(feature_layer)
+        if '.gdb' in lower_path and not lower_path.endswith('.gdb'):
+            gdb = feature_layer[:lower_path.index('.gdb') + 4]
+            layer = feature_layer[lower_path.index('.gdb') + 5:]
+            df = geopandas.read_file(gdb, layer=layer)
+        else:
+            df = geopandas.read_file(feature_layer)
+
+        if df.empty:
+            return {'vertices': 0, 'area_km2': 0.0}
+
+        vertices = int(shapely.get_num_coordinates(df.geometry.values).sum())
+
+        # Area has to be measured in a projected CRS, BC Albers if the AOI is in lat/long
+        if df.crs is None or df.crs.is_geographic:
+            df = df.set_crs(4326, allow_override=True) if df.crs is None else df
+            df = df.to_crs(3005)
+        area_km2 = float(df.geometry.area.sum()) / 1_000_000
+
+        return {'vertices': vertices, 'area_km2': area_km2}
+
+    except Exception:
+        return None
+
+
+def measure_aoi_files(feature_layer):
+    '''
+    Returns {'bytes': int} for the files that make up the AOI in feature_layer (the whole .gdb folder for a geodatabase
+    feature class), or None if they can't be found. Only stats the files, so a batch can be ordered without reading
+    every AOI off the share before the first job starts.
+    '''
+    if not feature_layer:
+        return None
+
+    feature_layer = str(feature_layer)
+    lower_path = feature_layer.lower()
+    try:
+        if '.gdb' in lower_path:
+            gdb = feature_layer[:lower_path.index('.gdb') + 4]
+            return {'bytes': sum(os.path.getsize(os.path.join(gdb, name)) for name in os.listdir(gdb))}
+        if lower_path.endswith('.shp'):
+            base = os.path.splitext(feature_layer)[0]
+            return {'bytes': sum(os.path.getsize(base + ext) for ext in ['.shp', '.shx', '.dbf'] if os.path.exists(base + ext))}
+        return {'bytes': os.path.getsize(feature_layer)}
+    except OSError:
+        return None
+
+
+def get_source_feature_layer(job):
+    ''' Returns the feature layer the job was queued with, before the AOI preparation or input staging replaced it '''
+    return str(job.get(SOURCE_FEATURE_LAYER_KEY) or job.get('feature_layer') or '')
+
+
+def load_recorded_durations(report_folder):
+    '''
+    Returns {source feature layer: [wall_seconds, ...]} for every successful job in the run reports written by earlier
+    batches. Reports written before the source_feature_layer column existed fall back to their feature_layer column.
+    '''
+    durations = {}
+    for report_file in glob.glob(os.path.join(report_folder, 'run_report_*.csv')):
+        with open(report_file, newline='') as f:
+            for row in csv.DictReader(f):
+                feature_layer = row.get('source_feature_layer') or row.get('feature_layer')
+                if row.get('status') == 'Success' and feature_layer and row.get('wall_seconds'):
+                    try:
+                        durations.setdefault(feature_layer, []).append(float(row['wall_seconds']))
+                    except ValueError:
+                        continue
+    return durations
+
+
+class COST_MODEL:
+    '''
+    Linear cost model: seconds = base + per_vertex * vertices + per_km2 * area_km2, or base + per_mb * MB for AOIs that
+    were only measured by file size. The defaults only need to rank jobs correctly, fit() replaces them with coefficients
+    from jobs that have recorded durations.
+    '''
+
+    # Minimum number of recorded jobs needed to fit the model
+    MIN_SAMPLES = 5
+
+    def __init__(self, base_seconds=600.0, seconds_per_vertex=0.05, seconds_per_km2=2.0, seconds_per_mb=2000.0) -> None:
+        self.base_seconds = base_seconds
+        self.seconds_per_vertex = seconds_per_vertex
+        self.seconds_per_km2 = seconds_per_km2
+        # Roughly seconds_per_vertex for the 20 to 30 bytes a vertex takes in a KML or shapefile
+        self.seconds_per_mb = seconds_per_mb
+
+    def features(self, measure):
+        ''' The model's inputs for a measure from measure_aoi or measure_aoi_files '''
+        if 'bytes' in measure:
+            return [1.0, measure['bytes'] / (1024 * 1024)]
+        return [1.0, measure['vertices'], measure['area_km2']]
+
+    def fit(self, samples):
+        ''' Fits the coefficients to samples of (measure, seconds), all measured the same way. Returns True if the model was fitted '''
+        if len(samples) < self.MIN_SAMPLES:
+            return False
+        try:
+            import numpy
+            x = numpy.array([self.features(measure) for measure, _ in samples])
+            y = numpy.array([seconds for _, seconds in samples])
+            coefficients = [float(c) for c in numpy.linalg.lstsq(x, y, rcond=None)[0]]
+        except Exception:
+            return False
+
+        # Negative coefficients come from noisy history and would reward big AOIs, keep the defaults for those
+        self.base_seconds = max(coefficients[0], 0.0)
+        if len(coefficients) == 2:
+            if coefficients[1] > 0:
+                self.seconds_per_mb = coefficients[1]
+            return True
+        if coefficients[1] > 0:
+            self.seconds_per_vertex = coefficients[1]
+        if coefficients[2] > 0:
+            self.seconds_per_km2 = coefficients[2]
+        return True
+
+    def estimate(self, measure):
+        if not measure:
+            return None
+        if 'bytes' in measure:
+            return self.base_seconds + self.seconds_per_mb * measure['bytes'] / (1024 * 1024)
+        return self.base_seconds + self.seconds_per_vertex * measure['vertices'] + self.seconds_per_km2 * measure['area_km2']
+
+
+def estimate_job_costs(jobs, report_folder=None, logger=None, measure=measure_aoi):
+    '''
+    Returns {job_index: estimated seconds} for the (job_index, job) pairs in jobs. A job whose source feature layer has a
+    recorded duration uses the median of those, the rest use the cost model fitted to the recorded jobs. Jobs whose AOI can't be
+    read get the median estimate so they land in the middle of the queue. measure is measure_aoi (reads the geometry) or
+    measure_aoi_files (file sizes only, for ordering a batch that is about to start).
+    '''
+    logger = logger or logging.getLogger(__name__)
+    recorded = load_recorded_durations(report_folder) if report_folder and os.path.isdir(report_folder) else {}
+
+    measures = {job_index: measure(get_source_feature_layer(job)) for job_index, job in jobs}
+
+    model = COST_MODEL()
+    samples = []
+    for job_index, job in jobs:
+        history = recorded.get(get_source_feature_layer(job))
+        if history and measures[job_index]:
+            samples.append((measures[job_index], statistics.median(history)))
+    if model.fit(samples):
+        logger.info(f"Job Cost: Cost model fitted to {len(samples)} recorded jobs: base {model.base_seconds:.1f}s, "
+                    f"{model.seconds_per_vertex:.4f}s/vertex, {model.seconds_per_km2:.4f}s/km2, {model.seconds_per_mb:.1f}s/MB")
+
+    costs = {}
+    for job_index, job in jobs:
+        history = recorded.get(get_source_feature_layer(job))
+        costs[job_index] = statistics.median(history) if history else model.estimate(measures[job_index])
+
+    known = [cost for cost in costs.values() if cost is not None]
+    fallback = statistics.median(known) if known else model.base_seconds
+    for job_index in costs:
+        if costs[job_index] is None:
+            costs[job_index] = fallback
+
+    return costs
+
+
+def get_priority(job, priority_column):
+    ''' Returns the job's priority from the priority column as a number. Blank or non-numeric priorities are 0 '''
+    try:
+        return float(job.get(priority_column) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def order_jobs(jobs, costs, priority_column='priority'):
+    ''' Orders (job_index, job) pairs by priority (highest first), then by estimated cost (longest first) '''
+    return sorted(jobs, key=lambda pair: (-get_priority(pair[1], priority_column), -costs.get(pair[0], 0)))
+
+
+def simulate_makespan(durations, workers):
+    ''' Returns the total runtime of running durations, in the given order, on a pool of workers that each take the next job when free '''
+    if not durations:
+        return 0.0
+    worker_free_at = [0.0] * max(1, workers)
+    for duration in durations:
+        start = heapq.heappop(worker_free_at)
+        heapq.heappush(worker_free_at, start + duration)
+    return max(worker_free_at)
+
+
+def evaluate_ordering(jobs, costs, recorded_durations, workers, priority_column='priority'):
+    '''
+    Compares the makespan of running jobs in row order against the cost order, using recorded durations
+    ({job_index: seconds}) from a previous run. Returns {'row_order': seconds, 'cost_order': seconds}.
+    '''
+    row_order = [recorded_durations[job_index] for job_index, _ in jobs if job_index in recorded_durations]
+    cost_order = [recorded_durations[job_index] for job_index, _ in order_jobs(jobs, costs, priority_column) if job_index in recorded_durations]
+    return {'row_order': simulate_makespan(row_order, workers), 'cost_order': simulate_makespan(cost_order, workers)}
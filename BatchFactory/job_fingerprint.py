@@ -0,0 +1,79 @@
+###############################################################################################################################################################################
+#
+# Job Fingerprint - hashes a job's inputs so unchanged jobs that already have outputs can be skipped on a re-run
+#
+###############################################################################################################################################################################
+import os
+import json
+import hashlib
+
+from job_ledger import get_job_parameters
+
+# A shapefile is several files, any of them changing changes the AOI
+SHAPEFILE_SIDECARS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# Read files in 1 MB chunks so large inputs aren't loaded into memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    ''' Returns the sha256 hash of a file's contents '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_fingerprint(path):
+    '''
+    Returns a list of [path, mtime, size, sha256] for the files that make up an input. Shapefiles include their sidecar
+    files, file geodatabase feature classes (folder.gdb/feature_class) use the mtime and size of every file in the .gdb
+    folder since the feature class can't be hashed on its own.
+    '''
+    if not path:
+        return []
+
+    path = str(path)
+    lower_path = path.lower()
+
+    if lower_path.endswith('.shp'):
+        base = os.path.splitext(path)[0]
+        files = [base + ext for ext in SHAPEFILE_SIDECARS if os.path.exists(base + ext)]
+        return [[f, os.path.getmtime(f), os.path.getsize(f), hash_file(f)] for f in files]
+
+    if '.gdb' in lower_path:
+        gdb = path[:lower_path.index('.gdb') + 4]
+        if os.path.isdir(gdb):
+            fingerprint = []
+            for name in sorted(os.listdir(gdb)):
+                f = os.path.join(gdb, name)
+                if os.path.isfile(f):
+                    fingerprint.append([f, os.path.getmtime(f), os.path.getsize(f), None])
+            return fingerprint
+        return [[path, None, None, None]]
+
+    if os.path.isfile(path):
+        return [[path, os.path.getmtime(path), os.path.getsize(path), hash_file(path)]]
+
+    # The input doesn't exist (or is a database path), only the path itself is part of the fingerprint
+    return [[path, None, None, None]]
+
+
+def fingerprint_job(job, parameter_names):
+    '''
+    Returns a sha256 fingerprint of the parameter values plus the mtime, size and hash of the job's feature_layer. The
+    columns the batch rewrites itself are left out, the same as the ledger key, so a requeued job keeps its fingerprint.
+    '''
+    values = get_job_parameters(job, parameter_names)
+    feature_layer = file_fingerprint(job.get('feature_layer'))
+    fingerprint = json.dumps({'parameters': values, 'feature_layer': feature_layer}, sort_keys=True, default=str)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+def outputs_exist(job):
+    ''' Returns True if the job's output_directory exists and has something in it '''
+    output_directory = job.get('output_directory')
+    if not output_directory or not os.path.isdir(str(output_directory)):
+        return False
+    return len(os.listdir(str(output_directory))) > 0
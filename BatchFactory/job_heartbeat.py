@@ -0,0 +1,54 @@
+###############################################################################################################################################################################
+#
+# Job Heartbeat - a worker's last sign of progress, shared with the parent so a hung job is killed long before the job timeout
+#
+###############################################################################################################################################################################
+import time
+import threading
+import multiprocessing as mp
+
+# Longest stage name kept in the shared buffer
+STAGE_LENGTH = 64
+
+
+class JOB_HEARTBEAT:
+    '''
+    Shared memory the worker updates at every stage boundary and whenever the tool adds a message. The parent reads it to
+    see how long the job has gone without progress and which stage it was in. Passed to the worker process as an argument.
+    '''
+
+    def __init__(self) -> None:
+        self.last_progress = mp.Value('d', time.time())
+        self.stage = mp.Array('c', STAGE_LENGTH)
+
+    def beat(self, stage=None):
+        ''' Records progress now, and the stage the job is in if it changed '''
+        with self.last_progress.get_lock():
+            self.last_progress.value = time.time()
+            if stage is not None:
+                self.stage.value = str(stage).encode('utf-8')[:STAGE_LENGTH - 1]
+
+    def seconds_since_progress(self):
+        return time.time() - self.last_progress.value
+
+    def current_stage(self):
+        return self.stage.value.decode('utf-8', errors='replace')
+
+
+def watch_tool_messages(backend, heartbeat, poll_seconds):
+    '''
+    Starts a thread that beats the heartbeat whenever the running tool's message count changes. A tool that keeps
+    writing messages is making progress even if one stage takes hours. Returns the event that stops the thread.
+    '''
+    stop = threading.Event()
+
+    def watch():
+        last_count = backend.get_message_count()
+        while not stop.wait(poll_seconds):
+            count = backend.get_message_count()
+            if count != last_count:
+                last_count = count
+                heartbeat.beat('run_tool')
+
+    threading.Thread(target=watch, name='tool_message_watch', daemon=True).start()
+    return stop
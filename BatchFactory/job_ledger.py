@@ -0,0 +1,203 @@
+###############################################################################################################################################################################
+#
+# Job Ledger - local SQLite record of every job's state, attempts, timings, worker pid and error
+#
+###############################################################################################################################################################################
+import json
+import time
+import sqlite3
+import threading
+import hashlib
+import logging
+
+
+# Columns the batch writes itself (BATCH_FACTORY.BATCH_CONDITION_COLUMN, DONT_OVERWRITE_OUTPUTS and PRIORITY_COLUMN). A
+# requeued job has dont_overwrite_outputs switched on by the scheduler, that is not an edit of the row
+SYSTEM_MANAGED_COLUMNS = ['batch_condition', 'dont_overwrite_outputs', 'priority']
+
+
+def get_job_parameters(job, parameter_names):
+    ''' Returns {name: value} of the job's parameters that identify it, leaving out the system managed and _ prefixed keys '''
+    return {name: job.get(name) for name in parameter_names
+            if str(name).lower() not in SYSTEM_MANAGED_COLUMNS and not str(name).startswith('_')}
+
+
+def hash_job_parameters(job, parameter_names):
+    ''' Returns a sha256 hash of the job's parameter values so a row that is edited in the queuefile is treated as a new job '''
+    values = get_job_parameters(job, parameter_names)
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class JOB_LEDGER:
+    '''
+    The ledger is the record of job state for a queuefile. Each job is keyed by its job index (Excel row - 2) and the
+    hash of its parameters. The queuefile's batch_condition column is written from the ledger by the status writer.
+    '''
+
+    # States that end a job attempt
+    FINISHED_STATES = ['COMPLETE', 'Failed', 'Unknown Error']
+
+    def __init__(self, ledger_file, logger=None) -> None:
+        self.ledger_file = ledger_file
+        self.logger = logger or logging.getLogger(__name__)
+
+        # job index -> parameter hash of the job that is currently loaded for that row
+        self.current_hashes = {}
+        self.conn = None
+        # The scheduler, the AOI preparation threads and the status writer's timer all use the one connection. Every
+        # method holds the lock so a statement and its commit aren't interleaved with another thread's
+        self.lock = threading.RLock()
+        self.connect()
+
+    def __getstate__(self):
+        # sqlite connections and locks can't be sent to worker processes. The ledger is only used by the parent process
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def connect(self):
+        ''' Opens the ledger database and creates the jobs table if it doesn't exist '''
+        with self.lock:
+            if self.conn is not None:
+                return self.conn
+
+            self.conn = sqlite3.connect(self.ledger_file, timeout=30, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_index INTEGER NOT NULL,
+                    params_hash TEXT NOT NULL,
+                    state TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    queued_at REAL,
+                    started_at REAL,
+                    finished_at REAL,
+                    duration_seconds REAL,
+                    worker_pid INTEGER,
+                    error TEXT,
+                    input_fingerprint TEXT,
+                    bcgw_instance TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (job_index, params_hash)
+                )''')
+
+            # Ledgers created before input fingerprints and BCGW instances were recorded don't have the columns
+            columns = [row['name'] for row in self.conn.execute('PRAGMA table_info(jobs)')]
+            for column in ['input_fingerprint', 'bcgw_instance']:
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} TEXT')
+            self.conn.commit()
+            self.logger.info(f"Job Ledger - Using ledger {self.ledger_file}")
+            return self.conn
+
+    def register(self, job_index, params_hash):
+        ''' Adds the job to the ledger if it's new and returns its ledger record as a dictionary '''
+        with self.lock:
+            conn = self.connect()
+            self.current_hashes[job_index] = params_hash
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO jobs (job_index, params_hash, state, updated_at) VALUES (?, ?, ?, ?)',
+                             (job_index, params_hash, None, time.time()))
+            return self.get(job_index)
+
+    def get(self, job_index):
+        ''' Returns the ledger record of the currently loaded job at job_index, or None '''
+        with self.lock:
+            params_hash = self.current_hashes.get(job_index)
+            if params_hash is None:
+                return None
+            row = self.connect().execute('SELECT * FROM jobs WHERE job_index = ? AND params_hash = ?', (job_index, params_hash)).fetchone()
+            return dict(row) if row else None
+
+    def lookup(self, job_index, params_hash):
+        ''' Returns the ledger record of the job at job_index with params_hash without registering it, or None '''
+        with self.lock:
+            row = self.connect().execute('SELECT * FROM jobs WHERE job_index = ? AND params_hash = ?', (job_index, params_hash)).fetchone()
+            return dict(row) if row else None
+
+    def set_state(self, job_index, state, error=None):
+        ''' Records a new state for the job. Finished states also record the finish time and duration of the attempt '''
+        with self.lock:
+            params_hash = self.current_hashes.get(job_index)
+            if params_hash is None:
+                self.logger.warning(f"Job Ledger - Job {job_index} is not registered, state '{state}' not recorded")
+                return
+
+            # Re-recording the same finished state (e.g. re loading a COMPLETE row) keeps the original timings
+            record = self.get(job_index)
+            if record and record['state'] == state and error is None:
+                return
+
+            now = time.time()
+            conn = self.connect()
+            with conn:
+                if state in self.FINISHED_STATES:
+                    conn.execute('''UPDATE jobs SET state = ?, error = ?, finished_at = ?,
+                                    duration_seconds = CASE WHEN started_at IS NULL THEN NULL ELSE ? - started_at END,
+                                    updated_at = ? WHERE job_index = ? AND params_hash = ?''',
+                                 (state, error, now, now, now, job_index, params_hash))
+                elif state in ['Queued', 'Requeued']:
+                    conn.execute('UPDATE jobs SET state = ?, queued_at = ?, updated_at = ? WHERE job_index = ? AND params_hash = ?',
+                                 (state, now, now, job_index, params_hash))
+                else:
+                    conn.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE job_index = ? AND params_hash = ?',
+                                 (state, now, job_index, params_hash))
+
+    def mark_started(self, job_index, worker_pid=None, bcgw_instance=None):
+        ''' Records the start of a new attempt at the job and the BCGW instance the attempt connects to '''
+        with self.lock:
+            params_hash = self.current_hashes.get(job_index)
+            if params_hash is None:
+                return
+
+            now = time.time()
+            conn = self.connect()
+            with conn:
+                conn.execute('''UPDATE jobs SET state = 'Running', attempts = attempts + 1, started_at = ?, finished_at = NULL,
+                                duration_seconds = NULL, worker_pid = ?, bcgw_instance = ?, error = NULL, updated_at = ?
+                                WHERE job_index = ? AND params_hash = ?''',
+                             (now, worker_pid, bcgw_instance, now, job_index, params_hash))
+
+    def set_fingerprint(self, job_index, input_fingerprint):
+        ''' Records the fingerprint of the inputs the job is about to run with '''
+        with self.lock:
+            params_hash = self.current_hashes.get(job_index)
+            if params_hash is None:
+                return
+
+            conn = self.connect()
+            with conn:
+                conn.execute('UPDATE jobs SET input_fingerprint = ?, updated_at = ? WHERE job_index = ? AND params_hash = ?',
+                             (input_fingerprint, time.time(), job_index, params_hash))
+
+    def jobs_in_state(self, states):
+        ''' Returns the job indexes of the loaded jobs whose ledger state is one of states '''
+        with self.lock:
+            job_indexes = []
+            for job_index in sorted(self.current_hashes):
+                record = self.get(job_index)
+                if record and record['state'] in states:
+                    job_indexes.append(job_index)
+            return job_indexes
+
+    def loaded_states(self):
+        ''' Returns {job_index: state} for every loaded job that has a state '''
+        with self.lock:
+            states = {}
+            for job_index in sorted(self.current_hashes):
+                record = self.get(job_index)
+                if record and record['state']:
+                    states[job_index] = record['state']
+            return states
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
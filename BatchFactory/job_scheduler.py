@@ -0,0 +1,700 @@
+###############################################################################################################################################################################
+#
+# Job Scheduler - runs the queued jobs on a fixed number of worker processes
+#
+###############################################################################################################################################################################
+import os
+import time
+import heapq
+import logging
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+from mp_worker import process_job_mp, warm_worker_mp
+from retry_policy import RETRY_POLICY
+from env_config import get_env_number
+from job_heartbeat import JOB_HEARTBEAT
+from worker_scratch import copy_outputs_back
+from logging_setup import get_log_queue
+
+
+def get_max_workers(logger=None):
+    ''' Returns the number of worker processes to run at once. Uses MAX_WORKERS from the .env file, or the CPU count if it is not set '''
+    logger = logger or logging.getLogger(__name__)
+
+    max_workers = os.getenv('MAX_WORKERS')
+    if max_workers:
+        try:
+            max_workers = int(max_workers)
+            if max_workers > 0:
+                return max_workers
+        except ValueError:
+            pass
+        print(f"Job Scheduler: MAX_WORKERS '{max_workers}' is not a positive number, using the CPU count")
+        logger.warning(f"Job Scheduler: MAX_WORKERS '{max_workers}' is not a positive number, using the CPU count")
+
+    return mp.cpu_count() or 1
+
+
+def get_worker_mode():
+    ''' Returns the WORKER_MODE from the .env file. 'warm' keeps workers alive between jobs, 'spawn' starts a new process per job '''
+    worker_mode = (os.getenv('WORKER_MODE') or 'spawn').strip().lower()
+    return worker_mode if worker_mode in ['warm', 'spawn'] else 'spawn'
+
+
+class JOB_SCHEDULER:
+    ''' Job scheduler pulls jobs from a queue and keeps at most max_workers workers running at one time '''
+
+    # How often the monitor checks for finished uploads while there are some
+    UPLOAD_POLL_SECONDS = 1
+
+    def __init__(self, batch_factory_instance, max_workers, job_timeout, logger=None, worker_mode='spawn', retry_policy=None, job_source=None,
+                 no_progress_seconds=None, connection_broker=None, control=None, progress=None, output_planner=None,
+                 uploader=None) -> None:
+        self.batch_factory = batch_factory_instance
+        self.max_workers = max_workers
+        self.job_timeout = job_timeout
+
+        # A job whose worker hasn't beaten its heartbeat (new stage or new tool message) for this long is treated as hung
+        # and killed, long before the job timeout. Needs to be longer than the slowest silent stage, e.g. the toolbox import
+        # 0 turns hang detection off. It relies on arcpy's message count moving while a tool runs, which is not yet
+        # confirmed on ArcGIS Pro, so it is off until it has been checked there
+        self.no_progress_seconds = no_progress_seconds if no_progress_seconds is not None else get_env_number('NO_PROGRESS_SECONDS', 0, float)
+        self.logger = logger or logging.getLogger(__name__)
+        self.worker_mode = worker_mode
+        self.retry_policy = retry_policy or RETRY_POLICY()
+
+        # Optional source of more jobs (e.g. the shared queue), asked for one job whenever a worker is free and the queue is empty.
+        # It needs claim(count), has_more() and poll_seconds
+        self.job_source = job_source
+
+        # Optional CONNECTION_BROKER, a job only starts when the broker has a healthy BCGW connection and a free session for it
+        self.connection_broker = connection_broker
+
+        # Optional BATCH_CONTROL. 'pause' stops new jobs starting, 'drain' ends the batch once the running jobs finish and
+        # 'cancel' terminates the running jobs and requeues them. Ctrl+C is treated as a cancel
+        self.control = control
+        self.paused = False
+        self.stop_reason = None
+
+        # Optional BATCH_PROGRESS, told about every job start and condition change for the status page
+        self.progress = progress
+
+        # Optional OUTPUT_PLANNER, a job waits in the queue while another running job writes to its output folder
+        self.output_planner = output_planner
+
+        # Optional OUTPUT_UPLOADER for outputs the workers staged locally. A job's result is recorded (and its output
+        # folder released) once its outputs are on the share, the worker goes on to its next job in the meantime
+        self.uploader = uploader
+
+        # Jobs waiting for a worker, failed jobs waiting out their backoff (ready_time, job_index) and attempts made this batch
+        self.job_queue = deque()
+        self.retry_queue = []
+        self.jobs_by_index = {}
+        self.attempts = {}
+        # job_index -> BCGW instance the connection broker started the job's current attempt on
+        self.bcgw_instances = {}
+
+        # Counters for the end of batch summary
+        self.success_counter = 0
+        self.timeout_failed_counter = 0
+        self.worker_failed_counter = 0
+        self.other_exception_failed_counter = 0
+        self.hung_failed_counter = 0
+        self.cancelled_counter = 0
+        self.retried_counter = 0
+
+        # Startup cost (toolbox import) and job cost are kept apart so the two worker modes can be compared
+        self.startup_seconds = []
+        self.job_seconds = []
+
+    def run(self, jobs):
+        ''' Runs every (job_index, job) pair in jobs with the scheduler's worker mode '''
+        batch_start = time.time()
+
+        self.job_queue = deque(jobs)
+        self.jobs_by_index = {job_index: job for job_index, job in jobs}
+
+        # A drain or cancel left behind by an earlier batch doesn't stop this one
+        if self.control is not None and self.control.owner and self.control.read() in ['drain', 'cancel']:
+            print(f"Job Scheduler: Ignoring the '{self.control.command}' left in {self.control.control_file} by an earlier batch")
+            self.logger.warning(f"Job Scheduler: Ignoring the '{self.control.command}' left in {self.control.control_file} by an earlier batch")
+            self.control.clear()
+
+        more = ', more from the job source' if self.job_source is not None else ''
+        self.logger.info(f"Job Scheduler: {len(jobs)} jobs queued{more} for {self.max_workers} {self.worker_mode} workers")
+        print(f"Job Scheduler: {len(jobs)} jobs queued{more} for {self.max_workers} {self.worker_mode} workers")
+
+        if self.progress is not None:
+            self.progress.start()
+        try:
+            if self.worker_mode == 'warm':
+                self.run_warm_workers()
+            else:
+                self.run_spawn_workers()
+            # A cancel doesn't stop the uploads that have started, the outputs of finished jobs still reach the share
+            self.collect_uploads(wait=True)
+        finally:
+            if self.progress is not None:
+                self.progress.stop()
+
+        if self.stop_reason is not None:
+            self.release_waiting_jobs()
+            if self.control is not None:
+                self.control.clear()
+            print(f"Job Scheduler: Batch stopped by {self.stop_reason}, run main.py again to carry on with the jobs that aren't COMPLETE")
+            self.logger.warning(f"Job Scheduler: Batch stopped by {self.stop_reason}, {self.cancelled_counter} running jobs were requeued")
+
+        self.logger.info(f"Job Scheduler: Complete. Success: {self.success_counter}, Timed out: {self.timeout_failed_counter}, "
+                         f"Worker failed: {self.worker_failed_counter}, Hung: {self.hung_failed_counter}, Unknown: {self.other_exception_failed_counter}, "
+                         f"Cancelled: {self.cancelled_counter}, Retries: {self.retried_counter}")
+        print(f"Job Scheduler: Complete. Success: {self.success_counter}, Timed out: {self.timeout_failed_counter}, "
+              f"Worker failed: {self.worker_failed_counter}, Hung: {self.hung_failed_counter}, Unknown: {self.other_exception_failed_counter}, "
+              f"Cancelled: {self.cancelled_counter}, Retries: {self.retried_counter}")
+        self.log_cost_summary(time.time() - batch_start)
+
+    def has_waiting_jobs(self):
+        ''' True while there are jobs in the queue, failed jobs waiting to be retried or jobs the job source may still hand out '''
+        if self.job_queue or self.retry_queue:
+            return True
+        return self.job_source is not None and self.job_source.has_more()
+
+    def release_retries(self):
+        ''' Moves the retries whose backoff has passed to the front of the job queue '''
+        while self.retry_queue and self.retry_queue[0][0] <= time.time():
+            _, job_index = heapq.heappop(self.retry_queue)
+            self.job_queue.appendleft((job_index, self.jobs_by_index[job_index]))
+
+    def seconds_until_next_retry(self):
+        ''' Seconds until the next retry is due, or None if there are no retries waiting '''
+        if not self.retry_queue:
+            return None
+        return max(0, self.retry_queue[0][0] - time.time())
+
+    def check_control(self):
+        ''' Reads the control file and returns True while new jobs may start. A drain can still become a cancel, neither can be undone '''
+        if self.control is None or self.stop_reason == 'cancel':
+            return self.stop_reason is None
+
+        command = self.control.read()
+        if command in ['drain', 'cancel'] and self.stop_reason != command:
+            self.stop_reason = command
+            print(f"Job Scheduler: {command.capitalize()} requested, no new jobs will start")
+            self.logger.warning(f"Job Scheduler: {command.capitalize()} requested through {self.control.control_file}, no new jobs will start")
+
+        paused = command == 'pause'
+        if paused != self.paused:
+            self.paused = paused
+            print(f"Job Scheduler: {'Paused, running jobs carry on' if paused else 'Resumed'}")
+            self.logger.info(f"Job Scheduler: {'Paused, running jobs carry on' if paused else 'Resumed'}")
+
+        return self.stop_reason is None and not self.paused
+
+    def interrupt(self):
+        ''' Ctrl+C: cancel the batch the same way a cancel command does '''
+        print("Job Scheduler: Interrupted, cancelling the batch")
+        self.logger.warning("Job Scheduler: Interrupted (Ctrl+C), cancelling the batch")
+        self.stop_reason = 'cancel'
+
+    def keep_running(self, busy):
+        '''
+        True while the monitor should keep going: jobs are running, uploading or waiting, only running or uploading jobs once
+        draining, nothing once cancelled. Records the jobs whose uploads have finished.
+        '''
+        self.collect_uploads()
+        busy = busy or (self.uploader is not None and self.uploader.pending() > 0)
+        self.check_control()
+        if self.stop_reason == 'cancel':
+            return False
+        if self.stop_reason == 'drain':
+            return busy
+        return busy or self.has_waiting_jobs()
+
+    def can_dispatch(self):
+        ''' True if another job can start: the batch isn't paused or stopping and the connection broker (if any) has a BCGW session for it '''
+        if not self.check_control():
+            return False
+        return self.connection_broker is None or self.connection_broker.has_free_session()
+
+    def find_free_job(self):
+        ''' Returns the position of the first queued job whose output folder isn't in use by a running job, or None '''
+        for position, (job_index, job) in enumerate(self.job_queue):
+            if self.output_planner is None or self.output_planner.is_free(job):
+                return position
+        return None
+
+    def next_job(self):
+        ''' Returns the next (job_index, job) to run, or None if nothing is ready. Jobs held back by a shared output folder keep their place '''
+        self.release_retries()
+        position = self.find_free_job()
+        if position is None and self.job_source is not None:
+            for job_index, job in self.job_source.claim(1):
+                self.jobs_by_index[job_index] = job
+                self.job_queue.append((job_index, job))
+            position = self.find_free_job()
+        if position is None:
+            return None
+        job_index, job = self.job_queue[position]
+        del self.job_queue[position]
+        self.attempts[job_index] = self.attempts.get(job_index, 0) + 1
+        if self.connection_broker is not None:
+            self.bcgw_instances[job_index] = self.connection_broker.acquire(job_index)
+        if self.output_planner is not None:
+            self.output_planner.acquire(job_index, job)
+        return job_index, job
+
+    def release_job(self, job_index):
+        ''' Gives back the BCGW session and the output folder of a job that has stopped running '''
+        if self.connection_broker is not None:
+            self.connection_broker.release(job_index)
+        if self.output_planner is not None:
+            self.output_planner.release(job_index)
+
+    def seconds_until_next_event(self, start_times, heartbeats=()):
+        '''
+        Seconds the monitor can wait before it has to wake up by itself: the nearest job deadline (each job's own start
+        time plus the job timeout), the nearest no progress deadline (each heartbeat's last beat plus no_progress_seconds)
+        or the next retry, whichever comes first. None means wait until a worker finishes.
+        '''
+        waits = [max(0, start_time + self.job_timeout - time.time()) for start_time in start_times]
+        if self.no_progress_seconds > 0:
+            waits += [max(0, self.no_progress_seconds - heartbeat.seconds_since_progress()) for heartbeat in heartbeats]
+        retry_wait = self.seconds_until_next_retry()
+        if retry_wait is not None:
+            waits.append(retry_wait)
+        # Check the job source again for jobs other nodes haven't claimed or have let expire
+        if self.job_source is not None:
+            waits.append(self.job_source.poll_seconds)
+        # Jobs are held while the BCGW is unreachable, try again at the next health check
+        if self.connection_broker is not None and not self.connection_broker.healthy:
+            waits.append(self.connection_broker.seconds_until_health_check())
+        # Look for a new command in the control file
+        if self.control is not None:
+            waits.append(self.control.poll_seconds)
+        # Record the uploads as they finish
+        if self.uploader is not None and self.uploader.pending() > 0:
+            waits.append(self.UPLOAD_POLL_SECONDS)
+        return min(waits) if waits else None
+
+    def run_spawn_workers(self):
+        '''
+        Starts a new process_job_mp process for every job. The monitor waits on every running worker at once and handles
+        each one as soon as it finishes, so a free slot is refilled straight away. Each job's timeout is counted from its
+        own start time.
+        '''
+        running = {}  # process sentinel -> (process, job_index, start_time, heartbeat)
+
+        manager = mp.Manager()
+        return_dict = manager.dict()
+
+        while self.keep_running(bool(running)):
+
+            # Fill every free worker slot with the next job in the queue
+            while len(running) < self.max_workers and self.can_dispatch():
+                next_job = self.next_job()
+                if next_job is None:
+                    break
+                job_index, job = next_job
+                heartbeat = JOB_HEARTBEAT()
+                p = mp.Process(target=process_job_mp, args=(self.batch_factory, job, job_index, self.batch_factory.current_path, return_dict, get_log_queue(), heartbeat))
+                p.start()
+                self.batch_factory.ledger.mark_started(job_index, p.pid, self.bcgw_instances.get(job_index))
+                running[p.sentinel] = (p, job_index, time.time(), heartbeat)
+                self.report_started(job_index, heartbeat)
+                self.logger.info(f"Job Scheduler: {job.get(self.batch_factory.BATCH_CONDITION_COLUMN)} Job {job_index}.....Multiproccessing started......")
+                print(f"Job Scheduler: Job {job_index} started ({len(running)}/{self.max_workers} workers busy)")
+
+            # Only retries waiting out their backoff (or jobs the job source can't hand out yet) are left
+            if not running:
+                try:
+                    time.sleep(self.seconds_until_next_event([]) or 0)
+                except KeyboardInterrupt:
+                    self.interrupt()
+                continue
+
+            # Wait until any worker finishes, a job reaches its deadline or stops making progress, or a retry is due
+            try:
+                finished = wait(list(running), timeout=self.seconds_until_next_event([start for _, _, start, _ in running.values()],
+                                                                                     [heartbeat for _, _, _, heartbeat in running.values()]))
+            except KeyboardInterrupt:
+                self.interrupt()
+                finished = []
+
+            for sentinel in finished:
+                process, job_index, start_time, heartbeat = running.pop(sentinel)
+                process.join()
+                self.record_result(job_index, return_dict.get(job_index))
+
+            # If a process exceeds its timeout, or its heartbeat has gone quiet, terminate the process and mark the job as failed
+            for sentinel, (process, job_index, start_time, heartbeat) in list(running.items()):
+                timed_out = time.time() - start_time >= self.job_timeout
+                hung = self.is_hung(heartbeat)
+                if timed_out or hung:
+                    running.pop(sentinel)
+                    process.terminate()
+                    process.join()
+                    if timed_out:
+                        self.record_result(job_index, None, timed_out=True)
+                    else:
+                        self.record_no_progress(job_index, heartbeat)
+
+        # Cancelled: terminate what is still running. A job that finished just before it was terminated keeps its result
+        for sentinel, (process, job_index, start_time, heartbeat) in list(running.items()):
+            process.terminate()
+            process.join()
+            try:
+                result = return_dict.get(job_index)
+            except Exception:
+                # Ctrl+C reaches the manager process too
+                result = None
+            if result is not None:
+                self.record_result(job_index, result)
+            else:
+                self.requeue_cancelled(job_index)
+
+        manager.shutdown()
+
+    def start_warm_worker(self, worker_id):
+        ''' Starts a warm worker with its own task queue, a pipe for it to send results back on and a heartbeat '''
+        task_queue = mp.Queue()
+        result_conn, worker_conn = mp.Pipe(duplex=False)
+        heartbeat = JOB_HEARTBEAT()
+        p = mp.Process(target=warm_worker_mp, args=(self.batch_factory, worker_id, self.batch_factory.current_path, task_queue, worker_conn, get_log_queue(), heartbeat))
+        p.start()
+        # Only the worker writes to its end of the pipe
+        worker_conn.close()
+        self.logger.info(f"Job Scheduler: Warm worker {worker_id} started (pid {p.pid})")
+        print(f"Job Scheduler: Warm worker {worker_id} started")
+        return {'process': p, 'task_queue': task_queue, 'conn': result_conn, 'heartbeat': heartbeat, 'ready': False, 'job_index': None, 'start_time': None}
+
+    def stop_warm_worker(self, workers, worker_id):
+        ''' Terminates a warm worker and removes it from the pool. Returns the job it was running, or None '''
+        worker = workers.pop(worker_id)
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+        worker['process'].join()
+        worker['conn'].close()
+        return worker['job_index']
+
+    def handle_warm_message(self, workers, message):
+        ''' Handles a 'ready' or 'done' message from a warm worker '''
+        if message[0] == 'ready':
+            _, worker_id, startup_seconds, error = message
+            self.startup_seconds.append(startup_seconds)
+            if error:
+                # The worker couldn't import the toolbox, so it has exited and won't take jobs
+                print(f"Job Scheduler: Warm worker {worker_id} failed to start: {error}")
+                self.logger.error(f"Job Scheduler: Warm worker {worker_id} failed to start: {error}")
+                self.stop_warm_worker(workers, worker_id)
+            else:
+                workers[worker_id]['ready'] = True
+                self.logger.info(f"Job Scheduler: Warm worker {worker_id} ready after {startup_seconds:.1f} seconds")
+
+        elif message[0] == 'done':
+            _, worker_id, job_index, result = message
+            if worker_id in workers and workers[worker_id]['job_index'] == job_index:
+                workers[worker_id]['job_index'] = None
+                workers[worker_id]['start_time'] = None
+                self.record_result(job_index, result)
+
+    def run_warm_workers(self):
+        '''
+        Starts max_workers long lived workers that import the toolbox once, then hands each idle worker the next job.
+        The monitor waits on every worker's result pipe and process at once, so results are recorded and idle workers
+        get a new job the moment a job finishes. A worker that runs past its job's timeout, or dies, is replaced with a
+        fresh worker.
+        '''
+        next_worker_id = 0
+        workers = {}
+
+        # With a job source the number of jobs isn't known up front, so start the full pool
+        pool_size = self.max_workers if self.job_source is not None else min(self.max_workers, len(self.job_queue))
+        for _ in range(pool_size):
+            workers[next_worker_id] = self.start_warm_worker(next_worker_id)
+            next_worker_id += 1
+
+        while workers and self.keep_running(any(w['job_index'] is not None for w in workers.values())):
+
+            # Hand the next job to every worker that has imported the toolbox and is idle
+            for worker_id, worker in workers.items():
+                if worker['ready'] and worker['job_index'] is None:
+                    if not self.can_dispatch():
+                        break
+                    next_job = self.next_job()
+                    if next_job is None:
+                        break
+                    job_index, job = next_job
+                    # The time the worker sat idle isn't counted against the job
+                    worker['heartbeat'].beat('queued')
+                    worker['task_queue'].put((job_index, job))
+                    self.batch_factory.ledger.mark_started(job_index, worker['process'].pid, self.bcgw_instances.get(job_index))
+                    worker['job_index'] = job_index
+                    worker['start_time'] = time.time()
+                    self.report_started(job_index, worker['heartbeat'])
+                    self.logger.info(f"Job Scheduler: {job.get(self.batch_factory.BATCH_CONDITION_COLUMN)} Job {job_index} sent to warm worker {worker_id}")
+                    print(f"Job Scheduler: Job {job_index} sent to warm worker {worker_id}")
+
+            # Wait until a worker sends a message or dies, a job reaches its deadline or stops making progress, or a retry is due
+            connections = {worker['conn']: worker_id for worker_id, worker in workers.items()}
+            sentinels = {worker['process'].sentinel: worker_id for worker_id, worker in workers.items()}
+            start_times = [worker['start_time'] for worker in workers.values() if worker['start_time'] is not None]
+            heartbeats = [worker['heartbeat'] for worker in workers.values() if worker['job_index'] is not None or not worker['ready']]
+            try:
+                ready = wait(list(connections) + list(sentinels), timeout=self.seconds_until_next_event(start_times, heartbeats))
+            except KeyboardInterrupt:
+                self.interrupt()
+                ready = []
+
+            # Read every message first, a worker can send its result and then exit
+            for conn in ready:
+                if conn in connections:
+                    try:
+                        while conn.poll():
+                            self.handle_warm_message(workers, conn.recv())
+                    except (EOFError, OSError):
+                        pass
+
+            lost_worker = False
+            for sentinel in ready:
+                worker_id = sentinels.get(sentinel)
+                if worker_id in workers:
+                    # The worker died (crash, out of memory) without being told to stop
+                    job_index = self.stop_warm_worker(workers, worker_id)
+                    print(f"Job Scheduler: Warm worker {worker_id} stopped unexpectedly")
+                    self.logger.error(f"Job Scheduler: Warm worker {worker_id} stopped unexpectedly")
+                    if job_index is not None:
+                        self.record_result(job_index, None)
+                    lost_worker = True
+
+            # Terminate any worker whose job ran past its timeout or stopped making progress
+            for worker_id in list(workers):
+                worker = workers[worker_id]
+                hung = self.is_hung(worker['heartbeat'])
+                if worker['job_index'] is not None and time.time() - worker['start_time'] >= self.job_timeout:
+                    job_index = self.stop_warm_worker(workers, worker_id)
+                    self.record_result(job_index, None, timed_out=True)
+                    lost_worker = True
+                elif worker['job_index'] is not None and hung:
+                    job_index = self.stop_warm_worker(workers, worker_id)
+                    self.record_no_progress(job_index, worker['heartbeat'])
+                    lost_worker = True
+                elif not worker['ready'] and hung:
+                    # Stuck importing the toolbox, it would never take a job
+                    self.stop_warm_worker(workers, worker_id)
+                    print(f"Job Scheduler: Warm worker {worker_id} made no progress importing the toolbox, replacing it")
+                    self.logger.error(f"Job Scheduler: Warm worker {worker_id} made no progress for {self.no_progress_seconds:.0f} seconds "
+                                      f"during {worker['heartbeat'].current_stage()}, replacing it")
+                    lost_worker = True
+
+            # Replace the workers that were lost so the pool stays full
+            while lost_worker and self.has_waiting_jobs() and len(workers) < self.max_workers:
+                workers[next_worker_id] = self.start_warm_worker(next_worker_id)
+                next_worker_id += 1
+
+        # Cancelled: record any result that arrived in the meantime, then terminate the busy workers and requeue their jobs
+        for worker_id in list(workers):
+            if workers[worker_id]['job_index'] is None:
+                continue
+            try:
+                while workers[worker_id]['conn'].poll():
+                    self.handle_warm_message(workers, workers[worker_id]['conn'].recv())
+            except (EOFError, OSError):
+                pass
+            if workers[worker_id]['job_index'] is not None:
+                self.requeue_cancelled(self.stop_warm_worker(workers, worker_id))
+
+        # Every worker failed to start, the jobs that are left can't be run
+        if self.stop_reason is None:
+            for _, job_index in self.retry_queue:
+                self.job_queue.append((job_index, self.jobs_by_index[job_index]))
+            self.retry_queue = []
+            while self.job_queue:
+                job_index, job = self.job_queue.popleft()
+                self.set_job_condition(job_index, 'Failed', 'No warm worker was able to import the toolbox')
+                self.worker_failed_counter += 1
+
+        # Tell the workers to shut down
+        for worker in workers.values():
+            worker['task_queue'].put(None)
+        for worker in workers.values():
+            worker['process'].join()
+            worker['conn'].close()
+
+    def collect_uploads(self, wait=False):
+        ''' Records the result of every job whose outputs have been uploaded (all of them if wait is True). A failed upload fails the job '''
+        if self.uploader is None:
+            return
+        for job_index, result, error in self.uploader.finished(wait):
+            if error is not None and result.get('status') == 'Success':
+                result = dict(result, status='Failed', error=error, error_type='UploadError')
+            self.record_result(job_index, result, uploaded=True)
+
+    def record_result(self, job_index, result, timed_out=False, uploaded=False):
+        '''
+        Writes the result of a finished (or timed out) job to the queuefile and updates the counters. A job whose outputs
+        are staged locally is recorded once they are on the share.
+        '''
+        if not uploaded and result and result.get('staged_output'):
+            if self.uploader is not None:
+                # The BCGW session is done with, the output folder stays in use until the upload finishes
+                if self.connection_broker is not None:
+                    self.connection_broker.release(job_index)
+                self.uploader.submit(job_index, result)
+                return
+            staged, output_directory = result['staged_output']
+            try:
+                copy_outputs_back(staged, output_directory, self.logger)
+            except Exception as e:
+                self.logger.error(f"Job Scheduler: Unable to copy the outputs of job {job_index} to {output_directory}: {e}")
+                if result.get('status') == 'Success':
+                    result = dict(result, status='Failed', error=f"Unable to copy the outputs to {output_directory}: {e}", error_type='UploadError')
+
+        self.release_job(job_index)
+
+        # If the job exceeded the timeout its worker has already been terminated, mark the job as failed
+        if timed_out:
+            print(f"Job Scheduler: Job {job_index} exceeded timeout. Terminating process.")
+            self.logger.warning(f"Job Scheduler: Job {job_index} exceeded timeout. Terminating process.")
+
+            self.batch_factory.run_report.add(job_index, self.attempts.get(job_index, 1), 'Timed Out', self.jobs_by_index.get(job_index),
+                                              {'error': f"Exceeded the job timeout of {self.job_timeout} seconds", 'telemetry': {'wall_seconds': self.job_timeout}})
+            if self.retry_or_fail(job_index, 'Failed', f"Exceeded the job timeout of {self.job_timeout} seconds", 'TimeoutExpired'):
+                return
+            self.timeout_failed_counter += 1
+            self.logger.error(f"Job Scheduler: Job {job_index} exceeded timeout. Marking as Failed. Failed counter is {self.timeout_failed_counter}")
+            return
+
+        result = result or {}
+        self.batch_factory.run_report.add(job_index, self.attempts.get(job_index, 1), result.get('status') or 'Unknown Error',
+                                          self.jobs_by_index.get(job_index), result)
+        if result.get('startup_seconds') is not None and self.worker_mode == 'spawn':
+            self.startup_seconds.append(result['startup_seconds'])
+        if result.get('job_seconds') is not None:
+            self.job_seconds.append(result['job_seconds'])
+
+        status = result.get('status')
+        if status == 'Success':
+            self.success_counter += 1
+            self.set_job_condition(job_index, 'COMPLETE')
+            print(f"Job Scheduler: Job {job_index} completed successfully.")
+            self.logger.info(f"Job Scheduler: Job {job_index} completed successfully. Success counter is {self.success_counter}")
+
+        elif status == 'Failed':
+            # Job failed due to an exception in the worker
+            if self.retry_or_fail(job_index, 'Failed', result.get('error'), result.get('error_type')):
+                return
+            self.worker_failed_counter += 1
+            print(f"Job Scheduler: Job {job_index} failed due to an exception.")
+            self.logger.error(f"Job Scheduler: Job {job_index} failed due to an exception in the Worker. Worker failed counter is {self.worker_failed_counter}")
+
+        else:
+            # Handle unexpected cases, e.g. the worker crashed before writing a result
+            if self.retry_or_fail(job_index, 'Unknown Error', result.get('error'), result.get('error_type')):
+                return
+            self.other_exception_failed_counter += 1
+            print(f"Job Scheduler: Job {job_index} failed with unknown status.")
+            self.logger.error(f"Job Scheduler: Job {job_index} failed with unknown status. Other Exception failed counter is {self.other_exception_failed_counter}")
+
+    def is_hung(self, heartbeat):
+        ''' True if hang detection is on (NO_PROGRESS_SECONDS > 0) and the heartbeat has been quiet for that long '''
+        return self.no_progress_seconds > 0 and heartbeat.seconds_since_progress() >= self.no_progress_seconds
+
+    def record_no_progress(self, job_index, heartbeat):
+        '''
+        Records a job whose worker was terminated because its heartbeat went quiet. It is not retried: a long tool run that
+        writes no messages would only be killed again.
+        '''
+        self.release_job(job_index)
+        stage = heartbeat.current_stage() or 'unknown'
+        idle_seconds = heartbeat.seconds_since_progress()
+        error = f"Job made no progress for {idle_seconds:.0f} seconds during {stage} (NO_PROGRESS_SECONDS is {self.no_progress_seconds:.0f}), worker terminated"
+
+        print(f"Job Scheduler: Job {job_index} made no progress during {stage}. Terminating process.")
+        self.logger.warning(f"Job Scheduler: Job {job_index} made no progress for {idle_seconds:.0f} seconds during {stage}. Terminating process.")
+
+        self.batch_factory.run_report.add(job_index, self.attempts.get(job_index, 1), 'No Progress', self.jobs_by_index.get(job_index),
+                                          {'error': error})
+        if self.retry_or_fail(job_index, 'Failed', error, 'NoProgress'):
+            return
+        self.hung_failed_counter += 1
+        self.logger.error(f"Job Scheduler: Job {job_index} made no progress. Marking as Failed. Hung counter is {self.hung_failed_counter}")
+
+    def report_started(self, job_index, heartbeat):
+        ''' Tells the progress page a job is running '''
+        if self.progress is not None:
+            self.progress.job_started(job_index, heartbeat, len(self.job_queue) + len(self.retry_queue))
+
+    def set_job_condition(self, job_index, condition, error=None):
+        ''' Records a job's new condition in the queuefile and the ledger, and on the progress page '''
+        self.batch_factory.add_job_result(job_index, condition, error)
+        if self.progress is not None:
+            self.progress.job_condition(job_index, condition)
+
+    def requeue_cancelled(self, job_index):
+        ''' Marks a job whose worker was terminated by a cancel as Requeued, so the next batch runs it again without overwriting its outputs '''
+        self.release_job(job_index)
+        self.cancelled_counter += 1
+
+        error = 'Cancelled before it finished, it runs again on the next batch'
+        job = self.jobs_by_index[job_index]
+        self.batch_factory.run_report.add(job_index, self.attempts.get(job_index, 1), 'Cancelled', job, {'error': error})
+        job[self.batch_factory.BATCH_CONDITION_COLUMN] = 'Requeued'
+        if self.batch_factory.DONT_OVERWRITE_OUTPUTS in job:
+            job[self.batch_factory.DONT_OVERWRITE_OUTPUTS] = 'True'
+        self.set_job_condition(job_index, 'Requeued', error)
+        if self.job_source is not None:
+            self.job_source.release(job_index)
+
+        print(f"Job Scheduler: Job {job_index} cancelled and requeued")
+        self.logger.warning(f"Job Scheduler: Job {job_index} cancelled and requeued")
+
+    def release_waiting_jobs(self):
+        ''' Gives the jobs that were waiting when the batch stopped back to the job source (a shared queue node's leases) '''
+        if self.job_source is None:
+            return
+        for job_index, _ in self.job_queue:
+            self.job_source.release(job_index)
+        for _, job_index in self.retry_queue:
+            self.job_source.release(job_index)
+
+    def retry_or_fail(self, job_index, condition, error, error_type):
+        '''
+        Asks the retry policy whether the failed job should run again. Retryable jobs are marked Requeued and wait out
+        their backoff in the retry queue while the other jobs keep running. Returns True if the job will be retried,
+        otherwise the job is marked with condition and False is returned.
+        '''
+        attempts = self.attempts.get(job_index, 1)
+        classification = self.retry_policy.classify(error, error_type)
+
+        if self.retry_policy.should_retry(attempts, error, error_type):
+            delay = self.retry_policy.backoff(attempts)
+            heapq.heappush(self.retry_queue, (time.time() + delay, job_index))
+            self.retried_counter += 1
+
+            # The retry keeps the outputs the failed attempt already made
+            job = self.jobs_by_index[job_index]
+            job[self.batch_factory.BATCH_CONDITION_COLUMN] = 'Requeued'
+            if self.batch_factory.DONT_OVERWRITE_OUTPUTS in job:
+                job[self.batch_factory.DONT_OVERWRITE_OUTPUTS] = 'True'
+            self.set_job_condition(job_index, 'Requeued', error)
+
+            print(f"Job Scheduler: Job {job_index} failed with a {classification} error, retrying in {delay:.0f} seconds (attempt {attempts + 1} of {self.retry_policy.max_attempts})")
+            self.logger.warning(f"Job Scheduler: Job {job_index} failed with a {classification} error ({error_type}: {error}). "
+                                f"Retrying in {delay:.0f} seconds (attempt {attempts + 1} of {self.retry_policy.max_attempts})")
+            return True
+
+        self.logger.info(f"Job Scheduler: Job {job_index} failed with a {classification} error after {attempts} attempts, not retrying")
+        self.set_job_condition(job_index, condition, error or 'The worker ended without returning a result')
+        return False
+
+    def log_cost_summary(self, batch_seconds):
+        ''' Logs the startup cost and the per job cost separately so the spawn and warm worker modes can be compared '''
+        total_startup = sum(self.startup_seconds)
+        mean_startup = total_startup / len(self.startup_seconds) if self.startup_seconds else 0
+        mean_job = sum(self.job_seconds) / len(self.job_seconds) if self.job_seconds else 0
+
+        summary = (f"Job Scheduler: {self.worker_mode} workers - {len(self.startup_seconds)} toolbox imports took {total_startup:.1f} seconds "
+                   f"(mean {mean_startup:.1f}), {len(self.job_seconds)} jobs took a mean of {mean_job:.1f} seconds, "
+                   f"batch took {batch_seconds:.1f} seconds")
+        print(summary)
+        self.logger.info(summary)
@@ -0,0 +1,150 @@
+###############################################################################################################################################################################
+#
+# Job Telemetry - wall time, CPU time, peak memory and I/O for each job, written to a run report at the end of the batch
+#
+###############################################################################################################################################################################
+import os
+import sys
+import csv
+import time
+import datetime
+import logging
+
+# psutil gives CPU, memory and I/O numbers on Windows. Without it only wall and CPU time are recorded
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Job dictionary key holding the feature layer from the queuefile, before the AOI preparation or input staging replace it.
+# Recorded durations are looked up by it. Not a tool parameter
+SOURCE_FEATURE_LAYER_KEY = '_source_feature_layer'
+
+
+def read_process_counters():
+    ''' Returns the current CPU seconds, peak RSS (MB) and I/O byte counts of this process. Values that can't be read are None '''
+    counters = {'cpu_seconds': time.process_time(), 'peak_rss_mb': None, 'read_bytes': None, 'write_bytes': None}
+
+    if psutil is not None:
+        process = psutil.Process()
+        cpu = process.cpu_times()
+        counters['cpu_seconds'] = cpu.user + cpu.system
+
+        memory = process.memory_info()
+        # Windows reports the peak working set, other platforms only the current RSS
+        peak = getattr(memory, 'peak_wset', None) or memory.rss
+        counters['peak_rss_mb'] = peak / (1024 * 1024)
+
+        try:
+            io = process.io_counters()
+            counters['read_bytes'] = io.read_bytes
+            counters['write_bytes'] = io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+
+    if resource is not None:
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+        counters['peak_rss_mb'] = max(counters['peak_rss_mb'] or 0, peak_rss_mb)
+
+    return counters
+
+
+def start_job_telemetry():
+    ''' Takes the starting counters for a job. Pass the result to finish_job_telemetry when the job is done '''
+    counters = read_process_counters()
+    counters['wall_start'] = time.time()
+    return counters
+
+
+def finish_job_telemetry(start):
+    '''
+    Returns the wall time, CPU time, peak RSS and I/O bytes used by the job since start_job_telemetry.
+    Peak RSS is the process's peak, so for a warm worker it is the highest of all the jobs it has run so far.
+    '''
+    end = read_process_counters()
+
+    def used(key):
+        if start.get(key) is None or end.get(key) is None:
+            return None
+        return end[key] - start[key]
+
+    return {
+        'wall_seconds': time.time() - start['wall_start'],
+        'cpu_seconds': used('cpu_seconds'),
+        'peak_rss_mb': end['peak_rss_mb'],
+        'read_bytes': used('read_bytes'),
+        'write_bytes': used('write_bytes'),
+    }
+
+
+class RUN_REPORT:
+    ''' Collects one row per job attempt in the parent process and writes them to a CSV (or Parquet) run report '''
+
+    COLUMNS = ['job_index', 'attempt', 'status', 'worker_pid', 'startup_seconds', 'wall_seconds', 'cpu_seconds',
+               'peak_rss_mb', 'read_bytes', 'write_bytes', 'feature_layer', 'source_feature_layer', 'error']
+
+    def __init__(self, report_folder, report_format='csv', logger=None) -> None:
+        self.report_folder = report_folder
+        self.report_format = (report_format or 'csv').lower()
+        self.logger = logger or logging.getLogger(__name__)
+        self.rows = []
+
+    def add(self, job_index, attempt, status, job=None, result=None):
+        ''' Adds a row for one attempt at a job. result is the worker's result dictionary (None if the worker was killed) '''
+        result = result or {}
+        job = job or {}
+        telemetry = result.get('telemetry') or {}
+        row = {
+            'job_index': job_index,
+            'attempt': attempt,
+            'status': status,
+            'worker_pid': result.get('pid'),
+            'startup_seconds': result.get('startup_seconds'),
+            'feature_layer': job.get('feature_layer'),
+            'source_feature_layer': job.get(SOURCE_FEATURE_LAYER_KEY, job.get('feature_layer')),
+            'error': result.get('error'),
+        }
+        for key in ['wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'read_bytes', 'write_bytes']:
+            row[key] = telemetry.get(key)
+        self.rows.append(row)
+
+    def write(self):
+        ''' Writes the run report and returns its path, or None if there was nothing to write '''
+        if not self.rows:
+            return None
+
+        os.makedirs(self.report_folder, exist_ok=True)
+        report_name = f'run_report_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}'
+
+        if self.report_format == 'parquet':
+            try:
+                import pandas
+                report_file = os.path.join(self.report_folder, report_name + '.parquet')
+                pandas.DataFrame(self.rows, columns=self.COLUMNS).to_parquet(report_file, index=False)
+                self.rows = []
+                print(f"Run Report: Written to {report_file}")
+                self.logger.info(f"Run Report: Written to {report_file}")
+                return report_file
+            except ImportError as e:
+                # pandas or pyarrow isn't installed, fall back to CSV
+                print(f"Run Report: Unable to write Parquet ({e}), writing CSV instead")
+                self.logger.warning(f"Run Report: Unable to write Parquet ({e}), writing CSV instead")
+
+        report_file = os.path.join(self.report_folder, report_name + '.csv')
+        with open(report_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+        # The next batch starts a new report
+        self.rows = []
+        print(f"Run Report: Written to {report_file}")
+        self.logger.info(f"Run Report: Written to {report_file}")
+        return report_file
@@ -2,37 +2,162 @@
 # Set up logging
 
 import os
+import json
+import atexit
 import datetime
 import logging
+import logging.handlers
+import multiprocessing as mp
+
+# The parent process owns the log queue and the listener that writes it to disk. Workers get the queue as an argument
+LOG_QUEUE = None
+LOG_LISTENER = None
+
+
+class JSON_FORMATTER(logging.Formatter):
+    ''' Formats each log record as one JSON line, including the job index, stage and duration when a worker supplies them '''
+
+    STRUCTURED_FIELDS = ['job_index', 'stage', 'duration', 'worker']
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        for field in self.STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class JOB_SPLIT_HANDLER(logging.Handler):
+    ''' Optional handler that also writes every record that has a job index to its own file, one file per job '''
+
+    def __init__(self, log_folder) -> None:
+        super().__init__()
+        self.log_folder = log_folder
+        self.job_files = {}
+
+    def emit(self, record):
+        job_index = getattr(record, 'job_index', None)
+        if job_index is None:
+            return
+        try:
+            if job_index not in self.job_files:
+                self.job_files[job_index] = open(os.path.join(self.log_folder, f'ast_job_{job_index}.log'), 'a', encoding='utf-8')
+            job_file = self.job_files[job_index]
+            job_file.write(self.format(record) + '\n')
+            job_file.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for job_file in self.job_files.values():
+            job_file.close()
+        self.job_files = {}
+        super().close()
+
+
+class JOB_CONTEXT_FILTER(logging.Filter):
+    ''' Adds the worker's current job index and stage to every record it logs so the listener can group them by job '''
+
+    def __init__(self, worker=None) -> None:
+        super().__init__()
+        self.worker = worker
+        self.job_index = None
+        self.stage = None
+
+    def filter(self, record):
+        if getattr(record, 'job_index', None) is None:
+            record.job_index = self.job_index
+        if getattr(record, 'stage', None) is None:
+            record.stage = self.stage
+        if getattr(record, 'worker', None) is None:
+            record.worker = self.worker
+        return True
 
 
 def setup_logging():
     ''' Set up logging for the script '''
+    global LOG_QUEUE, LOG_LISTENER
+
     # Create the log folder filename
     log_folder = f'autoast_logs_{datetime.datetime.now().strftime("%Y%m%d")}'
 
     # Create the log folder in the current directory if it doesn't exits
     if not os.path.exists(log_folder):
         os.mkdir(log_folder)
-    
+
     # Check if the log folder was created successfully
     assert os.path.exists(log_folder), "Error creating log folder, check permissions and path"
 
     # Create the log file path with the date and time appended
     log_file = os.path.join(log_folder, f'ast_log_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
 
+    # One rotating JSON log for the parent and every worker
+    file_handler = logging.handlers.RotatingFileHandler(log_file,
+                                                        maxBytes=int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)),
+                                                        backupCount=int(os.getenv('LOG_BACKUP_COUNT', 5)),
+                                                        encoding='utf-8')
+    file_handler.setFormatter(JSON_FORMATTER())
+    handlers = [file_handler]
 
+    # Optionally split the worker records into one file per job as well
+    if str(os.getenv('LOG_SPLIT_PER_JOB', 'false')).lower() == 'true':
+        split_handler = JOB_SPLIT_HANDLER(log_folder)
+        split_handler.setFormatter(JSON_FORMATTER())
+        handlers.append(split_handler)
+
+    # Workers and the parent put records on the queue, the listener thread does all the file I/O so logging never blocks a worker
+    LOG_QUEUE = mp.Queue(-1)
+    LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, *handlers, respect_handler_level=True)
+    LOG_LISTENER.start()
+    atexit.register(stop_logging)
 
     # Set up logging config to DEBUG level
-    logging.basicConfig(filename=log_file, 
-                        level=logging.DEBUG, 
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
 
     # Create the logger object and set to the current file name
     logger = logging.getLogger(__name__)
 
     print("Logging set up")
     logger.info("Logging set up")
-    
+
     return logger
-###############################################################################################################################################################################
\ No newline at end of file
+
+
+def get_log_queue():
+    ''' Returns the queue workers send their log records to, or None if setup_logging hasn't been called '''
+    return LOG_QUEUE
+
+
+def setup_queue_logging(log_queue, worker=None):
+    ''' Sends every log record in a worker process to the parent's log queue. Returns the filter that tags records with the current job '''
+    context_filter = JOB_CONTEXT_FILTER(worker)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(context_filter)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.DEBUG)
+    return context_filter
+
+
+def stop_logging():
+    ''' Stops the listener after it has written every record still on the queue '''
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        for handler in LOG_LISTENER.handlers:
+            handler.close()
+        LOG_LISTENER = None
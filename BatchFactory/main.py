@@ -17,55 +17,112 @@
 
 
 import os
+import argparse
 from dotenv import load_dotenv
-from logging_setup import setup_logging
+from logging_setup import setup_logging, stop_logging
 from database_connection import setup_bcgw
+from connection_broker import close_connection_broker
 from toolbox_import import import_any_toolbox
 from batch_factory import BATCH_FACTORY
+from shared_queue import SHARED_QUEUE
+from batch_control import CONTROL_COMMANDS, get_control_file, write_control
 
 
 
-## *** INPUT YOUR EXCEL FILE NAME HERE ***
+## *** INPUT YOUR EXCEL FILE NAME HERE *** (a .csv or .parquet queuefile works the same way)
 excel_file = '1_shp_file_job.xlsx'
 
 
 
+def parse_args():
+    ''' Command line flags. With no flags the whole queuefile runs on this machine '''
+    parser = argparse.ArgumentParser(description='Batch runs the tool in the .env file over every job in the queuefile')
+    shard = parser.add_mutually_exclusive_group()
+    shard.add_argument('--coordinator', metavar='SHARED_DIR', help='publish the queuefile to a shared folder and merge the results from every node')
+    shard.add_argument('--node', metavar='SHARED_DIR', help='claim and run jobs from a shared folder published by a coordinator')
+    shard.add_argument('--dry-run', action='store_true', help='check the queuefile and estimate the batch time without running any jobs or connecting to the BCGW')
+    parser.add_argument('--node-id', help='name of this node in the shared folder (defaults to host_pid)')
+    parser.add_argument('--workers', type=int, help='number of workers the --dry-run makespan is projected for (defaults to MAX_WORKERS)')
+    parser.add_argument('--control', choices=CONTROL_COMMANDS,
+                        help='pause, resume, drain or cancel the batch that is running on this queuefile (or on SHARED_DIR with --node/--coordinator) and exit')
+    return parser.parse_args()
+
+
+
 #################################################################################################################################################################################
 if __name__ == '__main__':
     current_path = os.path.dirname(os.path.realpath(__file__))
+    args = parse_args()
 
-    # Call the setup_logging function to log the messages
-    logger = setup_logging()
-
-    # Load the default environment
+    # Load the default environment first, the log size, rotation and per job split settings are read from it
     load_dotenv()
 
-    # Call the import_any_toolbox function to import any toolbox
-    template = import_any_toolbox(logger)
-
-    # Call the setup_bcgw function to set up the database connection
-    secrets = setup_bcgw(logger)
+    # Call the setup_logging function to log the messages
+    logger = setup_logging()
 
     # Create the path for the queuefile
     qf = os.path.join(current_path, excel_file)
 
-    # Create an instance of the Ast Factory class, assign the queuefile path and the bcgw username and passwords to the instance
-    bat = BATCH_FACTORY(qf, secrets[0], secrets[1], logger, current_path)
-
-    if not os.path.exists(qf):
-        print("Main: Queuefile not found, creating new queuefile")
-        logger.info("Main: Queuefile not found, creating new queuefile")
-        bat.create_new_queuefile()
-        
-    # Load the jobs using the load_jobs method. This will scan the excel sheet and assign to "jobs"    
-    jobs = bat.load_jobs()
-    
-    bat.batch_ast()
-    
-    bat.re_load_failed_jobs_V2()
-    
-    bat.batch_ast()
+    if args.control:
+        # Only sends the command to the running batch, nothing else is set up
+        shared_dir = args.node or args.coordinator
+        control_file = SHARED_QUEUE(shared_dir, logger=logger).control_file if shared_dir else get_control_file(qf)
+        write_control(control_file, args.control)
+        print(f"Main: Sent '{args.control}' to the batch through {control_file}")
+        logger.info(f"Main: Sent '{args.control}' to the batch through {control_file}")
+        stop_logging()
+        raise SystemExit(0)
+
+    if not args.dry_run:
+        # Call the import_any_toolbox function to import any toolbox
+        template = import_any_toolbox(logger)
+
+        # Call the setup_bcgw function to set up the database connection
+        secrets = setup_bcgw(logger)
+
+    if args.dry_run:
+        # Checks every job and projects the batch time, no BCGW connection and no tool runs
+        if os.path.exists(qf):
+            BATCH_FACTORY(qf, None, None, logger, current_path).dry_run(args.workers)
+        else:
+            print(f"Main: Queuefile {qf} not found, nothing to check")
+            logger.error(f"Main: Queuefile {qf} not found, nothing to check")
+
+    elif args.node:
+        # A node runs jobs claimed from the shared folder, its queuefile is a local copy of the published one
+        shared_queue = SHARED_QUEUE(args.node, args.node_id, logger=logger)
+        node_qf = shared_queue.copy_snapshot(os.path.join(current_path, f'node_{shared_queue.node_id}.csv'))
+        bat = BATCH_FACTORY(node_qf, secrets[0], secrets[1], logger, current_path)
+        bat.run_shard_node(shared_queue)
+
+    else:
+        # Create an instance of the Ast Factory class, assign the queuefile path and the bcgw username and passwords to the instance
+        bat = BATCH_FACTORY(qf, secrets[0], secrets[1], logger, current_path)
+
+        if not os.path.exists(qf):
+            print("Main: Queuefile not found, creating new queuefile")
+            logger.info("Main: Queuefile not found, creating new queuefile")
+            # QUEUE_TEMPLATE in the .env file copies a filled in Excel template into the new queuefile
+            bat.create_new_queuefile(os.getenv('QUEUE_TEMPLATE'))
+            
+        if args.coordinator:
+            # The jobs run on the nodes, this machine publishes them and keeps the queuefile up to date
+            bat.run_shard_coordinator(SHARED_QUEUE(args.coordinator, args.node_id, logger=logger))
+
+        else:
+            # Load the jobs using the load_jobs method. This will scan the excel sheet and assign to "jobs"    
+            jobs = bat.load_jobs()
+            
+            # Failed jobs with transient errors (BCGW drops, locks) are retried inside batch_ast by the retry policy,
+            # so there is no second pass. Use re_load_failed_jobs_V2 to requeue everything that is still Failed by hand.
+            bat.batch_ast()
     
+    # The shared connection file holds the BCGW credentials, it is removed as soon as the jobs are done
+    close_connection_broker()
+
     print("Main: BATCH Factory COMPLETE")
     logger.info("Main: BATCH Factory COMPLETE")
 
+    # Write out anything still waiting on the log queue
+    stop_logging()
+
@@ -1,4 +1,12 @@
 import sys
+import os
+import time
+from job_telemetry import start_job_telemetry, finish_job_telemetry
+from gp_backend import get_backend
+from job_heartbeat import watch_tool_messages
+from worker_scratch import setup_worker_scratch, remove_worker_scratch, stage_outputs_locally, upload_outputs_async, stage_job_outputs, copy_outputs_back
+from env_config import get_env_number
+from aoi_cache import touch_cached_aoi
 
 
 
@@ -6,30 +14,30 @@ import sys
 
 
 
-def process_job_mp(batch_factory_instance, job, job_index, current_path, return_dict):
-    import os
-    import arcpy
+def setup_worker_logging(current_path, job_index, log_queue=None):
+    '''
+    Sets up logging for a worker process. With a log queue every record is sent to the parent's log listener, tagged with
+    the job index, and the returned log context is used to change the job and stage. Without one the worker writes to
+    its own log file in the autoast_logs folder and the log context is None.
+    '''
     import datetime
     import logging
     import multiprocessing as mp
-    import traceback
-   
+    from logging_setup import setup_queue_logging
 
     logger = logging.getLogger(f"Process Job Mp: worker_{job_index}")
 
-    logger.info("##########################################################################################################################")
-    logger.info("#")
-    logger.info("Running Multiprocessing Worker Function.....")
-    logger.info("#")
-    logger.info("##########################################################################################################################")
-
-    print(f"Process Job Mp: Processing job {job_index}: {job}")
+    if log_queue is not None:
+        log_context = setup_queue_logging(log_queue, worker=mp.current_process().pid)
+        log_context.job_index = job_index
+        logger.info(f"Process Job Mp: Worker process {mp.current_process().pid} started for job {job_index}", extra={'stage': 'worker_start'})
+        return logger, log_context
 
     # Set up logging folder in the worker process
     logger.info(f"Process Job Mp: Worker process {mp.current_process().pid} started for job {job_index}")
     log_folder = os.path.join(current_path, f'autoast_logs_{datetime.datetime.now().strftime("%Y%m%d")}')
     if not os.path.exists(log_folder):
-        os.mkdir(log_folder)
+        os.makedirs(log_folder, exist_ok=True)
         logger.info(f"Process Job Mp: Created log folder {log_folder}")
 
     # Generate a unique log file name per process
@@ -38,128 +46,318 @@ def process_job_mp(batch_factory_instance, job, job_index, current_path, return_
         f'ast_worker_log_{datetime.datetime.now().strftime("%Y_%m_%d_%H%M%S")}_{mp.current_process().pid}_job_{job_index}.log'
     )
     logger.info(f"Process Job Mp: Log file for worker process is: {log_file}")
-    
+
     # Set up logging config in the worker process
     logging.basicConfig(
         filename=log_file,
         level=logging.DEBUG,  # Set level to DEBUG to capture all messages
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
-    
-    # Set up the parameters for the job from the list
+
+    return logger, None
+
+
+def load_worker_tool(logger):
+    ''' Imports the toolbox from the .env file into the worker process and returns the tool function and the tool name '''
+    import_start = time.time()
+    backend = get_backend()
+
+    # Re-import the toolbox in each process
+    any_toolbox = os.getenv('TOOLBOX')  # Get the toolbox path from environment variables
+
+    if any_toolbox:
+        backend.import_toolbox(any_toolbox)
+        print(f"Process Job Mp: {any_toolbox} imported successfully in worker.")
+        logger.info(f"Process Job Mp: {any_toolbox} imported successfully in worker ({backend.name} backend).")
+    else:
+        raise ImportError("Process Job Mp: Toolbox path not found. Ensure TOOLBOX path is set correctly in environment variables.")
+
+    any_tool = os.getenv('TOOL') # Get the tool name from environment variables
+    if not any_tool:
+        raise ImportError("Tool name not found in .env")
+
+    tool_func = backend.get_tool(any_tool)
+    if not tool_func:
+        raise AttributeError(f"Tool '{any_tool}' not found in the toolbox.")
+
+    logger.info(f"Process Job Mp: Tool {any_tool} loaded", extra={'stage': 'import_toolbox', 'duration': time.time() - import_start})
+    return tool_func, any_tool
+
+
+def beat(heartbeat, stage):
+    ''' Tells the parent the job reached a new stage. Does nothing when the worker was started without a heartbeat '''
+    if heartbeat is not None:
+        heartbeat.beat(stage)
+
+
+def run_job(batch_factory_instance, tool_func, any_tool, job, job_index, logger, heartbeat=None):
+    '''
+    Runs one job with a tool that has already been imported. Raises an exception if the job fails. While the tool runs
+    the heartbeat is beaten every time the tool writes a new message, checked every HEARTBEAT_POLL_SECONDS when hang
+    detection (NO_PROGRESS_SECONDS) is on.
+    '''
+    backend = get_backend()
+
+    # Intermediate data goes to this worker's own scratch folder on local disk
+    setup_worker_scratch(logger)
+
+    # The job's AOI may be read from the AOI cache, mark it as in use so another job's preparation doesn't evict it
+    touch_cached_aoi(job.get('feature_layer'), logger)
+
+    # Prepare parameters
     params = []
-    for param_name in batch_factory_instance.parameter_names:
-        value = job.get(param_name)
-        
+
+    # The parameters are the spreadsheet headers found by load_jobs (batch_condition is not included)
+    parameter_names = batch_factory_instance.parameter_names or list(batch_factory_instance.BATCH_PARAMETERS.values())
+
+    # Convert 'true'/'false' strings to booleans
+    for param in parameter_names: # use the batch_factory_instance that is passed into the function to access the ast factory parameters
+        value = job.get(param)
+        if isinstance(value, str) and value.lower() in ['true', 'false']:
+            value = True if value.lower() == 'true' else False
+        params.append(value)
+
     logger.info(f"Parameters for job {job_index}: {params}")
     print(f"Parameters for job {job_index}: {params}")
-    
-    
+
+    #NOTE: This is where the output directory is set
+    # Get the output directory from the job (a local folder when the outputs are staged)
+    output_directory = job.get('output_directory')
+
+    # # If output_directory is not provided
+    # if not output_directory:
+    #     # Check if 'output directory is same as input directory' is set to True
+    #     output_same_as_input = job.get('output_directory_is_same_as_input_directory')
+    #     if output_same_as_input == True or str(output_same_as_input).lower() == 'true':
+    #         # Use the input_directory as output_directory
+    #         #NOTE This handling is already present in the AST Tool
+    #         output_directory = job.get('input_directory')
+    #         if not output_directory:
+    #             raise ValueError(f"Process Job Mp: 'Input Directory' is required when 'Output Directory is same as Input Directory' is True for job {job_index}.")
+    #         job['output_directory'] = output_directory
+    #         logger.info(f"Process Job Mp: Output directory is same as input directory for job {job_index}. Using: {output_directory}")
+    #     else:
+    #         # If there was no output directory provided and 'output directory is same as input directory' is False
+    #         # Set the default output directory to a default location (This can be changed later) This will prevent the job from failing due to a user error
+
+    #         #DELETE This was put in for testing so that it's easy to delete all outputs from one place at once.
+    #         DEFAULT_DIR = os.getenv('DIR')
+    #         output_directory = os.path.join("T:", f'job{job_index}')
+    #         job['output_directory'] = output_directory
+    #         logger.warning(f"Process Job Mp: Output directory not provided for job {job_index}. Using default path: {output_directory}")
+    # else:
+    #     # Output directory is provided
+    #     job['output_directory'] = output_directory
+
+    # Create the output directory if the user put in a path but failed to create the output directory in Windows explorer
+    if output_directory and not os.path.exists(output_directory):
+        try:
+            os.makedirs(output_directory)
+            print(f"Output directory '{output_directory}' created.")
+            logger.warning(f"Process Job Mp: Output directory doesn't exist for job ({job_index}).")
+            logger.warning(f"\n")
+            logger.warning(f"'{output_directory}' created.")
+        except OSError as e:
+            raise RuntimeError(f"Failed to create the output directory '{output_directory}'. Check your permissions: {e}")
+
+    # Log the parameters being used
+    logger.debug(f"Process Job Mp: Job Parameters: {params}")
+
+    # Run the tool
+    logger.info("Process Job Mp: Running your tool in Multiprocessing Batch Mode...Hold on!!!! ...")
+    logger.info(f"Running tool {any_tool} with params={params}", extra={'stage': 'run_tool'})
+    tool_start = time.time()
+    beat(heartbeat, 'run_tool')
+    # Only watched when hang detection is on, the message count is read from another thread while the tool runs
+    watch = heartbeat is not None and get_env_number('NO_PROGRESS_SECONDS', 0, float) > 0
+    stop_watch = watch_tool_messages(backend, heartbeat, get_env_number('HEARTBEAT_POLL_SECONDS', 10, float)) if watch else None
     try:
-        # Re-import the toolbox in each process
-        any_toolbox = os.getenv('TOOLBOX')  # Get the toolbox path from environment variables
-        
-        if any_toolbox:
-            arcpy.ImportToolbox(any_toolbox)
-            print(f"Process Job Mp: {any_toolbox} imported successfully in worker.")
-            logger.info(f"Process Job Mp: {any_toolbox} imported successfully in worker.")
-        else:
-            raise ImportError("Process Job Mp: Toolbox path not found. Ensure TOOLBOX path is set correctly in environment variables.")
-
-        any_tool = os.getenv('TOOL') # Get the tool name from environment variables
-        if not any_tool:
-            raise ImportError("Tool name not found in .env")
-
-        tool_func = getattr(arcpy, any_tool, None)
-        if not tool_func:
-            raise AttributeError(f"Tool '{any_tool}' not found in the toolbox.")
-    
-        
-        # Prepare parameters
-        params = []
-
-        # Convert 'true'/'false' strings to booleans
-        for param in batch_factory_instance.BATCH_PARAMETERS.values(): # use the batch_factory_instance that is passed into the function to access the ast factory parameters
-            value = job.get(param)
-            if isinstance(value, str) and value.lower() in ['true', 'false']:
-                value = True if value.lower() == 'true' else False
-            params.append(value)
-        
-        #NOTE: This is where the output directory is set
-        # Get the output directory from the job
+        backend.run_tool(tool_func, params)
+    finally:
+        if stop_watch is not None:
+            stop_watch.set()
+    beat(heartbeat, 'capture_messages')
+    logger.info("Process Job Mp: Your Tool completed successfully.", extra={'stage': 'run_tool', 'duration': time.time() - tool_start})
+
+    # Capture and log arcpy messages
+    logger.info("Process Job Mp: Capturing arcpy messages...")
+    arcpy_messages = backend.get_messages(0)
+    arcpy_warnings = backend.get_messages(1)
+    arcpy_errors = backend.get_messages(2)
+
+    if arcpy_messages:
+        logger.info(f'arcpy messages: {arcpy_messages}')
+    if arcpy_warnings:
+        logger.warning(f'arcpy warnings: {arcpy_warnings}')
+    if arcpy_errors:
+        logger.error(f'arcpy errors: {arcpy_errors}')
+
+
+def describe_job_error(e):
+    ''' Returns the error text of a failed job: the exception message plus any arcpy error messages, so the retry policy can classify it '''
+    error = str(e)
+    try:
+        arcpy_errors = get_backend().get_messages(2)
+        if arcpy_errors and arcpy_errors not in error:
+            error = f"{error}\n{arcpy_errors}"
+    except Exception:
+        pass
+    return error
+
+
+def log_job_failure(job_index, e, logger):
+    ''' Logs the error and traceback of a failed job '''
+    import traceback
+
+    logger.error(f"Process Job Mp: Job {job_index} failed with error: {e}")
+    logger.debug(traceback.format_exc())
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    traceback_str = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+    logger.error(f"Process Job Mp: Job {job_index} failed with error: {e}")
+    logger.error(f"Process Job Mp: Traceback:\n{traceback_str}")
+
+
+def run_measured_job(batch_factory_instance, tool_func, any_tool, job, job_index, logger, result, heartbeat=None):
+    ''' Runs the job and records its status, error, job_seconds and resource telemetry (wall, CPU, peak RSS, I/O) in result '''
+    telemetry = start_job_telemetry()
+    staged_output = None
+    try:
+        # With STAGE_OUTPUTS_LOCALLY the tool writes to a local folder, which goes to output_directory once the tool is done
         output_directory = job.get('output_directory')
+        if output_directory and stage_outputs_locally():
+            dont_overwrite = str(job.get(batch_factory_instance.DONT_OVERWRITE_OUTPUTS)).strip().lower() == 'true'
+            staged_output = stage_job_outputs(job_index, output_directory, dont_overwrite, logger)
+            job = dict(job, output_directory=staged_output)
+
+        run_job(batch_factory_instance, tool_func, any_tool, job, job_index, logger, heartbeat)
 
-        # # If output_directory is not provided
-        # if not output_directory:
-        #     # Check if 'output directory is same as input directory' is set to True
-        #     output_same_as_input = job.get('output_directory_is_same_as_input_directory')
-        #     if output_same_as_input == True or str(output_same_as_input).lower() == 'true':
-        #         # Use the input_directory as output_directory
-        #         #NOTE This handling is already present in the AST Tool
-        #         output_directory = job.get('input_directory')
-        #         if not output_directory:
-        #             raise ValueError(f"Process Job Mp: 'Input Directory' is required when 'Output Directory is same as Input Directory' is True for job {job_index}.")
-        #         job['output_directory'] = output_directory
-        #         logger.info(f"Process Job Mp: Output directory is same as input directory for job {job_index}. Using: {output_directory}")
-        #     else:
-        #         # If there was no output directory provided and 'output directory is same as input directory' is False
-        #         # Set the default output directory to a default location (This can be changed later) This will prevent the job from failing due to a user error
-                
-        #         #DELETE This was put in for testing so that it's easy to delete all outputs from one place at once. 
-        #         DEFAULT_DIR = os.getenv('DIR')
-        #         output_directory = os.path.join("T:", f'job{job_index}')
-        #         job['output_directory'] = output_directory
-        #         logger.warning(f"Process Job Mp: Output directory not provided for job {job_index}. Using default path: {output_directory}")
-        # else:
-        #     # Output directory is provided
-        #     job['output_directory'] = output_directory
-
-        # Create the output directory if the user put in a path but failed to create the output directory in Windows explorer
-        if output_directory and not os.path.exists(output_directory):
-            try:
-                os.makedirs(output_directory)
-                print(f"Output directory '{output_directory}' created.")
-                logger.warning(f"Process Job Mp: Output directory doesn't exist for job ({job_index}).")
-                logger.warning(f"\n")
-                logger.warning(f"'{output_directory}' created.")
-            except OSError as e:
-                raise RuntimeError(f"Failed to create the output directory '{output_directory}'. Check your permissions: {e}")
-
-
-    
-
-        # Log the parameters being used
-        logger.debug(f"Process Job Mp: Job Parameters: {params}")
-
-        # Run the tool
-        logger.info("Process Job Mp: Running your tool in Multiprocessing Batch Mode...Hold on!!!! ...")
-        logger.info(f"Running tool {any_tool} with params={params}")
-        arcpy.tool_func(*params)
-        logger.info("Process Job Mp: Your Tool completed successfully.")
-        batch_factory_instance.add_job_result(job_index, 'COMPLETE')
-
-        # Capture and log arcpy messages
-        logger.info("Process Job Mp: Capturing arcpy messages...")
-        arcpy_messages = arcpy.GetMessages(0)
-        arcpy_warnings = arcpy.GetMessages(1)
-        arcpy_errors = arcpy.GetMessages(2)
-
-        if arcpy_messages:
-            logger.info(f'arcpy messages: {arcpy_messages}')
-        if arcpy_warnings:
-            logger.warning(f'arcpy warnings: {arcpy_warnings}')
-        if arcpy_errors:
-            logger.error(f'arcpy errors: {arcpy_errors}')
-        
         # Indicate success
-        return_dict[job_index] = 'Success'  
+        result['status'] = 'Success'
+
+    except Exception as e:
+        # Indicate failure
+        result['status'] = 'Failed'
+        result['error'] = describe_job_error(e)
+        result['error_type'] = type(e).__name__
+        log_job_failure(job_index, e, logger)
+
+    # A failed attempt's outputs go to the share too, a retry keeps them. With UPLOAD_OUTPUTS_ASYNC the scheduler
+    # uploads them while this worker runs its next job, otherwise they are copied before the result is sent
+    if staged_output is not None:
+        if upload_outputs_async():
+            result['staged_output'] = (staged_output, output_directory)
+        else:
+            beat(heartbeat, 'copy_outputs')
+            try:
+                copy_outputs_back(staged_output, output_directory, logger)
+            except Exception as e:
+                log_job_failure(job_index, e, logger)
+                if result['status'] == 'Success':
+                    result['status'] = 'Failed'
+                    result['error'] = f"Unable to copy the outputs to {output_directory}: {e}"
+                    result['error_type'] = type(e).__name__
+
+    result['telemetry'] = finish_job_telemetry(telemetry)
+    result['job_seconds'] = result['telemetry']['wall_seconds']
+    beat(heartbeat, 'job_done')
+    logger.info(f"Process Job Mp: Job {job_index} {result['status']}, telemetry: {result['telemetry']}",
+                extra={'stage': 'job_done', 'duration': result['job_seconds']})
+
+
+def process_job_mp(batch_factory_instance, job, job_index, current_path, return_dict, log_queue=None, heartbeat=None):
+    '''
+    Runs a single job in its own process. The toolbox is imported fresh for every job. The heartbeat (a JOB_HEARTBEAT)
+    is beaten at every stage so the scheduler can tell a slow job from a hung one.
+    '''
+    process_start = time.time()
+    beat(heartbeat, 'worker_start')
+
+    logger, log_context = setup_worker_logging(current_path, job_index, log_queue)
+
+    logger.info("##########################################################################################################################")
+    logger.info("#")
+    logger.info("Running Multiprocessing Worker Function.....")
+    logger.info("#")
+    logger.info("##########################################################################################################################")
+
+    print(f"Process Job Mp: Processing job {job_index}: {job}")
+
+    # startup_seconds is the cost of importing arcpy and the toolbox, job_seconds is the cost of running the tool
+    result = {'status': 'Failed', 'startup_seconds': None, 'job_seconds': None, 'pid': os.getpid(), 'error': None, 'error_type': None}
+
+    try:
+        beat(heartbeat, 'import_toolbox')
+        tool_func, any_tool = load_worker_tool(logger)
+        result['startup_seconds'] = time.time() - process_start
 
     except Exception as e:
         # Indicate failure
-        return_dict[job_index] = 'Failed'
-        logger.error(f"Process Job Mp: Job {job_index} failed with error: {e}")
-        logger.debug(traceback.format_exc())
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        traceback_str = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-        logger.error(f"Process Job Mp: Job {job_index} failed with error: {e}")
-        logger.error(f"Process Job Mp: Traceback:\n{traceback_str}")
+        result['status'] = 'Failed'
+        result['error'] = describe_job_error(e)
+        result['error_type'] = type(e).__name__
+        log_job_failure(job_index, e, logger)
+
+    else:
+        run_measured_job(batch_factory_instance, tool_func, any_tool, job, job_index, logger, result, heartbeat)
+
+    logger.info(f"Process Job Mp: Job {job_index} startup took {result['startup_seconds']} seconds, job took {result['job_seconds']} seconds")
+    remove_worker_scratch()
+    return_dict[job_index] = result
+
+
+def warm_worker_mp(batch_factory_instance, worker_id, current_path, task_queue, result_conn, log_queue=None, heartbeat=None):
+    '''
+    Long lived worker. Imports the toolbox once, then runs jobs from its task queue until it receives None.
+    Sends ('ready', worker_id, startup_seconds, error) on the result pipe once the toolbox is imported and
+    ('done', worker_id, job_index, result) after every job. The heartbeat is beaten at every stage of every job.
+    '''
+    startup_start = time.time()
+    beat(heartbeat, 'worker_start')
+
+    logger, log_context = setup_worker_logging(current_path, f'warm_{worker_id}', log_queue)
+    if log_context is not None:
+        # Records are only tagged with a job index while the worker is running that job
+        log_context.job_index = None
+
+    logger.info("##########################################################################################################################")
+    logger.info("#")
+    logger.info(f"Running Warm Worker {worker_id}.....")
+    logger.info("#")
+    logger.info("##########################################################################################################################")
+
+    try:
+        beat(heartbeat, 'import_toolbox')
+        tool_func, any_tool = load_worker_tool(logger)
+    except Exception as e:
+        # Tell the scheduler this worker can't run any jobs
+        log_job_failure(f'warm_{worker_id} startup', e, logger)
+        result_conn.send(('ready', worker_id, time.time() - startup_start, str(e)))
+        return
+
+    startup_seconds = time.time() - startup_start
+    logger.info(f"Warm Worker {worker_id}: Toolbox imported once in {startup_seconds} seconds")
+    result_conn.send(('ready', worker_id, startup_seconds, None))
+
+    while True:
+        task = task_queue.get()
+
+        # None tells the worker the batch is finished
+        if task is None:
+            logger.info(f"Warm Worker {worker_id}: No more jobs, shutting down")
+            remove_worker_scratch()
+            break
+
+        job_index, job = task
+        beat(heartbeat, 'job_start')
+        if log_context is not None:
+            log_context.job_index = job_index
+        print(f"Warm Worker {worker_id}: Processing job {job_index}: {job}")
+        logger.info(f"Warm Worker {worker_id}: Processing job {job_index}")
+
+        result = {'status': 'Failed', 'startup_seconds': 0, 'job_seconds': None, 'pid': os.getpid(), 'error': None, 'error_type': None}
+        run_measured_job(batch_factory_instance, tool_func, any_tool, job, job_index, logger, result, heartbeat)
+
+        logger.info(f"Warm Worker {worker_id}: Job {job_index} took {result['job_seconds']} seconds")
+        result_conn.send(('done', worker_id, job_index, result))
+        if log_context is not None:
+            log_context.job_index = None
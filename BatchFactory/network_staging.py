@@ -0,0 +1,254 @@
+###############################################################################################################################################################################
+#
+# Network Staging - copies the jobs' network inputs (feature layers, templates on spatialfiles.bcgov) to local disk once,
+# and uploads the jobs' outputs back to the network share in the background
+#
+# INPUT_STAGING copies each network dataset (a shapefile and its sidecars, a whole file geodatabase or a single file) on
+# STAGING_WORKERS threads, checks the sha256 of the local copy against the one read from the share, and rewrites the
+# job's parameters to the local copy. A dataset shared by many jobs is copied once, and a copy whose source hasn't changed
+# (same sizes and modified times) is reused by the next batch.
+#
+# OUTPUT_UPLOADER copies the outputs a worker staged locally (see worker_scratch) to the job's output_directory on
+# UPLOAD_WORKERS threads while the worker is already running its next job.
+#
+###############################################################################################################################################################################
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from job_fingerprint import HASH_CHUNK_SIZE
+from worker_scratch import copy_outputs_back
+from env_config import get_env_number
+
+MANIFEST_FILE = 'staged.json'
+
+
+def is_network_path(path):
+    ''' True for UNC paths (\\\\server\\share) and paths under one of the STAGE_INPUT_PREFIXES (mapped drives, comma separated) '''
+    path = str(path).strip()
+    if path.startswith('\\\\') or path.startswith('//'):
+        return True
+    prefixes = [prefix.strip().lower() for prefix in os.getenv('STAGE_INPUT_PREFIXES', '').split(',') if prefix.strip()]
+    return any(path.lower().startswith(prefix) for prefix in prefixes)
+
+
+def get_dataset_files(path):
+    '''
+    Returns (dataset_root, files, remainder) for an input: a geodatabase feature class is the whole .gdb folder plus the
+    feature class path inside it, a shapefile is every file with its name, anything else is the file itself. Returns None
+    for folders and paths that don't exist, they aren't staged.
+    '''
+    path = str(path).strip()
+    lower_path = path.lower()
+
+    if '.gdb' in lower_path:
+        end = lower_path.index('.gdb') + 4
+        root, remainder = path[:end], path[end:]
+        if not os.path.isdir(root):
+            return None
+        files = [os.path.join(folder, name) for folder, _, names in os.walk(root) for name in names if not name.lower().endswith('.lock')]
+        return root, files, remainder
+
+    if not os.path.isfile(path):
+        return None
+
+    if lower_path.endswith('.shp'):
+        # Sidecars include the spatial index and metadata files, not only the ones the fingerprint hashes
+        folder, name = os.path.split(path)
+        stem = os.path.splitext(name)[0].lower() + '.'
+        files = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().startswith(stem)]
+        return path, files, ''
+
+    return path, [path], ''
+
+
+def copy_verified(source, target):
+    '''
+    Copies source to target, hashing the data as it is read from the share, then hashes the written copy and compares
+    the two. The copy is only renamed into place if they match. Returns the sha256. Raises IOError on a mismatch.
+    '''
+    partial = target + '.partial'
+    sha = hashlib.sha256()
+    with open(source, 'rb') as src, open(partial, 'wb') as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+            dst.write(chunk)
+
+    written = hashlib.sha256()
+    with open(partial, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            written.update(chunk)
+
+    if written.hexdigest() != sha.hexdigest():
+        os.remove(partial)
+        raise IOError(f"Checksum mismatch copying {source}")
+    shutil.copystat(source, partial)
+    os.replace(partial, target)
+    return sha.hexdigest()
+
+
+class INPUT_STAGING:
+    ''' Stages network inputs on local disk for the jobs of a batch. stage_job is safe to call from the AOI preparation threads '''
+
+    def __init__(self, stage_dir=None, workers=None, logger=None) -> None:
+        self.stage_dir = stage_dir or os.getenv('LOCAL_STAGING_DIR') or os.path.join(tempfile.gettempdir(), 'batch_factory_inputs')
+        workers = workers if workers is not None else get_env_number('STAGING_WORKERS', 4)
+        self.logger = logger or logging.getLogger(__name__)
+        os.makedirs(self.stage_dir, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='input_staging')
+        self.lock = threading.Lock()
+        self.futures = {}  # dataset root -> future of the local root
+        self.copied_bytes = 0
+
+    def dataset_folder(self, root):
+        ''' The local folder for a dataset, named after its network path so the same dataset always lands in the same place '''
+        key = hashlib.sha1(os.path.normcase(os.path.normpath(root)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.stage_dir, key)
+
+    def copy_dataset(self, root, files):
+        ''' Runs on a staging thread. Copies a dataset's files unless the last copy is still current, returns the local root '''
+        folder = self.dataset_folder(root)
+        local_root = os.path.join(folder, os.path.basename(root))
+        manifest_file = os.path.join(folder, MANIFEST_FILE)
+
+        # The source's sizes and modified times, a copy made from the same files is reused
+        source_stats = {}
+        for f in files:
+            stat = os.stat(f)
+            source_stats[os.path.relpath(f, os.path.dirname(root))] = [stat.st_size, stat.st_mtime]
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get('source') == root and {name: value[:2] for name, value in manifest['files'].items()} == source_stats:
+                self.logger.info(f"Input Staging: Reusing the local copy of {root}")
+                return local_root
+        except (OSError, ValueError, KeyError):
+            pass
+
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        staged_files = {}
+        for name, (size, mtime) in source_stats.items():
+            target = os.path.join(folder, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            source = os.path.join(os.path.dirname(root), name)
+            try:
+                sha = copy_verified(source, target)
+            except IOError:
+                # One more try, a share under load can return a short read
+                sha = copy_verified(source, target)
+            staged_files[name] = [size, mtime, sha]
+            with self.lock:
+                self.copied_bytes += size
+
+        # The manifest is written last, a copy that was interrupted has none and is made again
+        with open(manifest_file, 'w') as f:
+            json.dump({'source': root, 'files': staged_files}, f)
+        self.logger.info(f"Input Staging: Copied {root} to {local_root} ({len(staged_files)} files, checksums verified)")
+        return local_root
+
+    def submit(self, path):
+        ''' Starts staging a network input unless it is already being staged. Returns (future, remainder) or None '''
+        if not path or not isinstance(path, str) or not is_network_path(path):
+            return None
+        dataset = get_dataset_files(path)
+        if dataset is None:
+            return None
+        root, files, remainder = dataset
+        with self.lock:
+            if root not in self.futures:
+                self.futures[root] = self.executor.submit(self.copy_dataset, root, files)
+            return self.futures[root], remainder
+
+    def prefetch(self, jobs, parameter_names):
+        '''
+        Starts copying the queued jobs' network inputs, so they are often local by the time the jobs are prepared. KML and
+        shapefile feature layers are left out, the AOI preparation replaces them with the prepared AOI.
+        '''
+        for job_index, job in jobs:
+            for name in self.input_parameters(job, parameter_names):
+                if name == 'feature_layer' and '.gdb' not in str(job.get(name) or '').lower():
+                    continue
+                try:
+                    self.submit(job.get(name))
+                except OSError as e:
+                    self.logger.warning(f"Input Staging: Unable to stage {job.get(name)} for job {job_index}: {e}")
+
+    def input_parameters(self, job, parameter_names):
+        '''
+        The parameters that are read by the tool. output_directory is written to, and when it is empty the tool writes
+        its outputs next to the feature layer, so the feature layer has to stay on the share too.
+        '''
+        names = [name for name in parameter_names if name != 'output_directory']
+        output_directory = job.get('output_directory')
+        if output_directory is None or str(output_directory).strip() in ['', '#']:
+            names = [name for name in names if name != 'feature_layer']
+        return names
+
+    def stage_job(self, job_index, job, parameter_names):
+        ''' Rewrites the job's network input parameters to their local copies. An input that can't be staged is left on the share '''
+        for name in self.input_parameters(job, parameter_names):
+            path = job.get(name)
+            try:
+                staged = self.submit(path)
+                if staged is None:
+                    continue
+                future, remainder = staged
+                job[name] = future.result() + remainder
+                self.logger.info(f"Input Staging: Job {job_index} {name} is read from {job[name]}")
+            except Exception as e:
+                print(f"Input Staging: Unable to stage {path} for job {job_index}, reading it from the share: {e}")
+                self.logger.warning(f"Input Staging: Unable to stage {path} for job {job_index}, reading it from the share: {e}")
+        return job
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        print(f"Input Staging: {len(self.futures)} network inputs staged, {self.copied_bytes / (1024 * 1024):.1f} MB copied")
+        self.logger.info(f"Input Staging: {len(self.futures)} network inputs staged, {self.copied_bytes / (1024 * 1024):.1f} MB copied")
+
+
+class OUTPUT_UPLOADER:
+    ''' Copies staged job outputs to the network share on background threads for the scheduler '''
+
+    def __init__(self, workers=None, logger=None) -> None:
+        workers = workers if workers is not None else get_env_number('UPLOAD_WORKERS', 2)
+        self.logger = logger or logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='output_upload')
+        self.uploads = {}  # job_index -> (future, result)
+
+    def submit(self, job_index, result):
+        ''' Starts uploading a finished job's staged outputs, the job's result is handed back once the upload is done '''
+        staged, output_directory = result['staged_output']
+        self.uploads[job_index] = (self.executor.submit(copy_outputs_back, staged, output_directory, self.logger), result)
+        self.logger.info(f"Output Uploader: Uploading the outputs of job {job_index} to {output_directory}")
+
+    def pending(self):
+        return len(self.uploads)
+
+    def finished(self, wait=False):
+        '''
+        Returns (job_index, result, error) for every upload that is done (all of them once they finish if wait is True).
+        error is None when the outputs reached the share.
+        '''
+        done = []
+        for job_index, (future, result) in list(self.uploads.items()):
+            if not wait and not future.done():
+                continue
+            try:
+                future.result()
+                error = None
+            except Exception as e:
+                error = f"Unable to upload the outputs to {result['staged_output'][1]}: {e}"
+                self.logger.error(f"Output Uploader: Job {job_index} {error}")
+            del self.uploads[job_index]
+            done.append((job_index, result, error))
+        return done
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
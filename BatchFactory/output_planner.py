@@ -0,0 +1,73 @@
+###############################################################################################################################################################################
+#
+# Output Planner - keeps jobs that write to the same output folder from running at the same time
+#
+# The tool writes aoi_boundary.gdb and the status sheets to the job's output_directory, or to the folder of the feature
+# layer when output_directory is empty. Two jobs with the same output folder would delete or overwrite each other's
+# geodatabase, so the scheduler only starts a job once no running job has its output folder. Jobs with their own output
+# folder are not held up.
+#
+###############################################################################################################################################################################
+import os
+import logging
+
+
+def get_output_target(job):
+    ''' Returns the normalised folder the job writes its outputs to, or None if it can't be worked out '''
+    output_directory = job.get('output_directory')
+    if output_directory is not None and str(output_directory).strip() not in ['', '#']:
+        path = str(output_directory).strip()
+    else:
+        # Same as the tool's get_fc_directory_name: the folder the shapefile or geodatabase is in
+        feature_layer = str(job.get('feature_layer') or '').strip()
+        if not feature_layer:
+            return None
+        lower_path = feature_layer.lower()
+        for extension in ['.gdb', '.mdb']:
+            if extension in lower_path:
+                feature_layer = feature_layer[:lower_path.index(extension) + len(extension)]
+                break
+        path = os.path.dirname(feature_layer)
+
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
+
+
+class OUTPUT_PLANNER:
+    ''' Tracks the output folder of every running job for the scheduler '''
+
+    def __init__(self, logger=None) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+        self.in_use = {}   # output folder -> job_index
+        self.targets = {}  # job_index -> output folder
+
+    def plan(self, jobs):
+        ''' Logs the groups of (job_index, job) that share an output folder, they will run one at a time. Returns {folder: [job_index]} '''
+        groups = {}
+        for job_index, job in jobs:
+            target = get_output_target(job)
+            if target is not None:
+                groups.setdefault(target, []).append(job_index)
+
+        conflicts = {target: job_indexes for target, job_indexes in groups.items() if len(job_indexes) > 1}
+        for target, job_indexes in conflicts.items():
+            print(f"Output Planner: Jobs {job_indexes} all write to {target}, they will run one at a time")
+            self.logger.warning(f"Output Planner: Jobs {job_indexes} all write to {target}, they will run one at a time")
+        if jobs and not conflicts:
+            self.logger.info(f"Output Planner: All {len(jobs)} jobs write to their own output folder")
+        return conflicts
+
+    def is_free(self, job):
+        ''' True if no running job writes to this job's output folder '''
+        target = get_output_target(job)
+        return target is None or target not in self.in_use
+
+    def acquire(self, job_index, job):
+        target = get_output_target(job)
+        if target is not None:
+            self.in_use[target] = job_index
+            self.targets[job_index] = target
+
+    def release(self, job_index):
+        target = self.targets.pop(job_index, None)
+        if target is not None and self.in_use.get(target) == job_index:
+            del self.in_use[target]
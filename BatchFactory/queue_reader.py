@@ -0,0 +1,172 @@
+###############################################################################################################################################################################
+#
+# Queue Reader - streams jobs out of the queuefile with a read-only workbook so memory stays flat for large queues
+#
+# The queuefile can be Excel (.xlsx), CSV (.csv) or Parquet (.parquet). All three have the same columns: the header row
+# holds the parameter names and batch_condition holds each job's state. The format is picked from the file extension.
+#
+###############################################################################################################################################################################
+import os
+import csv
+import logging
+import tempfile
+from openpyxl import Workbook, load_workbook
+
+QUEUE_FORMATS = {
+    '.xlsx': 'xlsx',
+    '.xlsm': 'xlsx',
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+}
+
+
+def get_queue_format(queuefile):
+    ''' Returns 'xlsx', 'csv' or 'parquet' from the queuefile's extension '''
+    extension = os.path.splitext(str(queuefile))[1].lower()
+    if extension not in QUEUE_FORMATS:
+        raise ValueError(f"Unsupported queuefile format '{extension}', use one of {list(QUEUE_FORMATS)}")
+    return QUEUE_FORMATS[extension]
+
+
+def write_queue_rows(queuefile, rows, sheet_name='batch_config'):
+    '''
+    Writes rows (the header first, then one tuple per job, blank rows included so job indexes don't move) to a queuefile
+    in the format of its extension. The file is written to a temp file next to it and renamed over it.
+    '''
+    queue_format = get_queue_format(queuefile)
+    queue_folder = os.path.dirname(os.path.abspath(queuefile))
+    fd, tmp_file = tempfile.mkstemp(suffix=os.path.splitext(queuefile)[1], prefix='~queuefile_', dir=queue_folder)
+    os.close(fd)
+
+    try:
+        if queue_format == 'xlsx':
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet(sheet_name)
+            for row in rows:
+                ws.append(list(row))
+            wb.save(tmp_file)
+
+        elif queue_format == 'csv':
+            with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                for row in rows:
+                    writer.writerow(['' if value is None else value for value in row])
+
+        else:
+            import pyarrow
+            import pyarrow.parquet
+
+            rows = iter(rows)
+            header = [str(h) for h in next(rows)]
+            # Parquet columns need one type, so every value is stored as text like it would be in a CSV
+            columns = [[] for _ in header]
+            for row in rows:
+                row = list(row) + [None] * (len(header) - len(row))
+                for column, value in zip(columns, row):
+                    column.append(None if value is None or value == '' else str(value))
+            table = pyarrow.table({name: pyarrow.array(column, type=pyarrow.string()) for name, column in zip(header, columns)})
+            pyarrow.parquet.write_table(table, tmp_file)
+
+        os.replace(tmp_file, queuefile)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def convert_queuefile(source, destination, sheet_name='batch_config', logger=None):
+    ''' Copies a queuefile into another format, e.g. the Excel template to CSV for scripted submitters, or a CSV back to Excel to review '''
+    logger = logger or logging.getLogger(__name__)
+    write_queue_rows(destination, QUEUE_READER(source, sheet_name, logger).iter_rows(), sheet_name)
+    print(f"Queue Reader: Converted {source} to {destination}")
+    logger.info(f"Queue Reader: Converted {source} to {destination}")
+
+
+class QUEUE_READER:
+    '''
+    Reads the queuefile one row at a time. load_jobs and re_load_failed_jobs_V2 both parse rows through
+    iter_jobs, so a job dictionary looks the same whichever one built it.
+    '''
+
+    def __init__(self, queuefile, sheet_name, logger=None) -> None:
+        self.queuefile = queuefile
+        self.sheet_name = sheet_name
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue_format = get_queue_format(queuefile)
+        self.header = []
+
+    def open_sheet(self):
+        ''' Opens an Excel queuefile in read-only mode and returns the workbook and the batch_config sheet '''
+        wb = load_workbook(filename=self.queuefile, read_only=True)
+        if self.sheet_name not in wb.sheetnames:
+            wb.close()
+            raise ValueError(f"'{self.sheet_name}' sheet not found in the workbook.")
+
+        ws = wb[self.sheet_name]
+        # Some writers leave a stale sheet dimension behind, which would cut rows or columns off in read-only mode
+        ws.reset_dimensions()
+        return wb, ws
+
+    def iter_rows(self):
+        ''' Yields every row as a tuple, the header first. Empty cells are None in every format '''
+        if self.queue_format == 'xlsx':
+            wb, ws = self.open_sheet()
+            try:
+                yield from ws.iter_rows(min_row=1, values_only=True)
+            finally:
+                wb.close()
+
+        elif self.queue_format == 'csv':
+            # utf-8-sig drops the byte order mark Excel adds when it saves a CSV
+            with open(self.queuefile, newline='', encoding='utf-8-sig') as f:
+                for row in csv.reader(f):
+                    yield tuple(None if value == '' else value for value in row)
+
+        else:
+            import pyarrow.parquet
+
+            parquet_file = pyarrow.parquet.ParquetFile(self.queuefile)
+            header = parquet_file.schema_arrow.names
+            yield tuple(header)
+            for batch in parquet_file.iter_batches():
+                for row in batch.to_pylist():
+                    yield tuple(None if row[name] == '' else row[name] for name in header)
+
+    def read_header(self):
+        ''' Returns the header row (the parameter names). Blank header cells are returned as empty strings '''
+        rows = self.iter_rows()
+        try:
+            header_row = next(rows, None)
+        finally:
+            rows.close()
+
+        if not header_row or not any(header_row):
+            raise ValueError("No header found in the spreadsheet.")
+
+        self.header = [h if h is not None else "" for h in header_row]
+        return self.header
+
+    def iter_jobs(self):
+        '''
+        Yields (job_index, job) for every row that isn't blank, where job_index is the row number - 2 (as in Excel) and job
+        maps each header to the row's value (None values become empty strings). Rows are read lazily, only one is held at a time.
+        '''
+        rows = self.iter_rows()
+        try:
+            header_row = next(rows, None)
+            if not header_row or not any(header_row):
+                raise ValueError("No header found in the spreadsheet.")
+            self.header = [h if h is not None else "" for h in header_row]
+
+            for row_idx, row_data in enumerate(rows, start=2):
+                # If the row is entirely blank, skip it
+                if all((value is None or str(value).strip() == '') for value in row_data):
+                    continue
+
+                job = {}
+                for key, value in zip(self.header, row_data):
+                    if key:
+                        job[key] = "" if value is None else value
+
+                yield row_idx - 2, job
+        finally:
+            rows.close()
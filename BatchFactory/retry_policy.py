@@ -0,0 +1,99 @@
+###############################################################################################################################################################################
+#
+# Retry Policy - decides whether a failed job is worth running again and how long to wait first
+#
+###############################################################################################################################################################################
+import re
+
+from env_config import get_env_number
+
+
+class RETRY_POLICY:
+    '''
+    Classifies job errors as transient (BCGW/Oracle connection drops, locks, network hiccups) or permanent (bad inputs,
+    missing data, a broken tool) from the exception type and the arcpy error text captured by the worker. Only transient
+    errors are retried, up to max_attempts, with an exponential backoff between attempts.
+    '''
+
+    # Login failures are never retried, whatever else the message says. A retry logs in again with the same bad password
+    # and can lock the BCGW account. Checked before everything else
+    CREDENTIAL_PATTERNS = [
+        r'ORA-01017',               # invalid username/password
+        r'ORA-28000',               # account is locked
+        r'ORA-28001',               # password has expired
+        r'ORA-01005',               # null password given
+    ]
+
+    # Error text that means the job may work if it's run again. Checked before the permanent patterns
+    TRANSIENT_PATTERNS = [
+        r'ORA-03113',               # end-of-file on communication channel
+        r'ORA-03114',               # not connected to ORACLE
+        r'ORA-03135',               # connection lost contact
+        r'ORA-12170',               # TNS connect timeout
+        r'ORA-12514', r'ORA-12537', r'ORA-12541', r'ORA-12543',  # listener errors
+        r'ORA-01033',               # ORACLE initialization or shutdown in progress
+        r'ORA-02396',               # exceeded maximum idle time
+        r'ORA-00018', r'ORA-00020', # maximum number of sessions / processes exceeded
+        r'TNS:',
+        r'ERROR 000464',            # cannot get exclusive schema lock
+        r'ERROR 999999',            # unexpected tool failure, usually a dropped connection or lock
+        r'Underlying DBMS error',
+        r'Failed to connect to (the )?database',
+        r'schema lock',
+        r'network (name|path) (is )?(no longer )?(not )?(available|found)',
+        r'connection (was )?(reset|refused|aborted|closed)',
+        r'timed out',
+    ]
+
+    # Error text that means running the job again won't help
+    PERMANENT_PATTERNS = [
+        r'ERROR 000732',            # dataset does not exist or is not supported
+        r'ERROR 000735',            # value is required
+        r'ERROR 000725',            # output already exists
+        r'ERROR 000354',            # name contains invalid characters
+        r'Exceeded the job timeout',
+        r'does not exist',
+        r'is required',
+    ]
+
+    # Exception types raised by the worker itself
+    TRANSIENT_EXCEPTION_TYPES = ['TimeoutError', 'ConnectionError', 'ConnectionResetError', 'ConnectionAbortedError', 'BrokenPipeError']
+    PERMANENT_EXCEPTION_TYPES = ['ValueError', 'TypeError', 'KeyError', 'AttributeError', 'ImportError', 'FileNotFoundError', 'PermissionError']
+
+    def __init__(self, max_attempts=None, backoff_seconds=None, max_backoff_seconds=None) -> None:
+        self.max_attempts = max_attempts if max_attempts is not None else get_env_number('RETRY_MAX_ATTEMPTS', 3)
+        self.backoff_seconds = backoff_seconds if backoff_seconds is not None else get_env_number('RETRY_BACKOFF_SECONDS', 60, float)
+        self.max_backoff_seconds = max_backoff_seconds if max_backoff_seconds is not None else get_env_number('RETRY_MAX_BACKOFF_SECONDS', 1800, float)
+
+    def classify(self, error=None, error_type=None):
+        ''' Returns 'transient' or 'permanent' for a job error '''
+        error = error or ''
+
+        for pattern in self.CREDENTIAL_PATTERNS:
+            if re.search(pattern, error, re.IGNORECASE):
+                return 'permanent'
+        for pattern in self.TRANSIENT_PATTERNS:
+            if re.search(pattern, error, re.IGNORECASE):
+                return 'transient'
+        for pattern in self.PERMANENT_PATTERNS:
+            if re.search(pattern, error, re.IGNORECASE):
+                return 'permanent'
+
+        if error_type in self.TRANSIENT_EXCEPTION_TYPES:
+            return 'transient'
+        if error_type in self.PERMANENT_EXCEPTION_TYPES:
+            return 'permanent'
+
+        # A worker that died without an error (e.g. ran out of memory) is worth another try
+        if not error and not error_type:
+            return 'transient'
+
+        return 'permanent'
+
+    def should_retry(self, attempts, error=None, error_type=None):
+        ''' Returns True if a job that has been attempted `attempts` times and failed with this error should run again '''
+        return attempts < self.max_attempts and self.classify(error, error_type) == 'transient'
+
+    def backoff(self, attempts):
+        ''' Seconds to wait before the next attempt. Doubles with every attempt up to max_backoff_seconds '''
+        return min(self.backoff_seconds * (2 ** max(attempts - 1, 0)), self.max_backoff_seconds)
@@ -0,0 +1,392 @@
+###############################################################################################################################################################################
+#
+# Shared Queue - spreads one queuefile's jobs across several machines through a folder on the network share
+#
+# A coordinator publishes the queuefile's jobs to the shared folder. Each node (main.py --node on another machine) claims
+# jobs one at a time with a lease file, renews its leases on a heartbeat while the jobs run and writes each result back.
+# The coordinator merges the results into the queuefile so there is still one status view. A node that dies stops
+# renewing its leases and its jobs are claimed by another node once the lease expires. The hosts' clocks need to agree
+# (domain joined machines do) because lease expiry times are compared across machines.
+#
+#   shared_dir/manifest.json        queuefile, parameter names and the order jobs should be claimed in
+#   shared_dir/queue_snapshot.csv   copy of the queuefile when it was published, each node keeps its own status view in a copy
+#   shared_dir/jobs/<index>.json    one published job
+#   shared_dir/leases/<index>.lease the node that holds the job and when its lease expires
+#   shared_dir/results/<index>.json the latest condition of the job
+#   shared_dir/nodes/<node>.json    each node's last heartbeat and the jobs it's running
+#
+###############################################################################################################################################################################
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+from env_config import get_env_number
+from queue_reader import convert_queuefile
+
+# Conditions that end a job. Requeued is written while a node waits to retry the job itself
+FINAL_CONDITIONS = ['COMPLETE', 'Failed', 'Unknown Error']
+
+
+def get_node_id():
+    ''' Returns a node id that is unique per machine and process '''
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+
+def write_json_atomic(path, data):
+    ''' Writes data to path through a temp file so a reader on another machine never sees half a file '''
+    tmp_file = f"{path}.{get_node_id()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, default=str)
+    os.replace(tmp_file, path)
+
+
+def read_json(path):
+    ''' Returns the JSON in path, or None if it doesn't exist or is being replaced '''
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError, PermissionError):
+        return None
+
+
+class SHARED_QUEUE:
+    '''
+    The file-lock directory shared by the coordinator and the nodes. Claiming a job creates its lease file with O_EXCL,
+    which only one machine can do, so a job is never run by two nodes at once unless its lease expired.
+    '''
+
+    def __init__(self, shared_dir, node_id=None, lease_seconds=None, poll_seconds=None, max_claims=None, logger=None) -> None:
+        self.shared_dir = shared_dir
+        self.node_id = node_id or get_node_id()
+        self.lease_seconds = lease_seconds if lease_seconds is not None else get_env_number('SHARD_LEASE_SECONDS', 300, float)
+        self.poll_seconds = poll_seconds if poll_seconds is not None else get_env_number('SHARD_POLL_SECONDS', 15, float)
+        # A job whose lease keeps expiring is crashing its nodes, stop handing it out after this many claims
+        self.max_claims = max_claims if max_claims is not None else get_env_number('SHARD_MAX_CLAIMS', 3)
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.jobs_dir = os.path.join(shared_dir, 'jobs')
+        self.leases_dir = os.path.join(shared_dir, 'leases')
+        self.results_dir = os.path.join(shared_dir, 'results')
+        self.nodes_dir = os.path.join(shared_dir, 'nodes')
+        self.manifest_file = os.path.join(shared_dir, 'manifest.json')
+        self.snapshot_file = os.path.join(shared_dir, 'queue_snapshot.csv')
+        # main.py --control writes here to pause, drain or cancel every node
+        self.control_file = os.path.join(shared_dir, 'control.txt')
+        for folder in [self.jobs_dir, self.leases_dir, self.results_dir, self.nodes_dir]:
+            os.makedirs(folder, exist_ok=True)
+
+        # Jobs this node holds a lease on, and the job indexes known to be finished
+        self.held = {}
+        self.finished = set()
+        self.last_refresh = 0
+        self.heartbeat_stop = None
+        self.heartbeat_thread = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        # The queue belongs to the node's parent process. Workers get a copy without the lock or heartbeat
+        state = self.__dict__.copy()
+        state['lock'] = None
+        state['heartbeat_stop'] = None
+        state['heartbeat_thread'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def job_file(self, job_index):
+        return os.path.join(self.jobs_dir, f'{job_index}.json')
+
+    def lease_file(self, job_index):
+        return os.path.join(self.leases_dir, f'{job_index}.lease')
+
+    def result_file(self, job_index):
+        return os.path.join(self.results_dir, f'{job_index}.json')
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Coordinator
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def publish(self, queuefile, parameter_names, jobs, sheet_name='batch_config'):
+        '''
+        Publishes (job_index, params_hash, job) tuples in the order they should be claimed. A job that already has a
+        final result for the same parameters is left alone so a coordinator restart doesn't run it again.
+        '''
+        convert_queuefile(queuefile, self.snapshot_file, sheet_name, self.logger)
+
+        order = []
+        published = 0
+        for job_index, params_hash, job in jobs:
+            order.append(job_index)
+            result = read_json(self.result_file(job_index))
+            if result and result.get('params_hash') == params_hash and result.get('condition') in FINAL_CONDITIONS:
+                continue
+
+            # A changed row replaces the old job and any result it had
+            existing = read_json(self.job_file(job_index))
+            if existing and existing.get('params_hash') != params_hash:
+                for path in [self.result_file(job_index), self.lease_file(job_index)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+            write_json_atomic(self.job_file(job_index), {'job_index': job_index, 'params_hash': params_hash, 'job': job})
+            published += 1
+
+        write_json_atomic(self.manifest_file, {'queuefile': queuefile, 'parameter_names': parameter_names, 'order': order,
+                                               'published_at': time.time(), 'coordinator': self.node_id})
+        print(f"Shared Queue: Published {published} jobs to {self.shared_dir}")
+        self.logger.info(f"Shared Queue: Published {published} jobs ({len(order)} in the manifest) to {self.shared_dir}")
+        return published
+
+    def read_results(self):
+        ''' Returns {job_index: result} for every job that has written a result '''
+        results = {}
+        for name in os.listdir(self.results_dir):
+            if name.endswith('.json'):
+                result = read_json(os.path.join(self.results_dir, name))
+                if result:
+                    results[result['job_index']] = result
+        return results
+
+    def status(self):
+        ''' Returns the number of jobs in each state across every node, plus the nodes and their last heartbeat '''
+        manifest = read_json(self.manifest_file) or {}
+        results = self.read_results()
+        now = time.time()
+
+        counts = {'pending': 0, 'running': 0, 'expired': 0}
+        for job_index in manifest.get('order', []):
+            result = results.get(job_index)
+            if result and result['condition'] in FINAL_CONDITIONS:
+                counts[result['condition']] = counts.get(result['condition'], 0) + 1
+                continue
+            lease = read_json(self.lease_file(job_index))
+            if lease is None:
+                counts['pending'] += 1
+            elif lease['expires_at'] < now:
+                counts['expired'] += 1
+            else:
+                counts['running'] += 1
+
+        nodes = {}
+        for name in os.listdir(self.nodes_dir):
+            if name.endswith('.json'):
+                node = read_json(os.path.join(self.nodes_dir, name))
+                if node:
+                    nodes[node['node_id']] = {'seconds_since_heartbeat': round(now - node['updated_at'], 1), 'running': node.get('running', [])}
+        return {'jobs': counts, 'nodes': nodes}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Nodes
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def read_manifest(self):
+        ''' Returns the coordinator's manifest, waiting for it to be published '''
+        manifest = read_json(self.manifest_file)
+        while manifest is None:
+            print(f"Shared Queue: Waiting for a coordinator to publish jobs to {self.shared_dir}")
+            self.logger.info(f"Shared Queue: Waiting for a coordinator to publish jobs to {self.shared_dir}")
+            time.sleep(self.poll_seconds)
+            manifest = read_json(self.manifest_file)
+        return manifest
+
+    def copy_snapshot(self, node_queuefile):
+        ''' Copies the published queuefile to a local CSV so the node has its own status view with the same job indexes '''
+        self.read_manifest()
+        convert_queuefile(self.snapshot_file, node_queuefile, logger=self.logger)
+        return node_queuefile
+
+    def refresh(self, force=False):
+        ''' Re-reads which jobs are finished, at most once every poll_seconds unless forced '''
+        if not force and time.time() - self.last_refresh < self.poll_seconds:
+            return
+        for job_index, result in self.read_results().items():
+            if result['condition'] in FINAL_CONDITIONS:
+                self.finished.add(job_index)
+        self.last_refresh = time.time()
+
+    def has_more(self):
+        ''' True while any published job is unfinished, either claimable now or running on a node whose lease may still expire '''
+        self.refresh()
+        manifest = read_json(self.manifest_file) or {}
+        return any(job_index not in self.finished for job_index in manifest.get('order', []))
+
+    def try_lease(self, job_index, claims):
+        ''' Creates the job's lease file. Only one node can create it, returns True if this node did '''
+        try:
+            fd = os.open(self.lease_file(job_index), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'job_index': job_index, 'node_id': self.node_id, 'claimed_at': time.time(),
+                       'expires_at': time.time() + self.lease_seconds, 'claims': claims}, f)
+        return True
+
+    def break_expired_lease(self, job_index, lease):
+        '''
+        Moves an expired lease out of the way so the job can be claimed again. Returns True if this node removed it.
+        If another node renewed or re-claimed the lease in the meantime, it's put back.
+        '''
+        lease_file = self.lease_file(job_index)
+        broken_file = f"{lease_file}.{self.node_id}.expired"
+        try:
+            os.rename(lease_file, broken_file)
+        except (FileNotFoundError, FileExistsError, PermissionError):
+            return False
+
+        broken = read_json(broken_file)
+        if broken != lease and not os.path.exists(lease_file):
+            # Another node took the lease between the read and the rename, give it back
+            os.rename(broken_file, lease_file)
+            return False
+
+        os.remove(broken_file)
+        previous = read_json(self.result_file(job_index)) or {}
+        print(f"Shared Queue: Lease on job {job_index} held by {lease['node_id']} expired, claiming it again")
+        self.logger.warning(f"Shared Queue: Lease on job {job_index} held by {lease['node_id']} expired (last result {previous.get('condition')}), claiming it again")
+        return True
+
+    def claim(self, count=1):
+        ''' Claims up to count jobs in the manifest order. Returns a list of (job_index, job) '''
+        manifest = read_json(self.manifest_file) or {}
+        self.refresh()
+        claimed = []
+
+        for job_index in manifest.get('order', []):
+            if len(claimed) >= count:
+                break
+            if job_index in self.finished or job_index in self.held:
+                continue
+
+            published = read_json(self.job_file(job_index))
+            if published is None:
+                continue
+            result = read_json(self.result_file(job_index))
+            if result and result.get('params_hash') == published['params_hash'] and result['condition'] in FINAL_CONDITIONS:
+                self.finished.add(job_index)
+                continue
+
+            claims = 1
+            if not self.try_lease(job_index, claims):
+                lease = read_json(self.lease_file(job_index))
+                if lease is None or lease['expires_at'] >= time.time():
+                    continue
+                claims = lease.get('claims', 1) + 1
+                if not self.break_expired_lease(job_index, lease) or not self.try_lease(job_index, claims):
+                    continue
+
+                # The job keeps taking its nodes down with it, stop handing it out
+                if claims > self.max_claims:
+                    with self.lock:
+                        self.held[job_index] = published['params_hash']
+                    self.record_result(job_index, 'Failed', f"Job was claimed {claims - 1} times and its lease expired every time")
+                    continue
+
+            with self.lock:
+                self.held[job_index] = published['params_hash']
+            claimed.append((job_index, published['job']))
+            print(f"Shared Queue: Node {self.node_id} claimed job {job_index}")
+            self.logger.info(f"Shared Queue: Node {self.node_id} claimed job {job_index} (claim {claims})")
+
+        return claimed
+
+    def record_result(self, job_index, condition, error=None):
+        ''' Writes the job's condition for the coordinator. A final condition releases the lease '''
+        with self.lock:
+            params_hash = self.held.get(job_index)
+        if params_hash is None:
+            return
+
+        write_json_atomic(self.result_file(job_index), {'job_index': job_index, 'params_hash': params_hash, 'condition': condition,
+                                                        'error': error, 'node_id': self.node_id, 'updated_at': time.time()})
+        if condition in FINAL_CONDITIONS:
+            self.release(job_index)
+            self.finished.add(job_index)
+
+    def release(self, job_index):
+        ''' Removes this node's lease on a job '''
+        with self.lock:
+            self.held.pop(job_index, None)
+        lease = read_json(self.lease_file(job_index))
+        if lease and lease['node_id'] == self.node_id:
+            try:
+                os.remove(self.lease_file(job_index))
+            except FileNotFoundError:
+                pass
+
+    def heartbeat(self):
+        ''' Pushes back the expiry of every lease this node holds and records that the node is alive '''
+        with self.lock:
+            held = list(self.held)
+
+        for job_index in held:
+            lease = read_json(self.lease_file(job_index))
+            if lease is None or lease['node_id'] != self.node_id:
+                # The lease expired and another node has the job now
+                self.logger.warning(f"Shared Queue: Node {self.node_id} lost its lease on job {job_index}")
+                continue
+            lease['expires_at'] = time.time() + self.lease_seconds
+            write_json_atomic(self.lease_file(job_index), lease)
+
+        write_json_atomic(os.path.join(self.nodes_dir, f'{self.node_id}.json'),
+                          {'node_id': self.node_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'updated_at': time.time(), 'running': held})
+
+    def start_heartbeat(self):
+        ''' Renews this node's leases on a background thread, three times per lease, until stop_heartbeat is called '''
+        if self.heartbeat_thread:
+            return
+        self.heartbeat_stop = threading.Event()
+
+        def heartbeat_loop():
+            while not self.heartbeat_stop.wait(self.lease_seconds / 3):
+                try:
+                    self.heartbeat()
+                except OSError as e:
+                    # The share dropped out, try again on the next beat before the leases run out
+                    self.logger.error(f"Shared Queue: Heartbeat failed: {e}")
+
+        self.heartbeat()
+        self.heartbeat_thread = threading.Thread(target=heartbeat_loop, name='shared_queue_heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        ''' Stops the heartbeat and gives up any leases still held so other nodes can pick the jobs up straight away '''
+        if self.heartbeat_thread:
+            self.heartbeat_stop.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+            self.heartbeat_stop = None
+        for job_index in list(self.held):
+            self.release(job_index)
+        node_file = os.path.join(self.nodes_dir, f'{self.node_id}.json')
+        if os.path.exists(node_file):
+            os.remove(node_file)
+
+
+class SHARED_JOB_SOURCE:
+    ''' Job source for the JOB_SCHEDULER that claims jobs from the shared queue and prepares each one before it runs '''
+
+    def __init__(self, shared_queue, prepare_job) -> None:
+        self.shared_queue = shared_queue
+        self.prepare_job = prepare_job
+        self.poll_seconds = shared_queue.poll_seconds
+
+    def claim(self, count=1):
+        ''' Claims and prepares up to count jobs. A job that is marked Failed while it is prepared has already released its lease '''
+        claimed = []
+        for job_index, job in self.shared_queue.claim(count):
+            prepared = self.prepare_job(job_index, job)
+            if prepared is not None:
+                claimed.append((job_index, prepared))
+        return claimed
+
+    def release(self, job_index):
+        ''' Gives a job back to the queue when the node stops before running it, another node can claim it '''
+        self.shared_queue.release(job_index)
+
+    def has_more(self):
+        return self.shared_queue.has_more()
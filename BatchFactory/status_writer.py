@@ -0,0 +1,205 @@
+###############################################################################################################################################################################
+#
+# Status Writer - collects batch_condition changes in memory and writes them to the queuefile in one save
+#
+###############################################################################################################################################################################
+import os
+import logging
+import tempfile
+import threading
+from openpyxl import load_workbook
+from queue_reader import QUEUE_READER, get_queue_format, write_queue_rows
+
+
+class STATUS_WRITER:
+    '''
+    The status writer is the only thing that writes to the queuefile. Condition changes are kept in memory and written
+    in one load/save when flush is called, either by the flush timer or at the end of a batch. The queuefile is saved
+    to a temp file next to it and renamed over it so a crash never leaves a half written queuefile. Excel queuefiles
+    are edited in place, CSV and Parquet queuefiles are rewritten.
+    '''
+
+    def __init__(self, queuefile, sheet_name, condition_column, dont_overwrite_column=None, logger=None) -> None:
+        self.queuefile = queuefile
+        self.sheet_name = sheet_name
+        self.condition_column = condition_column
+        self.dont_overwrite_column = dont_overwrite_column
+        self.logger = logger or logging.getLogger(__name__)
+
+        # Excel row number -> condition waiting to be written
+        self.pending = {}
+        # lock guards pending and is only held for moments, so jobs reporting a result never wait on a save. write_lock is
+        # held for a whole load/save so two flushes don't save over each other or write their conditions out of order
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.timer_stop = None
+        self.timer_thread = None
+
+    def __getstate__(self):
+        # The writer belongs to the parent process. Workers get a copy without the lock or timer
+        state = self.__dict__.copy()
+        state['lock'] = None
+        state['write_lock'] = None
+        state['timer_stop'] = None
+        state['timer_thread'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+
+    def set_condition(self, job_index, condition):
+        ''' Records the new condition for a job. Nothing is written until flush is called '''
+        # +2 to account for the header row and the 0-indexed job index
+        excel_row_index = job_index + 2
+        with self.lock:
+            self.pending[excel_row_index] = condition
+        self.logger.info(f"Status Writer - Job {job_index} (Row {excel_row_index}) condition '{condition}' waiting to be written")
+
+    def flush(self):
+        '''
+        Writes every pending condition to the queuefile in one save. Returns the number of rows written. The pending
+        conditions are taken under the lock and written outside it, conditions set while saving wait for the next flush.
+        '''
+        with self.write_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                pending = self.pending
+                self.pending = {}
+
+            try:
+                if get_queue_format(self.queuefile) == 'xlsx':
+                    written = self.write_xlsx(pending)
+                else:
+                    written = self.write_rows(pending)
+
+            except PermissionError as e:
+                # Usually the queuefile is open in Excel. The changes go back to pending and are written on the next flush
+                self.restore_pending(pending)
+                print(f"Error: Permission denied when trying to save the Excel file, will retry on the next flush - {e}")
+                self.logger.error(f"Status Writer - Permission denied when trying to save the Excel file, will retry on the next flush - {e}")
+                return 0
+
+            except Exception as e:
+                self.restore_pending(pending)
+                print(f"Unexpected error while writing job conditions: {e}")
+                self.logger.error(f"Status Writer - Unexpected error while writing job conditions: {e}")
+                return 0
+
+        print(f"Status Writer: Wrote {written} job conditions to the queuefile")
+        self.logger.info(f"Status Writer - Wrote {written} job conditions to the queuefile in one save")
+        return written
+
+    def restore_pending(self, pending):
+        ''' Puts conditions that couldn't be written back, unless a newer condition for the row came in while saving '''
+        with self.lock:
+            for excel_row_index, condition in pending.items():
+                self.pending.setdefault(excel_row_index, condition)
+
+    def write_xlsx(self, pending):
+        ''' Writes the pending conditions into the Excel queuefile in place, keeping its formatting. Returns the number of rows written '''
+        wb = load_workbook(filename=self.queuefile)
+        ws = wb[self.sheet_name]
+
+        # Read the header index for the batch_condition column
+        header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True))
+        if self.condition_column not in header:
+            raise ValueError(f"'{self.condition_column}' column not found in the spreadsheet.")
+
+        # +1 because Excel columns are 1-indexed
+        condition_index = header.index(self.condition_column) + 1
+        dont_overwrite_index = None
+        if self.dont_overwrite_column and self.dont_overwrite_column in header:
+            dont_overwrite_index = header.index(self.dont_overwrite_column) + 1
+
+        written = 0
+        for excel_row_index, condition in sorted(pending.items()):
+
+            # Do not update the row if it is blank
+            row_values = [ws.cell(row=excel_row_index, column=col).value for col in range(1, len(header) + 1)]
+            if all(value is None or str(value).strip() == '' for value in row_values):
+                self.logger.info(f"Status Writer - Row {excel_row_index} is blank, not updating.")
+                continue
+
+            ws.cell(row=excel_row_index, column=condition_index, value=condition)
+
+            # Requeued jobs keep the outputs from the failed run
+            if condition == 'Requeued' and dont_overwrite_index:
+                ws.cell(row=excel_row_index, column=dont_overwrite_index, value="True")
+                self.logger.info(f"Status Writer - Row {excel_row_index} updating {self.dont_overwrite_column} to 'True'.")
+            written += 1
+
+        self.save_atomic(wb)
+        return written
+
+    def write_rows(self, pending):
+        ''' Rewrites a CSV or Parquet queuefile with the pending conditions. Returns the number of rows written '''
+        rows = [list(row) for row in QUEUE_READER(self.queuefile, self.sheet_name, self.logger).iter_rows()]
+        header = rows[0] if rows else []
+        if self.condition_column not in header:
+            raise ValueError(f"'{self.condition_column}' column not found in the queuefile.")
+
+        condition_index = header.index(self.condition_column)
+        dont_overwrite_index = None
+        if self.dont_overwrite_column and self.dont_overwrite_column in header:
+            dont_overwrite_index = header.index(self.dont_overwrite_column)
+
+        written = 0
+        for excel_row_index, condition in sorted(pending.items()):
+            # Row numbers are 1-indexed with the header in row 1, the same as Excel
+            row = rows[excel_row_index - 1] if excel_row_index - 1 < len(rows) else []
+
+            # Do not update the row if it is blank
+            if all(value is None or str(value).strip() == '' for value in row):
+                self.logger.info(f"Status Writer - Row {excel_row_index} is blank, not updating.")
+                continue
+
+            row.extend([None] * (len(header) - len(row)))
+            row[condition_index] = condition
+
+            # Requeued jobs keep the outputs from the failed run
+            if condition == 'Requeued' and dont_overwrite_index is not None:
+                row[dont_overwrite_index] = "True"
+                self.logger.info(f"Status Writer - Row {excel_row_index} updating {self.dont_overwrite_column} to 'True'.")
+            written += 1
+
+        write_queue_rows(self.queuefile, rows, self.sheet_name)
+        return written
+
+    def save_atomic(self, wb):
+        ''' Saves the workbook to a temp file in the queuefile folder and renames it over the queuefile '''
+        queue_folder = os.path.dirname(os.path.abspath(self.queuefile))
+        fd, tmp_file = tempfile.mkstemp(suffix='.xlsx', prefix='~queuefile_', dir=queue_folder)
+        os.close(fd)
+        try:
+            wb.save(tmp_file)
+            os.replace(tmp_file, self.queuefile)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def start_timer(self, interval):
+        ''' Flushes the pending conditions every interval seconds on a background thread until stop_timer is called '''
+        if self.timer_thread:
+            return
+
+        self.timer_stop = threading.Event()
+
+        def flush_loop():
+            while not self.timer_stop.wait(interval):
+                self.flush()
+
+        self.timer_thread = threading.Thread(target=flush_loop, name='status_writer', daemon=True)
+        self.timer_thread.start()
+        self.logger.info(f"Status Writer - Flushing job conditions every {interval} seconds")
+
+    def stop_timer(self):
+        ''' Stops the flush timer and writes anything still pending '''
+        if self.timer_thread:
+            self.timer_stop.set()
+            self.timer_thread.join()
+            self.timer_thread = None
+            self.timer_stop = None
+        self.flush()
@@ -0,0 +1,9 @@
+###############################################################################################################################################################################
+#
+# Test setup - the BatchFactory modules import each other by name, so the folder above this one goes on the path
+#
+###############################################################################################################################################################################
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
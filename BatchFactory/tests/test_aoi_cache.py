@@ -0,0 +1,16 @@
+from aoi_utilities import get_kml_cache_key
+
+
+def write_kml(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('<kml xmlns="http://www.opengis.net/kml/2.2"><Document><name>AOI</name></Document></kml>')
+    return str(path)
+
+
+def test_same_kml_content_with_another_name_is_cached_apart(tmp_path):
+    # The converted layer is named after the KML, a cache hit would hand back the other KML's layer name
+    assert get_kml_cache_key(write_kml(tmp_path / 'Block A.kml')) != get_kml_cache_key(write_kml(tmp_path / 'Block B.kml'))
+
+
+def test_same_kml_in_another_folder_is_a_cache_hit(tmp_path):
+    assert get_kml_cache_key(write_kml(tmp_path / 'Block A.kml')) == get_kml_cache_key(write_kml(tmp_path / 'copy' / 'Block A.kml'))
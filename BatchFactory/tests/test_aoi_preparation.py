@@ -0,0 +1,39 @@
+import time
+import logging
+
+from aoi_preparation import AOI_PREPARATION
+
+
+def claim_all(preparation, timeout=10):
+    claimed = []
+    deadline = time.time() + timeout
+    while preparation.has_more() and time.time() < deadline:
+        claimed.extend(preparation.claim(10))
+        time.sleep(0.01)
+    return claimed
+
+
+def test_failed_preparation_is_not_handed_to_the_scheduler():
+    jobs = [(0, {'feature_layer': 'a.shp'}), (1, {'feature_layer': 'b.xyz'}), (2, {'feature_layer': 'c.gdb/c'})]
+
+    # batch_factory.prepare_job_aoi returns None for a job it marked Failed
+    def prepare(job_index, job):
+        return None if job['feature_layer'].endswith('.xyz') else job
+
+    preparation = AOI_PREPARATION(jobs, prepare, 2, logging.getLogger(__name__))
+    claimed = claim_all(preparation)
+    preparation.shutdown()
+
+    assert sorted(job_index for job_index, _ in claimed) == [0, 2]
+    assert not preparation.has_more()
+
+
+def test_job_is_handed_over_when_preparation_raises():
+    def prepare(job_index, job):
+        raise RuntimeError('FW Setup failed')
+
+    preparation = AOI_PREPARATION([(0, {'feature_layer': 'a.shp'})], prepare, 1, logging.getLogger(__name__))
+    claimed = claim_all(preparation)
+    preparation.shutdown()
+
+    assert [job_index for job_index, _ in claimed] == [0]
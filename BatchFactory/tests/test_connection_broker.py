@@ -0,0 +1,34 @@
+import logging
+
+from connection_broker import CONNECTION_BROKER
+from job_ledger import JOB_LEDGER
+
+
+def test_sessions_are_capped_at_one_job_per_worker_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv('BCGW_MAX_SESSIONS', raising=False)
+    monkeypatch.setenv('MAX_WORKERS', '3')
+    monkeypatch.setenv('BCGW_SESSIONS_PER_JOB', '2')
+
+    broker = CONNECTION_BROKER(str(tmp_path), logger=logging.getLogger(__name__))
+    broker.healthy = True
+    broker.last_check = float('inf')
+
+    assert broker.max_sessions == 6
+    broker.acquire(0)
+    broker.acquire(1)
+    assert broker.has_free_session()
+    broker.acquire(2)
+    assert not broker.has_free_session()
+
+
+def test_the_instance_a_job_ran_on_is_recorded(tmp_path):
+    broker = CONNECTION_BROKER(str(tmp_path), instances=['bcgw.bcgov/idwprod1.bcgov', 'bcgw-i.bcgov/idwdlvr1.bcgov'],
+                               logger=logging.getLogger(__name__))
+    broker.instance = 'bcgw-i.bcgov/idwdlvr1.bcgov'
+
+    ledger = JOB_LEDGER(str(tmp_path / 'queue_ledger.sqlite'), logging.getLogger(__name__))
+    ledger.register(0, 'hash_0')
+    ledger.mark_started(0, worker_pid=123, bcgw_instance=broker.acquire(0))
+
+    assert ledger.get(0)['bcgw_instance'] == 'bcgw-i.bcgov/idwdlvr1.bcgov'
+    ledger.close()
@@ -0,0 +1,27 @@
+from job_cost import COST_MODEL, measure_aoi_files, order_jobs, simulate_makespan
+
+
+def test_jobs_are_ordered_by_priority_then_longest_first():
+    jobs = [(0, {'priority': None}), (1, {'priority': None}), (2, {'priority': 5}), (3, {'priority': None})]
+    costs = {0: 600, 1: 7200, 2: 60, 3: 1800}
+
+    assert [job_index for job_index, _ in order_jobs(jobs, costs)] == [2, 1, 3, 0]
+
+
+def test_longest_first_shortens_the_batch():
+    durations = [60, 60, 60, 60, 600]
+    assert simulate_makespan(durations, 2) == 720
+    assert simulate_makespan(sorted(durations, reverse=True), 2) == 600
+
+
+def test_aois_are_sized_by_their_files(tmp_path):
+    (tmp_path / 'aoi.shp').write_bytes(b'x' * 1000)
+    (tmp_path / 'aoi.dbf').write_bytes(b'x' * 24)
+    gdb = tmp_path / 'aois.gdb'
+    gdb.mkdir()
+    (gdb / 'a00000001.gdbtable').write_bytes(b'x' * 2048)
+
+    assert measure_aoi_files(str(tmp_path / 'aoi.shp')) == {'bytes': 1024}
+    assert measure_aoi_files(str(gdb / 'aoi_poly')) == {'bytes': 2048}
+    assert measure_aoi_files(str(tmp_path / 'missing.kml')) is None
+    assert COST_MODEL().estimate({'bytes': 1024 * 1024}) > COST_MODEL().estimate({'bytes': 1024})
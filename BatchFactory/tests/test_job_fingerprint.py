@@ -0,0 +1,25 @@
+from job_fingerprint import fingerprint_job
+
+PARAMETER_NAMES = ['feature_layer', 'file_number', 'output_directory', 'dont_overwrite_outputs']
+
+
+def test_requeued_job_keeps_its_fingerprint(tmp_path):
+    aoi = tmp_path / 'aoi.kml'
+    aoi.write_text('<kml/>')
+    job = {'feature_layer': str(aoi), 'file_number': '1234567', 'output_directory': str(tmp_path / 'out'),
+           'dont_overwrite_outputs': 'False', 'batch_condition': 'Queued'}
+    before = fingerprint_job(job, PARAMETER_NAMES)
+
+    job['batch_condition'] = 'Requeued'
+    job['dont_overwrite_outputs'] = 'True'
+    assert fingerprint_job(job, PARAMETER_NAMES) == before
+
+
+def test_changed_input_changes_the_fingerprint(tmp_path):
+    aoi = tmp_path / 'aoi.kml'
+    aoi.write_text('<kml/>')
+    job = {'feature_layer': str(aoi), 'file_number': '1234567'}
+    before = fingerprint_job(job, PARAMETER_NAMES)
+
+    aoi.write_text('<kml><Document/></kml>')
+    assert fingerprint_job(job, PARAMETER_NAMES) != before
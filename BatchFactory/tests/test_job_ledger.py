@@ -0,0 +1,79 @@
+import logging
+import threading
+
+from job_ledger import JOB_LEDGER, hash_job_parameters
+
+PARAMETER_NAMES = ['region', 'feature_layer', 'file_number', 'output_directory', 'dont_overwrite_outputs']
+
+
+def make_job():
+    return {'region': 'Cariboo', 'feature_layer': r'\\server\aoi.shp', 'file_number': '1234567',
+            'output_directory': r'\\server\out', 'dont_overwrite_outputs': 'False', 'batch_condition': 'Queued', '_job_index': 0}
+
+
+def test_requeued_job_keeps_its_hash():
+    job = make_job()
+    before = hash_job_parameters(job, PARAMETER_NAMES)
+
+    # What the scheduler and status writer do to a job they requeue
+    job['batch_condition'] = 'Requeued'
+    job['dont_overwrite_outputs'] = 'True'
+
+    assert hash_job_parameters(job, PARAMETER_NAMES) == before
+
+
+def test_edited_row_is_a_new_job():
+    job = make_job()
+    before = hash_job_parameters(job, PARAMETER_NAMES)
+    job['file_number'] = '7654321'
+    assert hash_job_parameters(job, PARAMETER_NAMES) != before
+
+
+def test_requeued_row_keeps_its_ledger_record(tmp_path):
+    ledger_file = str(tmp_path / 'queue_ledger.sqlite')
+    job = make_job()
+
+    ledger = JOB_LEDGER(ledger_file, logging.getLogger(__name__))
+    ledger.register(0, hash_job_parameters(job, PARAMETER_NAMES))
+    ledger.mark_started(0, worker_pid=123)
+    ledger.set_state(0, 'Requeued', 'ORA-03113')
+    ledger.close()
+
+    # The next run reads the row back with the columns the batch rewrote
+    job['batch_condition'] = 'Requeued'
+    job['dont_overwrite_outputs'] = 'True'
+    ledger = JOB_LEDGER(ledger_file, logging.getLogger(__name__))
+    record = ledger.register(0, hash_job_parameters(job, PARAMETER_NAMES))
+    ledger.close()
+
+    assert record['state'] == 'Requeued'
+    assert record['attempts'] == 1
+
+
+def test_ledger_can_be_written_from_several_threads(tmp_path):
+    ledger = JOB_LEDGER(str(tmp_path / 'queue_ledger.sqlite'), logging.getLogger(__name__))
+    for job_index in range(40):
+        ledger.register(job_index, f'hash_{job_index}')
+
+    # The scheduler, AOI preparation threads and the status writer's timer share the ledger
+    errors = []
+
+    def run_jobs(job_indexes):
+        try:
+            for job_index in job_indexes:
+                ledger.mark_started(job_index, worker_pid=job_index)
+                ledger.set_fingerprint(job_index, f'fingerprint_{job_index}')
+                ledger.set_state(job_index, 'COMPLETE')
+                ledger.loaded_states()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_jobs, args=(range(start, 40, 4),)) for start in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert ledger.jobs_in_state(['COMPLETE']) == list(range(40))
+    ledger.close()
@@ -0,0 +1,35 @@
+import os
+import logging
+
+from output_planner import OUTPUT_PLANNER, get_output_target
+
+
+def test_jobs_sharing_an_output_folder_are_reported(tmp_path):
+    shared = str(tmp_path / 'out')
+    jobs = [(0, {'output_directory': shared}),
+            (1, {'output_directory': shared + os.sep}),
+            (2, {'output_directory': str(tmp_path / 'other')})]
+
+    conflicts = OUTPUT_PLANNER(logging.getLogger(__name__)).plan(jobs)
+
+    assert conflicts == {get_output_target(jobs[0][1]): [0, 1]}
+
+
+def test_empty_output_directory_uses_the_feature_layer_folder(tmp_path):
+    gdb_job = {'output_directory': '', 'feature_layer': str(tmp_path / 'aois' / 'aoi.gdb' / 'aoi_poly')}
+    shp_job = {'output_directory': '#', 'feature_layer': str(tmp_path / 'aois' / 'aoi.shp')}
+
+    assert get_output_target(gdb_job) == get_output_target(shp_job) == os.path.normcase(str(tmp_path / 'aois'))
+
+
+def test_a_busy_output_folder_waits_until_released(tmp_path):
+    planner = OUTPUT_PLANNER(logging.getLogger(__name__))
+    first = {'output_directory': str(tmp_path / 'out')}
+    second = {'output_directory': str(tmp_path / 'out')}
+
+    planner.acquire(0, first)
+    assert not planner.is_free(second)
+    assert planner.is_free({'output_directory': str(tmp_path / 'other')})
+
+    planner.release(0)
+    assert planner.is_free(second)
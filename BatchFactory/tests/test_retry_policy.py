@@ -0,0 +1,42 @@
+from retry_policy import RETRY_POLICY
+
+
+def test_no_progress_kill_is_not_retried():
+    error = "Job made no progress for 1800 seconds during run_tool (NO_PROGRESS_SECONDS is 1800), worker terminated"
+    assert RETRY_POLICY().classify(error, 'NoProgress') == 'permanent'
+
+
+def test_dropped_connections_are_transient():
+    policy = RETRY_POLICY()
+    assert policy.classify('ORA-03113: end-of-file on communication channel') == 'transient'
+    assert policy.classify('ERROR 000464: Cannot get exclusive schema lock') == 'transient'
+    assert policy.classify('', 'ConnectionResetError') == 'transient'
+
+
+def test_login_failures_are_never_retried():
+    # The TNS text would otherwise make it transient, retrying a bad password can lock the BCGW account
+    assert RETRY_POLICY().classify('ORA-01017: invalid username/password; logon denied (TNS: connection closed)') == 'permanent'
+
+
+def test_bad_inputs_are_permanent():
+    policy = RETRY_POLICY()
+    assert policy.classify('ERROR 000732: Input Features: Dataset aoi.shp does not exist or is not supported') == 'permanent'
+    assert policy.classify('list index out of range', 'ValueError') == 'permanent'
+    assert policy.classify('something unexpected', 'RuntimeError') == 'permanent'
+
+
+def test_worker_that_died_without_an_error_is_retried():
+    assert RETRY_POLICY().classify(None, None) == 'transient'
+
+
+def test_retries_stop_at_max_attempts():
+    policy = RETRY_POLICY(max_attempts=3)
+    assert policy.should_retry(1, 'ORA-03113')
+    assert policy.should_retry(2, 'ORA-03113')
+    assert not policy.should_retry(3, 'ORA-03113')
+    assert not policy.should_retry(1, 'ERROR 000732')
+
+
+def test_backoff_doubles_up_to_the_cap():
+    policy = RETRY_POLICY(backoff_seconds=60, max_backoff_seconds=300)
+    assert [policy.backoff(attempts) for attempts in [1, 2, 3, 4]] == [60, 120, 240, 300]
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import logging
+
+from queue_reader import write_queue_rows
+from shared_queue import SHARED_QUEUE, read_json
+
+
+def publish_jobs(tmp_path, count):
+    queuefile = str(tmp_path / 'queue.csv')
+    write_queue_rows(queuefile, [('region', 'batch_condition')] + [(f'Region {job_index}', 'Queued') for job_index in range(count)])
+    shared_dir = str(tmp_path / 'shared')
+    coordinator = SHARED_QUEUE(shared_dir, node_id='coordinator', logger=logging.getLogger(__name__))
+    coordinator.publish(queuefile, ['region'], [(job_index, f'hash_{job_index}', {'region': f'Region {job_index}'}) for job_index in range(count)])
+    return shared_dir
+
+
+def make_node(shared_dir, node_id, **kwargs):
+    return SHARED_QUEUE(shared_dir, node_id=node_id, poll_seconds=0, logger=logging.getLogger(__name__), **kwargs)
+
+
+def expire_lease(node, job_index):
+    lease_file = node.lease_file(job_index)
+    lease = read_json(lease_file)
+    lease['expires_at'] = time.time() - 1
+    with open(lease_file, 'w', encoding='utf-8') as f:
+        json.dump(lease, f)
+
+
+def test_a_leased_job_is_not_claimed_twice(tmp_path):
+    shared_dir = publish_jobs(tmp_path, 2)
+    first = make_node(shared_dir, 'node_a')
+    second = make_node(shared_dir, 'node_b')
+
+    assert [job_index for job_index, _ in first.claim(1)] == [0]
+    assert [job_index for job_index, _ in second.claim(2)] == [1]
+    assert second.claim(1) == []
+
+
+def test_an_expired_lease_is_claimed_again(tmp_path):
+    shared_dir = publish_jobs(tmp_path, 1)
+    first = make_node(shared_dir, 'node_a')
+    second = make_node(shared_dir, 'node_b')
+
+    first.claim(1)
+    assert second.claim(1) == []
+
+    # node_a died and stopped renewing its lease
+    expire_lease(first, 0)
+    assert [job_index for job_index, _ in second.claim(1)] == [0]
+    lease = read_json(second.lease_file(0))
+    assert lease['node_id'] == 'node_b'
+    assert lease['claims'] == 2
+
+
+def test_a_job_whose_lease_keeps_expiring_is_failed(tmp_path):
+    shared_dir = publish_jobs(tmp_path, 1)
+    nodes = [make_node(shared_dir, f'node_{n}', max_claims=2) for n in range(3)]
+
+    nodes[0].claim(1)
+    expire_lease(nodes[0], 0)
+    nodes[1].claim(1)
+    expire_lease(nodes[1], 0)
+
+    assert nodes[2].claim(1) == []
+    assert read_json(nodes[2].result_file(0))['condition'] == 'Failed'
+    assert not nodes[2].has_more()
+
+
+def test_a_final_result_releases_the_lease(tmp_path):
+    shared_dir = publish_jobs(tmp_path, 1)
+    node = make_node(shared_dir, 'node_a')
+
+    node.claim(1)
+    node.record_result(0, 'COMPLETE')
+
+    assert not os.path.exists(node.lease_file(0))
+    assert not node.has_more()
+    assert make_node(shared_dir, 'node_b').claim(1) == []
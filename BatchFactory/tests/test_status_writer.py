@@ -0,0 +1,54 @@
+import logging
+import threading
+
+from status_writer import STATUS_WRITER
+
+
+def make_writer(tmp_path):
+    return STATUS_WRITER(str(tmp_path / 'queue.csv'), 'batch_config', 'batch_condition', 'dont_overwrite_outputs', logging.getLogger(__name__))
+
+
+def test_conditions_can_be_set_while_a_flush_is_saving(tmp_path):
+    writer = make_writer(tmp_path)
+    saving = threading.Event()
+    finish = threading.Event()
+    written = []
+
+    def write_rows(pending):
+        saving.set()
+        finish.wait(5)
+        written.append(dict(pending))
+        return len(pending)
+
+    writer.write_rows = write_rows
+    writer.set_condition(0, 'Running')
+    flush = threading.Thread(target=writer.flush)
+    flush.start()
+    saving.wait(5)
+
+    # Doesn't wait for the save, the condition is written by the next flush
+    setter = threading.Thread(target=writer.set_condition, args=(0, 'COMPLETE'))
+    setter.start()
+    setter.join(1)
+    assert not setter.is_alive()
+
+    finish.set()
+    flush.join()
+    writer.flush()
+    assert written == [{2: 'Running'}, {2: 'COMPLETE'}]
+
+
+def test_conditions_that_could_not_be_saved_stay_pending(tmp_path):
+    writer = make_writer(tmp_path)
+
+    def write_rows(pending):
+        # A newer condition for row 3 arrives while the queuefile is locked
+        writer.set_condition(1, 'COMPLETE')
+        raise PermissionError('queuefile is open in Excel')
+
+    writer.write_rows = write_rows
+    writer.set_condition(0, 'Running')
+    writer.set_condition(1, 'Running')
+
+    assert writer.flush() == 0
+    assert writer.pending == {2: 'Running', 3: 'COMPLETE'}
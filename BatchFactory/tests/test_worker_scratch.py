@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import logging
+import subprocess
+
+from worker_scratch import remove_stale_scratch
+
+
+def make_old_folder(path):
+    os.makedirs(path)
+    old = time.time() - 48 * 3600
+    os.utime(path, (old, old))
+    return path
+
+
+def finished_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_old_folders_of_running_workers_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv('SCRATCH_MAX_AGE_HOURS', '24')
+    live = make_old_folder(str(tmp_path / f'worker_{os.getpid()}'))
+    live_outputs = make_old_folder(str(tmp_path / 'outputs' / f'job_3_{os.getpid()}'))
+    dead = make_old_folder(str(tmp_path / f'worker_{finished_pid()}'))
+
+    remove_stale_scratch(str(tmp_path), logging.getLogger(__name__))
+
+    assert os.path.isdir(live)
+    assert os.path.isdir(live_outputs)
+    assert not os.path.exists(dead)
+
+
+def test_recent_folders_of_finished_workers_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv('SCRATCH_MAX_AGE_HOURS', '24')
+    recent = str(tmp_path / f'worker_{finished_pid()}')
+    os.makedirs(recent)
+
+    remove_stale_scratch(str(tmp_path), logging.getLogger(__name__))
+
+    assert os.path.isdir(recent)
@@ -1,5 +1,5 @@
 import os
-import arcpy
+from gp_backend import get_backend
 
 #NOTE - Need to remove the template portion in the future
 
@@ -15,7 +15,7 @@ def import_any_toolbox(logger):
 
     # Import the toolbox
     try:
-        arcpy.ImportToolbox(any_toolbox)
+        get_backend().import_toolbox(any_toolbox)
         print(f"Toolbox imported successfully.")
         logger.info(f"Toolbox imported successfully.")
     except Exception as e:
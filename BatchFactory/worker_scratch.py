@@ -0,0 +1,176 @@
+###############################################################################################################################################################################
+#
+# Worker Scratch - a scratch workspace on local disk for each worker process, and local staging of each job's outputs
+#
+# Every worker gets its own folder under LOCAL_SCRATCH_DIR (the system temp folder by default) and arcpy's
+# scratchWorkspace points at it, so intermediate data never goes to the network share and two workers never share a
+# scratch geodatabase. With STAGE_OUTPUTS_LOCALLY the tool writes its outputs to the worker's folder as well, and they
+# are copied to the job's output_directory once the tool is done, by the worker or (UPLOAD_OUTPUTS_ASYNC) by the
+# scheduler's OUTPUT_UPLOADER while the worker runs its next job. Staged outputs are kept outside the worker's folder so
+# a spawned worker can exit before they are uploaded.
+#
+###############################################################################################################################################################################
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+# psutil checks whether the worker that owns a scratch folder is still running. Without it the OS is asked directly
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from gp_backend import get_backend
+from env_config import get_env_number
+
+# The geodatabase the tool writes to the output directory (and keeps if dont_overwrite_outputs is true)
+AOI_GDB = 'aoi_boundary.gdb'
+
+# This worker process's scratch folder, created by setup_worker_scratch
+SCRATCH_WORKSPACE = None
+
+
+def get_scratch_root():
+    ''' Returns the local folder the worker scratch folders are made in '''
+    return os.getenv('LOCAL_SCRATCH_DIR') or os.path.join(tempfile.gettempdir(), 'batch_factory_scratch')
+
+
+def stage_outputs_locally():
+    return str(os.getenv('STAGE_OUTPUTS_LOCALLY', 'True')).strip().lower() == 'true'
+
+
+def upload_outputs_async():
+    return str(os.getenv('UPLOAD_OUTPUTS_ASYNC', 'True')).strip().lower() == 'true'
+
+
+def is_process_alive(pid):
+    ''' True if a process with this pid is running. Errs on the side of alive when it can't tell '''
+    if pid == os.getpid():
+        return True
+    if psutil is not None:
+        return psutil.pid_exists(pid)
+    if sys.platform == 'win32':
+        import ctypes
+        # PROCESS_QUERY_LIMITED_INFORMATION, STILL_ACTIVE
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == 259
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def get_folder_pid(name):
+    ''' Returns the pid of the worker that made a worker_<pid> or job_<index>_<pid> folder, or None '''
+    pid = name.rsplit('_', 1)[-1]
+    return int(pid) if pid.isdigit() else None
+
+
+def remove_stale_scratch(scratch_root, logger):
+    '''
+    Removes the worker and staged output folders left behind by terminated workers, once they are SCRATCH_MAX_AGE_HOURS
+    old. A folder whose worker is still running is kept whatever its age, a long job may not have touched it for hours.
+    '''
+    max_age = get_env_number('SCRATCH_MAX_AGE_HOURS', 24, float) * 3600
+    outputs_root = os.path.join(scratch_root, 'outputs')
+    folders = [os.path.join(scratch_root, name) for name in os.listdir(scratch_root) if name.startswith('worker_')]
+    if os.path.isdir(outputs_root):
+        folders += [os.path.join(outputs_root, name) for name in os.listdir(outputs_root)]
+    for folder in folders:
+        pid = get_folder_pid(os.path.basename(folder))
+        if pid is not None and is_process_alive(pid):
+            continue
+        try:
+            if time.time() - os.path.getmtime(folder) > max_age:
+                shutil.rmtree(folder, ignore_errors=True)
+                logger.info(f"Worker Scratch: Removed stale scratch folder {folder}")
+        except OSError:
+            pass
+
+
+def setup_worker_scratch(logger):
+    ''' Creates this worker's scratch folder and makes it the scratch workspace. Safe to call for every job. Returns the folder '''
+    global SCRATCH_WORKSPACE
+    if SCRATCH_WORKSPACE is not None:
+        return SCRATCH_WORKSPACE
+
+    scratch_root = get_scratch_root()
+    os.makedirs(scratch_root, exist_ok=True)
+    remove_stale_scratch(scratch_root, logger)
+
+    SCRATCH_WORKSPACE = os.path.join(scratch_root, f'worker_{os.getpid()}')
+    shutil.rmtree(SCRATCH_WORKSPACE, ignore_errors=True)
+    os.makedirs(SCRATCH_WORKSPACE)
+    get_backend().set_environment(scratch_workspace=SCRATCH_WORKSPACE)
+    logger.info(f"Worker Scratch: Scratch workspace is {SCRATCH_WORKSPACE}")
+    return SCRATCH_WORKSPACE
+
+
+def remove_worker_scratch():
+    ''' Removes this worker's scratch folder when the worker is done '''
+    global SCRATCH_WORKSPACE
+    if SCRATCH_WORKSPACE is not None:
+        shutil.rmtree(SCRATCH_WORKSPACE, ignore_errors=True)
+        SCRATCH_WORKSPACE = None
+
+
+def stage_job_outputs(job_index, output_directory, dont_overwrite_outputs, logger):
+    '''
+    Returns a local folder for the tool to write the job's outputs to. If the job keeps its outputs (a retry or a
+    requeued job) the existing aoi_boundary.gdb is copied in first, so the tool finds it like it would on the share.
+    '''
+    setup_worker_scratch(logger)
+    staged = os.path.join(get_scratch_root(), 'outputs', f'job_{job_index}_{os.getpid()}')
+    shutil.rmtree(staged, ignore_errors=True)
+    os.makedirs(staged)
+
+    existing_gdb = os.path.join(output_directory, AOI_GDB)
+    if dont_overwrite_outputs and os.path.isdir(existing_gdb):
+        shutil.copytree(existing_gdb, os.path.join(staged, AOI_GDB))
+        logger.info(f"Worker Scratch: Copied the existing {existing_gdb} into {staged}")
+
+    logger.info(f"Worker Scratch: Job {job_index} outputs are written to {staged} and copied to {output_directory}")
+    return staged
+
+
+def copy_outputs_back(staged, output_directory, logger):
+    '''
+    Copies everything the tool wrote to the staged folder into output_directory, then removes the staged folder. A file
+    geodatabase replaces the one on the share as a whole, merging two geodatabases' files would corrupt it. Returns the
+    number of bytes copied.
+    '''
+    copied = 0
+    os.makedirs(output_directory, exist_ok=True)
+    for name in os.listdir(staged):
+        source = os.path.join(staged, name)
+        target = os.path.join(output_directory, name)
+        if os.path.isdir(source):
+            copied += sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(source) for file in files)
+            if name.lower().endswith('.gdb'):
+                # Copy next to the old geodatabase first so the share never has half a geodatabase under the real name
+                partial = target + '.partial'
+                shutil.rmtree(partial, ignore_errors=True)
+                shutil.copytree(source, partial)
+                shutil.rmtree(target, ignore_errors=True)
+                os.replace(partial, target)
+            else:
+                shutil.copytree(source, target, dirs_exist_ok=True)
+        else:
+            copied += os.path.getsize(source)
+            shutil.copy2(source, target)
+
+    shutil.rmtree(staged, ignore_errors=True)
+    logger.info(f"Worker Scratch: Copied {copied / (1024 * 1024):.1f} MB of outputs to {output_directory}")
+    return copied